@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the active time of selfstats summaries computed with a Period
+per group, one time at a time, with period.unions, which does all groups at
+once with numpy. Synthetic keystroke and click times are split over a
+number of groups, keystrokes first and then clicks like in selfstats. Both
+must give the same intervals and totals on the first --check times."""
+
+import sys
+import time
+import argparse
+
+import numpy
+
+from selfspy.period import Period, Periods, unions
+
+CUTOFF = 180
+
+
+def make_times(count, groups, seed=0):
+    rnd = numpy.random.RandomState(seed)
+    # bursts of typing with pauses in between
+    gaps = rnd.exponential(0.3, count)
+    pauses = rnd.random_sample(count) < 0.001
+    gaps[pauses] = rnd.exponential(600, pauses.sum())
+    times = 1.7e9 + numpy.cumsum(gaps)
+    del gaps, pauses
+    group = rnd.randint(0, groups, count).astype(numpy.intc)
+    # clicks, every tenth time, come after all keystrokes
+    clicks = numpy.zeros(count, dtype=bool)
+    clicks[::10] = True
+    order = numpy.argsort(clicks, kind='mergesort')
+    return group[order], times[order]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=float, default=1e8, help='Number of times. Default is %(default)g')
+    parser.add_argument('-g', '--groups', type=int, default=50, help='Number of groups. Default is %(default)s')
+    parser.add_argument('--check', type=int, default=10 ** 6, help='Number of times to compare with Period. Default is %(default)s')
+    args = parser.parse_args()
+
+    maxtime = time.time()
+    groups, times = make_times(args.check, args.groups)
+    start = time.time()
+    periods = [Period(CUTOFF, maxtime) for _ in xrange(args.groups)]
+    for group, t in zip(groups.tolist(), times.tolist()):
+        periods[group].append(t)
+    period_time = time.time() - start
+
+    start = time.time()
+    collected = Periods(CUTOFF, maxtime)
+    for group in xrange(args.groups):
+        collected.extend(group, times[groups == group].tolist())
+    found = collected.calc()
+    periods_time = time.time() - start
+    for group in xrange(args.groups):
+        if (periods[group].times != found[group].times or
+                periods[group].calc_total() != found[group].calc_total()):
+            print 'Different active time for group %d: %r with Period, %r with unions' % (
+                group, periods[group].calc_total(), found[group].calc_total())
+            sys.exit(1)
+    print '%d times: Period %.2f s, Periods %.2f s, %.1fx' % (
+        args.check, period_time, periods_time, period_time / periods_time)
+    del periods, collected, found, groups, times
+
+    groups, times = make_times(int(args.n), args.groups)
+    start = time.time()
+    found = unions(groups, times, CUTOFF, maxtime)
+    print '%d times in %d groups: unions %.2f s, %d intervals, %.0f active hours' % (
+        len(times), args.groups, time.time() - start, sum(len(u.starts) for u in found),
+        sum(u.calc_total() for u in found) / 3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares selfstats --body searches that decrypt every key sequence with
+searches narrowed by the search index (selfspy --body-index), on a
+synthetic encrypted database of typed words. Both must find the same rows."""
+
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import tempfile
+
+from Crypto.Cipher import Blowfish
+
+from selfspy import models
+from selfspy import body_index
+from selfspy.stats import Selfstats
+
+PASSWORD = 'benchmark'
+
+PATTERNS = ['quixotic', r'\bjazz\b', 'lorem ipsum', r'meet(ing)? at \d+', 'e']
+
+
+def make_words(rnd, count):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rnd.choice(letters) for _ in xrange(rnd.randint(2, 9)))
+             for _ in xrange(count)]
+    return words + ['quixotic', 'jazz', 'lorem', 'ipsum', 'meeting', 'at']
+
+
+def build(fname, rows, seed=0):
+    rnd = random.Random(seed)
+    words = make_words(rnd, 5000)
+    session = models.initialize(fname)()
+    process = models.Process(u'editor')
+    session.add(process)
+    session.flush()
+    window = models.Window('notes', process.id)
+    session.add(window)
+    session.flush()
+
+    start = datetime.datetime(2026, 1, 1)
+    for i in xrange(rows):
+        text = ' '.join(rnd.choice(words) for _ in xrange(rnd.randint(1, 12)))
+        if rnd.random() < 0.01:
+            text += ' meet at %d' % rnd.randint(1, 12)
+        row = models.Keys(text, [], [0.1] * len(text), len(text), start,
+                          process.id, window.id, 1)
+        row.created_at = start + datetime.timedelta(seconds=i * 30)
+        session.add(row)
+        if i % 10000 == 0:
+            session.commit()
+    session.commit()
+    session.close()
+
+
+def args(pattern):
+    a = dict(no_rollups=True, id=None, body=pattern, min_keys=None, key_freqs=False,
+             periods=None, process=None, title=None, date=None, clock=None, back=None,
+             limit=None, active=None, pactive=None, tactive=None, ratios=None,
+             pkeys=False, tkeys=False, clicks=False, showtext=False,
+             human_readable=False, password=PASSWORD)
+    return a
+
+
+def search(fname, pattern):
+    start = time.time()
+    ids = [row.id for row in Selfstats(fname, args(pattern)).filter_keys()]
+    return ids, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=100000, help='Number of key sequences. Default is %(default)s')
+    parser.add_argument('--db', help='Database file to use, created if missing. Default is a temporary file.')
+    args = parser.parse_args()
+
+    key = hashlib.md5(PASSWORD).digest()
+    models.ENCRYPTER = Blowfish.new(key)
+    models.LOOKUP_KEY = models.make_lookup_key(key)
+
+    fname = args.db or os.path.join(tempfile.mkdtemp(), 'selfspy.sqlite')
+    if not os.path.exists(fname):
+        print 'Building %d key sequences in %s...' % (args.n, fname)
+        build(fname, args.n)
+    session_maker = models.initialize(fname)
+
+    session = session_maker()
+    session.query(models.BodyIndex).delete()
+    session.execute(models.BodyToken.__table__.delete())
+    session.commit()
+    scans = dict((pattern, search(fname, pattern)) for pattern in PATTERNS)
+
+    start = time.time()
+    indexed = body_index.backfill(session_maker, [session_maker])
+    print 'Indexed %d rows in %.1f s, %.1f MB' % (
+        indexed, time.time() - start, os.path.getsize(fname) / 1048576.0)
+
+    print '%-20s %8s %10s %10s %8s' % ('pattern', 'rows', 'scan', 'index', 'speedup')
+    for pattern in PATTERNS:
+        scan_ids, scan_time = scans[pattern]
+        ids, index_time = search(fname, pattern)
+        if ids != scan_ids:
+            print 'Different results for %s: %d rows scanning, %d with the index' % (
+                pattern, len(scan_ids), len(ids))
+            sys.exit(1)
+        print '%-20s %8d %9.2fs %9.2fs %7.1fx' % (
+            pattern, len(ids), scan_time, index_time, scan_time / index_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the struct based RECORD decoder in sniff_x with the generic
+python-xlib parser it replaced. No X server is needed. No recorded reply
+buffers ship with selfspy: by default a synthetic stream of 70% motion, 25%
+keystrokes and 5% clicks is generated, where every KeyPress and ButtonPress
+is followed by its KeyRelease or ButtonRelease as the RECORD context in
+sniff_x delivers them, one event per reply. To measure a
+real session, append struct.pack('<I', len(reply.data)) + reply.data to a
+file for every reply in Sniffer.processevents and pass it with
+--replies."""
+
+import sys
+import time
+import random
+import struct
+import argparse
+
+from Xlib import X
+from Xlib.protocol import event, rq
+
+from selfspy.sniff_x import Sniffer, INPUT_EVENT
+
+
+class OfflineDisplay:
+    event_classes = event.event_class
+
+    def get_resource_class(self, name, default=None):
+        return default
+
+
+def make_replies(count, seed=0):
+    rnd = random.Random(seed)
+    replies = []
+    seq = 0
+    while len(replies) < count:
+        r = rnd.random()
+        if r < 0.7:
+            etypes, detail = [X.MotionNotify], 0
+        elif r < 0.95:
+            etypes, detail = [X.KeyPress, X.KeyRelease], rnd.randint(10, 60)
+        else:
+            etypes, detail = [X.ButtonPress, X.ButtonRelease], rnd.randint(1, 5)
+        x, y = rnd.randint(0, 1920), rnd.randint(0, 1080)
+        state = rnd.choice([0, 1, 4])
+        for etype in etypes:
+            seq += 1
+            replies.append(INPUT_EVENT.pack(etype, detail, seq & 0xffff, seq, 1, 1, 0,
+                                            x, y, x, y, state, 1))
+    return replies[:count]
+
+
+def load_replies(fname):
+    replies = []
+    with open(fname, 'rb') as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return replies
+            length, = struct.unpack('<I', header)
+            replies.append(f.read(length))
+
+
+class OfflineSniffer(Sniffer):
+    """ A Sniffer that decodes without connecting to an X server """
+
+    def __init__(self, display):
+        self.keymap = [[ord('a')] * 8] * 256
+        self.keysymdict = {}
+        self.key_hook = lambda *args: None
+        self.mouse_button_hook = lambda *args: None
+        self.mouse_move_hook = lambda *args: None
+        self.record_display = OfflineRecordDisplay(display)
+
+
+class OfflineRecordDisplay:
+    def __init__(self, display):
+        self.display = display
+
+
+def generic_dispatch(sniffer, data, display):
+    """ The decoding loop of processevents before the struct decoder """
+    while len(data):
+        ef = rq.EventField(None)
+        ev, data = ef.parse_binary_value(data, display, None, None)
+        if ev.type in [X.KeyPress]:
+            sniffer.key_hook(*sniffer.key_event(ev.detail, ev.state, ev.sequence_number))
+        elif ev.type in [X.ButtonPress]:
+            sniffer.mouse_button_hook(ev.detail, ev.root_x, ev.root_y)
+        elif ev.type == X.MotionNotify:
+            sniffer.mouse_move_hook(ev.root_x, ev.root_y)
+
+
+def bench(name, func, replies, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for data in replies:
+            func(data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print '%-8s %8.3f s  %8.2f us/reply' % (name, best, best * 1e6 / len(replies))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--replies', metavar='FILE', help='File of recorded reply buffers, (uint32 length, data) records, to decode instead of the synthetic mix.')
+    parser.add_argument('-n', type=int, default=200000, help='Number of generated replies. Default is %(default)s')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs. Default is %(default)s')
+    args = parser.parse_args()
+
+    replies = load_replies(args.replies) if args.replies else make_replies(args.n)
+    display = OfflineDisplay()
+    sniffer = OfflineSniffer(display)
+
+    generic = bench('generic', lambda data: generic_dispatch(sniffer, data, display), replies, args.repeat)
+    fast = bench('struct', sniffer.dispatch_events, replies, args.repeat)
+    print 'speedup  %8.1fx' % (generic / fast)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -36,6 +36,14 @@ from Crypto.Cipher import Blowfish
 from selfspy.activity_store import ActivityStore
 from selfspy.password_dialog import get_password
 from selfspy import check_password
+from selfspy import models
+from selfspy import reencrypt
+from selfspy import retention
+from selfspy import shards
+from selfspy import body_index
+from selfspy import rollup
+from selfspy import migrations
+from selfspy import journal
 
 from selfspy import config as cfg
 
@@ -103,17 +111,62 @@ def parse_config():
     parser.add_argument('-r', '--no-repeat', action='store_true',
                         help='Do not store special characters as repeated characters.')
 
+    parser.add_argument('--flush-interval', type=float,
+                        help='Maximum number of seconds captured events are held in memory before they are committed to the database. Default is %s' % cfg.WRITER_FLUSH_INTERVAL,
+                        default=cfg.WRITER_FLUSH_INTERVAL)
+    parser.add_argument('--batch-size', type=int,
+                        help='Commit to the database as soon as this many events are queued, even if --flush-interval has not passed. Default is %s' % cfg.WRITER_BATCH_SIZE,
+                        default=cfg.WRITER_BATCH_SIZE)
+
+    parser.add_argument('--storage-profile', choices=['durable', 'balanced', 'fast'],
+                        help='How SQLite trades durability for write speed. "durable" syncs every commit to disk, "balanced" uses a write-ahead log and syncs less often, "fast" never syncs and may lose the last seconds of data on power loss. Default is %s' % cfg.STORAGE_PROFILE,
+                        default=cfg.STORAGE_PROFILE)
+
+    parser.add_argument('--journal', action='store_true',
+                        help='Append captured events to a journal in the data directory and fold it into the database in the background. Keeps database work off the input path and replays unfolded events after a crash.')
+    parser.add_argument('--shards', action='store_true',
+                        help='Store keystrokes, clicks and clipboard events in one database file per month, in the %s folder of the data directory. Keeps the file written to small; selfstats reads the shards of the period it is asked about. Cannot be combined with --journal.' % cfg.SHARD_DIR)
+    parser.add_argument('--body-index', action='store_true',
+                        help='Keep a search index of what you type from now on, so selfstats --body only decrypts the key sequences that can match. The index holds keyed hashes of words and three letter sequences. Once turned on it is kept up to date by every run.')
+
     parser.add_argument('--change-password', action="store_true",
                         help='Change the password used to encrypt the keys columns and exit.')
+    parser.add_argument('--upgrade-timings', action="store_true",
+                        help='Convert key timings stored by older versions of selfspy to the compact binary format and exit.')
+    parser.add_argument('--upgrade-clipboard', action="store_true",
+                        help='Move clipboard contents stored by older versions of selfspy to the deduplicated content table and exit.')
+    parser.add_argument('--migrate', action="store_true",
+                        help='Bring the database schema up to date (new indexes and columns) and exit. Can run while another selfspy is logging.')
+    parser.add_argument('--dry-run', action="store_true",
+                        help='With --migrate or --retention, only print what would be done and an estimate of how much work it is.')
+    parser.add_argument('--keep-text', type=int, metavar='DAYS',
+                        help='Retention policy: drop the text of keystrokes older than this many days, keeping their timings for activity statistics. Default is %s' % cfg.RETENTION_TEXT_DAYS,
+                        default=cfg.RETENTION_TEXT_DAYS)
+    parser.add_argument('--keep-detail', type=int, metavar='DAYS',
+                        help='Retention policy: drop keystrokes, clicks and clipboard events older than this many days, keeping only hourly activity summaries for selfstats. Default is %s' % cfg.RETENTION_DETAIL_DAYS,
+                        default=cfg.RETENTION_DETAIL_DAYS)
+    parser.add_argument('--retention', action="store_true",
+                        help='Apply the retention policies to all stored data and exit. Otherwise they are applied for a few seconds every time selfspy starts.')
+    parser.add_argument('--backfill-body-index', action="store_true",
+                        help='Add the key sequences stored before --body-index was turned on to the search index and exit.')
+    parser.add_argument('--backfill-rollups', action="store_true",
+                        help='Rebuild the per-minute and per-hour activity summaries used by selfstats from all stored keystrokes and clicks and exit. The summaries of events dropped by --keep-detail are kept.')
 
     return parser.parse_args()
 
 
-def make_encrypter(password):
+def make_key(password):
     if password == "":
+        return None
+    return hashlib.md5(password).digest()
+
+
+def make_encrypter(password):
+    key = make_key(password)
+    if key is None:
         encrypter = None
     else:
-        encrypter = Blowfish.new(hashlib.md5(password).digest())
+        encrypter = Blowfish.new(key)
     return encrypter
 
 
@@ -160,6 +213,10 @@ def main():
         except OSError:
             pass
 
+    if args['journal'] and args['shards']:
+        print ('--journal cannot be combined with --shards.')
+        sys.exit(1)
+
     if args['no_text']:
         args['password'] = ""
 
@@ -173,25 +230,122 @@ def main():
         sys.exit(1)
 
     if args['change_password']:
+        # journal segments are encrypted with the password in use when written
+        if journal.segments(os.path.join(args['data_dir'], cfg.JOURNAL_DIR)):
+            print ('The journal holds events that are not in the database yet. Start selfspy --journal once with the old password to fold them in, then change the password.')
+            sys.exit(1)
         new_password = get_password(message="New Password: ")
         new_encrypter = make_encrypter(new_password)
-        print ('Re-encrypting your keys...')
-        astore = ActivityStore(os.path.join(args['data_dir'], cfg.DBNAME),
-                               encrypter,
-                               store_text=(not args['no_text']),
-                               repeat_char=(not args['no_repeat']))
-        astore.change_password(new_encrypter)
-        # delete the old password.digest
-        os.remove(os.path.join(args['data_dir'], check_password.DIGEST_NAME))
+        print ('Re-encrypting your data...')
+        session_maker = models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))
+        shard_set = shards.ShardSet(os.path.join(args['data_dir'], cfg.DBNAME))
+        # the search index is keyed by the password
+        session = session_maker()
+        try:
+            indexed = body_index.start_id(session) is not None
+        finally:
+            session.close()
+        if indexed:
+            body_index.clear(session_maker, shard_set.readers(session_maker))
+            print ('The search index was emptied. Run selfspy --backfill-body-index afterwards to rebuild it.')
+        try:
+            reencrypt.reencrypt(session_maker, make_key(args['password']), make_key(new_password),
+                                shard_set=shard_set)
+        except ValueError as e:
+            print (str(e))
+            sys.exit(1)
+        # only now replace the old password.digest
+        digest = os.path.join(args['data_dir'], check_password.DIGEST_NAME)
+        if os.path.exists(digest):
+            os.remove(digest)
         check_password.check(args['data_dir'], new_encrypter)
+        reencrypt.finish(session_maker)
         # don't assume we want the logger to run afterwards
         print ('Exiting...')
         sys.exit(0)
 
+    if reencrypt.in_progress(models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))):
+        print ('A password change was interrupted. Run selfspy --change-password again with the same new password to finish it.')
+        sys.exit(1)
+
+    # for the upgrades and migrations that read encrypted columns
+    models.ENCRYPTER = encrypter
+    models.LOOKUP_KEY = models.make_lookup_key(make_key(args['password']))
+
+    if args['upgrade_timings']:
+        print ('Converting key timings...')
+        session_maker = models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))
+        converted = models.upgrade_timings(session_maker())
+        print ('%d rows converted. Exiting...' % converted)
+        sys.exit(0)
+
+    if args['upgrade_clipboard']:
+        print ('Deduplicating clipboard contents...')
+        session_maker = models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))
+        converted = models.upgrade_clipboard(session_maker())
+        print ('%d rows converted. Exiting...' % converted)
+        sys.exit(0)
+
+    if args['migrate']:
+        session_maker = models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))
+        left = migrations.migrate(session_maker, dry_run=args['dry_run'])
+        if not left:
+            print ('The database is up to date.')
+        print ('Exiting...')
+        sys.exit(0)
+
+    left = migrations.migrate(models.initialize(os.path.join(args['data_dir'], cfg.DBNAME)),
+                              max_seconds=cfg.MIGRATION_AUTO_SECONDS)
+    if left:
+        print ('%d database migrations are pending. Run selfspy --migrate --dry-run to see them.' % len(left))
+
+    policies = retention.policies(args['keep_text'], args['keep_detail'])
+    if args['retention'] or policies:
+        session_maker = models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))
+        shard_set = shards.ShardSet(os.path.join(args['data_dir'], cfg.DBNAME))
+        if args['retention']:
+            if not policies:
+                print ('No retention policy given, see --keep-text and --keep-detail.')
+            for policy in policies:
+                print ('%s: %d rows' % (policy.describe(), retention.estimate(session_maker, shard_set, policy)))
+            if not args['dry_run']:
+                retention.run(session_maker, shard_set, policies)
+            print ('Exiting...')
+            sys.exit(0)
+        retention.run(session_maker, shard_set, policies,
+                      max_seconds=cfg.RETENTION_AUTO_SECONDS, verbose=False)
+
+    if args['backfill_body_index']:
+        print ('Indexing typed text...')
+        session_maker = models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))
+        shard_set = shards.ShardSet(os.path.join(args['data_dir'], cfg.DBNAME))
+        indexed = body_index.backfill(session_maker, shard_set.readers(session_maker))
+        print ('%d rows indexed. Exiting...' % indexed)
+        sys.exit(0)
+
+    if args['backfill_rollups']:
+        print ('Rebuilding activity rollups...')
+        session_maker = models.initialize(os.path.join(args['data_dir'], cfg.DBNAME))
+        shard_set = shards.ShardSet(os.path.join(args['data_dir'], cfg.DBNAME))
+        session = session_maker()
+        kept = retention.horizons(session).get(retention.DropDetail.name)
+        counted = rollup.backfill(session,
+                                  sources=[maker() for maker in shard_set.readers(session_maker)],
+                                  kept=kept)
+        print ('%d rows counted. Exiting...' % counted)
+        sys.exit(0)
+
     astore = ActivityStore(os.path.join(args['data_dir'], cfg.DBNAME),
                            encrypter,
                            store_text=(not args['no_text']),
-                           repeat_char=(not args['no_repeat']))
+                           repeat_char=(not args['no_repeat']),
+                           flush_interval=args['flush_interval'],
+                           batch_size=args['batch_size'],
+                           storage_profile=args['storage_profile'],
+                           journal=args['journal'],
+                           lookup_key=models.make_lookup_key(make_key(args['password'])),
+                           sharded=args['shards'],
+                           index_body=args['body_index'])
     cfg.LOCK.acquire()
 
     try:
@@ -14,8 +14,11 @@
 
 # You should have received a copy of the GNU General Public License
 # along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+import os
 import threading
 import time
+import itertools
+import Queue
 
 import PyQt5
 import pythoncom
@@ -62,8 +65,18 @@ elif platform.system() == 'Windows':
 else:
     from selfspy import sniff_x as sniffer
 
+from selfspy import config as cfg
 from selfspy import models
-from selfspy.models import Process, Window, Geometry, Click, Keys, Clipboard
+from selfspy.lru import LRUCache
+from selfspy.mouse_path import MousePath
+from selfspy.key_buffer import KeyBuffer
+from selfspy.rollup import Rollups
+from selfspy import shards
+from selfspy import body_index
+from selfspy.journal import (Journal, Compactor, SessionSink, checkpoint, pending_records,
+                             encode_record, to_utf8, KEY, CLICK, SCREEN, CLIPBOARD)
+from selfspy.models import (Process, Window, Geometry, Click, Keys, Clipboard, KeySymbol,
+                            ClipboardContent, ClipboardTypes, JournalSegment)
 
 from PyQt5 import QtWidgets
 
@@ -81,10 +94,17 @@ SKIP_MODIFIERS = {"", "Shift_L", "Super_L", "Alt_L", "Super_R", "Shift_R",
 SCROLL_BUTTONS = {4, 5, 6, 7}
 SCROLL_COOLOFF = 10  # seconds
 
-app = QtWidgets.QApplication(["", ""])
-clipboard = app.clipboard()
+_qt_app = None
 
-mimeData = clipboard.mimeData()
+
+def qt_clipboard():
+    """ The Qt clipboard. The QApplication is only created on first use, so
+        a logger that follows the clipboard through the sniffer never
+        starts Qt. """
+    global _qt_app
+    if _qt_app is None:
+        _qt_app = QtWidgets.QApplication(["", ""])
+    return _qt_app.clipboard()
 
 
 class Test(Text):
@@ -126,7 +146,7 @@ class ClipboardWatcher(threading.Thread):
     def run(self):
         recent_value = ""
         while not self._stopping:
-            tmp_value = clipboard.text()
+            tmp_value = qt_clipboard().text()
             if tmp_value != recent_value:
                 recent_value = tmp_value
                 self._callback()
@@ -136,39 +156,324 @@ class ClipboardWatcher(threading.Thread):
         self._stopping = True
 
 
-class Display:
-    def __init__(self):
-        self.proc_id = None
-        self.win_id = None
-        self.geo_id = None
+class WriterError(Exception):
+    """ Work was submitted to the writer thread after it stopped """
+
+
+class DbWriter(threading.Thread):
+    """ Owns the database sessions and group-commits everything queued to it.
+        Sniffer and clipboard callbacks only enqueue work, so commits never
+        happen on the input thread. A batch is committed when batch_size
+        writes are pending or flush_interval seconds have passed. Lookups,
+        which find or insert dimension rows, run in a session of their own
+        that is committed before their results are used, so the ids the
+        logger caches are never rolled back with a failed batch. Screen
+        changes are looked up with submit, which does not wait, and the rows
+        added for the new screen get its ids here once the lookup has run.
+        Other dimension rows a queued row refers to are looked up here too,
+        see add. """
+
+    ADD, CALL, FLUSH, STOP = range(4)
+
+    def __init__(self, session_maker,
+                 flush_interval=cfg.WRITER_FLUSH_INTERVAL,
+                 batch_size=cfg.WRITER_BATCH_SIZE,
+                 rollups=None, shards=None):
+        super(DbWriter, self).__init__()
+        self.daemon = True
+        self.session_maker = session_maker
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.rollups = rollups
+        self.shards = shards
+        self.month = None
+
+        self.queue = Queue.Queue()
+        # the rows added since the last commit, to add again when it is retried
+        self.batch = []
+        self.last_commit = time.time()
+
+        self.commit_retries = 0
+        self.commit_wait = 0.0
+
+    def add(self, obj, screen=None, stored=None, lookup=None):
+        """ Queues a new row for insertion. If screen is given, the row gets
+            its ids on the writer thread, see Display.fill. lookup is a pair
+            (func, done): func(session) is run and committed like a submitted
+            function and done(obj, value) is given its result, so done may
+            cache the ids it fills in. If func fails, obj is stored as it was
+            queued.
+            stored(obj) is run on the writer thread once the row is added to
+            the batch. """
+        self.queue.put((self.ADD, (obj, screen, stored, lookup)))
+
+    def submit(self, done, func, *args):
+        """ Queues func(session, *args) to run in the lookup session, which
+            is committed before done(value, error) is run on the writer
+            thread with the result, or with the exception if func failed.
+            Raises WriterError if the writer has stopped. """
+        def job(session):
+            try:
+                value = self.run_committed(session, func, *args)
+            except Exception as e:
+                done(None, e)
+            else:
+                done(value, None)
+
+        if not self.is_alive():
+            raise WriterError('the database writer has stopped')
+        self.queue.put((self.CALL, job))
+
+    def flush(self):
+        """ Blocks until everything queued so far is committed """
+        done = threading.Event()
+        self.queue.put((self.FLUSH, done))
+        done.wait()
+
+    def stop(self):
+        """ Commits what is left, ends the thread and reports the commits
+            that had to wait for a locked database """
+        self.queue.put((self.STOP, None))
+        self.join()
+        if self.commit_retries:
+            print('Retried %d commits on a locked database, waiting %.1f s in total'
+                  % (self.commit_retries, self.commit_wait))
+
+    def run(self):
+        self.session = self.session_maker()
+        lookup_session = self.session_maker()
+        while True:
+            if self.batch:
+                timeout = max(0, self.last_commit + self.flush_interval - time.time())
+            else:
+                timeout = None
+            try:
+                kind, payload = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                self.commit()
+                continue
+
+            if kind == self.ADD:
+                obj, screen, stored, lookup = payload
+                if screen is not None and not screen.fill(obj):
+                    print('Dropping a %s: its window is not stored' % type(obj).__name__)
+                    continue
+                if lookup is not None:
+                    func, done = lookup
+                    try:
+                        value = self.run_committed(lookup_session, func)
+                    except Exception as e:
+                        print('Storing a %s without its lookups: %s' % (type(obj).__name__, e))
+                    else:
+                        done(obj, value)
+                if self.shards is not None:
+                    self.route(obj)
+                self.session.add(obj)
+                self.batch.append(obj)
+                if stored is not None:
+                    stored(obj)
+            elif kind == self.CALL:
+                payload(lookup_session)
+            elif kind == self.FLUSH:
+                self.commit()
+                payload.set()
+            elif kind == self.STOP:
+                self.commit()
+                break
+
+            if len(self.batch) >= self.batch_size:
+                self.commit()
+
+    def route(self, row):
+        """ Moves to the shard of the month of row, committing what was
+            queued for the previous one, and gives row an id that is unique
+            over all shards """
+        month = shards.month_of(row.created_at)
+        if month != self.month:
+            self.commit()
+            self.session.close()
+            if self.month is not None:
+                # only the current month is written, and retention may drop older shards
+                self.shards.close(self.month)
+            self.session = self.shards.session_maker(month)()
+            self.month = month
+        row.id = self.shards.next_id(row)
+
+    def back_off(self, wait):
+        """ Sleeps wait seconds before a retry and returns the next wait """
+        self.commit_retries += 1
+        self.commit_wait += wait
+        time.sleep(wait)
+        return min(wait * 2, cfg.COMMIT_BACKOFF_MAX)
+
+    def run_committed(self, session, func, *args):
+        """ Returns func(session, *args) once session has been committed,
+            running func again after a locked commit, like commit """
+        wait = cfg.COMMIT_BACKOFF_MIN
+        for attempt in range(cfg.COMMIT_RETRIES + 1):
+            try:
+                value = func(session, *args)
+                session.commit()
+                return value
+            except sqlalchemy.exc.OperationalError:
+                session.rollback()
+                if attempt == cfg.COMMIT_RETRIES:
+                    raise
+                wait = self.back_off(wait)
+            except Exception:
+                session.rollback()
+                raise
+
+    def commit(self):
+        """ Commits the current batch. A locked database is retried with bounded
+            exponential backoff; every retry and the time spent waiting are
+            counted in commit_retries and commit_wait. Pending rollup counts
+            are written in the same transaction. """
+        self.last_commit = time.time()
+        if not self.batch:
+            return
 
+        batch = self.batch
+        self.batch = []
+        wait = cfg.COMMIT_BACKOFF_MIN
+        for attempt in range(cfg.COMMIT_RETRIES + 1):
+            rollups = {}
+            try:
+                if self.rollups is not None:
+                    rollups = self.rollups.flush(self.session)
+                self.session.commit()
+                break
+            except sqlalchemy.exc.OperationalError as e:
+                self.session.rollback()
+                if self.rollups is not None:
+                    self.rollups.restore(rollups)
+                if attempt == cfg.COMMIT_RETRIES:
+                    print('Giving up commit of %d rows: %s' % (len(batch), e))
+                    break
+                wait = self.back_off(wait)
+                self.session.add_all(batch)
+            except Exception as e:
+                self.session.rollback()
+                print('Dropping %d rows after commit error: %s' % (len(batch), e))
+                break
 
-class KeyPress:
-    def __init__(self, key, time, is_repeat):
-        self.key = key
-        self.time = time
-        self.is_repeat = is_repeat
+
+class Display:
+    """ The screen that events are stored for. Ids that were not cached are
+        None until the writer has looked them up, which sets ready, or
+        failed if that went wrong. """
+
+    def __init__(self, screen=None, geo_key=None, proc_id=None, win_id=None, geo_id=None):
+        self.screen = screen  # (process name, window title)
+        self.geo_key = geo_key
+        self.proc_id = proc_id
+        self.win_id = win_id
+        self.geo_id = geo_id
+        self.ready = None not in (proc_id, win_id, geo_id)
+        self.failed = False
+
+    def resolved(self, ids, error):
+        """ Takes the result of ActivityStore.lookup_screen. Runs on the
+            writer thread. """
+        if error is not None:
+            print('Could not store the window %r: %s' % (self.screen[1], error))
+            self.failed = True
+        else:
+            self.proc_id, self.win_id, self.geo_id = ids
+            self.ready = True
+
+    def fill(self, row):
+        """ Sets the ids of row, or returns False if they are not known """
+        if not self.ready:
+            return False
+        row.process_id = self.proc_id
+        row.window_id = self.win_id
+        row.geometry_id = self.geo_id
+        return True
 
 
 class ActivityStore:
-    def __init__(self, db_name, encrypter=None, store_text=True, repeat_char=True):
-        self.session_maker = models.initialize(db_name)
+    def __init__(self, db_name, encrypter=None, store_text=True, repeat_char=True,
+                 flush_interval=cfg.WRITER_FLUSH_INTERVAL,
+                 batch_size=cfg.WRITER_BATCH_SIZE,
+                 storage_profile=cfg.STORAGE_PROFILE,
+                 journal=False, lookup_key=None, sharded=False, index_body=False):
+        self.session_maker = models.initialize(db_name, storage_profile)
+        self.rollups = Rollups()
+        shard_set = shards.ShardSet(db_name, storage_profile) if sharded else None
+        self.writer = DbWriter(self.session_maker, flush_interval, batch_size,
+                               self.rollups, shard_set)
+
+        # In journal mode the sniffer hooks only append to the journal and the
+        # compactor thread replays it through the same store methods, with
+        # replay_time set to the time of each recorded event.
+        self.journal = None
+        self.compactor = None
+        if journal:
+            session = self.session_maker()
+            self.journal = Journal(os.path.join(os.path.dirname(db_name), cfg.JOURNAL_DIR),
+                                   checkpoint(session))
+            session.close()
+        self.replay_time = None
+        # the records of the queued keys and of the screen they belong to,
+        # see fold_journal; resumed is set once the ones kept with the
+        # checkpoint by the previous run are replayed
+        self.journal_keys = []
+        self.journal_screen = None
+        self.journal_resumed = False
 
         models.ENCRYPTER = encrypter
+        models.LOOKUP_KEY = lookup_key
+
+        # once enabled, the search index is kept up to date by every run
+        if index_body:
+            body_index.enable(self.session_maker,
+                              shards.ShardSet(db_name, storage_profile).readers(self.session_maker))
+        session = self.session_maker()
+        self.index_body = body_index.start_id(session) is not None
+        session.close()
+
+        # the activity at the end of the previous run is already rolled up
+        session = self.session_maker()
+        since = self.rollups.seed_start(session)
+        session.close()
+        if since is not None:
+            sources = [maker() for maker in
+                       shards.ShardSet(db_name, storage_profile).readers(self.session_maker, since)]
+            self.rollups.seed(since, sources)
+            for source in sources:
+                source.close()
 
         self.store_text = store_text
         self.repeat_char = repeat_char
         self.curtext = u""
 
-        self.key_presses = []
-        self.mouse_path = []
+        self.key_presses = KeyBuffer(collapse=repeat_char)
+        self.mouse_path = MousePath()
 
         self.current_window = Display()
+        # screens whose ids the writer is still looking up, see cache_screens
+        self.pending_screens = []
+
+        # (name) -> process id, (x, y, w, h) -> geometry id,
+        # (process id, title) -> window id
+        self.process_cache = LRUCache(cfg.DIMENSION_CACHE_SIZE)
+        self.geometry_cache = LRUCache(cfg.DIMENSION_CACHE_SIZE)
+        self.window_cache = LRUCache(cfg.DIMENSION_CACHE_SIZE)
+
+        # key string -> KeySymbol id, the vocabulary is small enough to keep.
+        # Only used on the writer thread.
+        self.key_symbols = {}
+
+        # content digest -> ClipboardContent id, MIME types -> ClipboardTypes id.
+        # Only used on the writer thread.
+        self.clipboard_contents = LRUCache(cfg.DIMENSION_CACHE_SIZE)
+        self.clipboard_types = {}
 
         self.last_scroll = {button: 0 for button in SCROLL_BUTTONS}
 
-        self.last_key_time = time.time()
-        self.last_commit = time.time()
+        # set from the first replayed event in journal mode
+        self.last_key_time = None if journal else time.time()
 
         self.started = NOW()
         self.last_screen_change = None
@@ -181,11 +486,7 @@ class ActivityStore:
         self.was_ctrl_v = False
         self.was_ctrl_x = False
 
-
-        # Start QT App in new thread, for receiving clipboard changes
-        t = threading.Thread(target=self.qtApp)
-        t.daemon = True
-        t.start()
+        self.native_clipboard = False
 
         # message_map = {
         #     win32con.WM_RENDERFORMAT: self.testHook
@@ -258,27 +559,28 @@ class ActivityStore:
     def testPaste(self):
         print ("paste")
 
-    def trycommit(self):
-
-        self.last_commit = time.time()
-        for _ in range(1000):
-            try:
-                self.session.commit()
-                break
-            except sqlalchemy.exc.OperationalError:
-                print("exception")
-                time.sleep(1)
-            except:
-                self.session.rollback()
-
     def run(self):
-        self.session = self.session_maker()
+        if self.journal is not None:
+            self.compactor = Compactor(self.journal, self.session_maker,
+                                       self.fold_journal, self.discard_journal_state)
+            self.compactor.start()
+        else:
+            self.writer.start()
         self.sniffer = sniffer.Sniffer()
         self.sniffer.screen_hook = self.got_screen_change
         self.sniffer.key_hook = self.got_key
         self.sniffer.mouse_button_hook = self.got_mouse_click
         self.sniffer.mouse_move_hook = self.got_mouse_move
 
+        # Follow the clipboard through the sniffer where it can, otherwise
+        # start a Qt event loop for it
+        self.native_clipboard = (hasattr(self.sniffer, 'watch_selections') and
+                                 self.sniffer.watch_selections(self.got_selection))
+        if not self.native_clipboard:
+            t = threading.Thread(target=self.qtApp)
+            t.daemon = True
+            t.start()
+
         # self.sniffer.clipboard_hook = self.got_changed_clipboard
 
         # watcher = ClipboardWatcher(self.got_changed_clipboard, 1.)
@@ -366,7 +668,7 @@ class ActivityStore:
         This will return a dictionary with the ID's and descriptions for
         each mime type.
         """
-        mime_formats = mimeData.formats()
+        mime_formats = qt_clipboard().mimeData().formats()
         format_dictionary = dict()
         for format in mime_formats:
             id = win32clipboard.RegisterClipboardFormat(str(format))
@@ -376,6 +678,7 @@ class ActivityStore:
 
     def get_clipboard_formats(self):
         format_dictionary = dict()
+        mimeData = qt_clipboard().mimeData()
         if mimeData.hasText():
             id = win32con.CF_TEXT
             data = str(mimeData.text())
@@ -445,74 +748,112 @@ class ActivityStore:
         # skip the event if same arguments as last time are passed
 
         args = [process_name, window_name, win_x, win_y, win_width, win_height]
-        if self.last_screen_change == args:
+        if self.last_screen_change == args and not self.current_window.failed:
             return
 
         self.last_screen_change = args
 
-        cur_process = self.session.query(
-            Process
-        ).filter_by(
-            name=process_name
-        ).scalar()
-        if not cur_process:
-            cur_process = Process(process_name)
-            self.session.add(cur_process)
-
-        cur_geometry = self.session.query(
-            Geometry
-        ).filter_by(
-            xpos=win_x,
-            ypos=win_y,
-            width=win_width,
-            height=win_height
-        ).scalar()
-        if not cur_geometry:
-            cur_geometry = Geometry(win_x, win_y, win_width, win_height)
-            self.session.add(cur_geometry)
-
-        cur_window = self.session.query(Window).filter_by(title=window_name,
-                                                          process_id=cur_process.id).scalar()
-        if not cur_window:
-            cur_window = Window(window_name, cur_process.id)
-            self.session.add(cur_window)
-
-        if not (self.current_window.proc_id == cur_process.id
-                and self.current_window.win_id == cur_window.id):
-            self.trycommit()
-            self.store_keys()  # happens before as these keypresses belong to the previous window
-            self.current_window.proc_id = cur_process.id
-            self.current_window.win_id = cur_window.id
-            self.current_window.geo_id = cur_geometry.id
-
-    def filter_many(self):
-        specials_in_row = 0
-        lastpress = None
-        newpresses = []
-        for press in self.key_presses:
-            key = press.key
-            if specials_in_row and key != lastpress.key:
-                if specials_in_row > 1:
-                    lastpress.key = '%s]x%d>' % (lastpress.key[:-2], specials_in_row)
-
-                newpresses.append(lastpress)
-                specials_in_row = 0
-
-            if len(key) > 1:
-                specials_in_row += 1
-                lastpress = press
-            else:
-                newpresses.append(press)
+        if self.journal is not None:
+            self.journal.append(SCREEN, time.time(), (win_x, win_y, win_width, win_height),
+                                (to_utf8(process_name), to_utf8(window_name)))
+            return
 
-        if specials_in_row:
-            if specials_in_row > 1:
-                lastpress.key = '%s]x%d>' % (lastpress.key[:-2], specials_in_row)
-            newpresses.append(lastpress)
+        self.change_screen(*args)
 
-        self.key_presses = newpresses
+    def change_screen(self, process_name, window_name, win_x, win_y, win_width, win_height):
+        """ Switches to the new screen if the process or window changed,
+            storing the queued keys first. Ids missing from the caches are
+            looked up by the writer without waiting for it. """
+        screen = (process_name, window_name)
+        if self.current_window.screen == screen and not self.current_window.failed:
+            return
+
+        self.cache_screens()
+        geo_key = (win_x, win_y, win_width, win_height)
+        proc_id = self.process_cache.get(process_name)
+        geo_id = self.geometry_cache.get(geo_key)
+        win_id = None
+        if proc_id is not None:
+            win_id = self.window_cache.get((proc_id, window_name))
+
+        display = Display(screen, geo_key, proc_id, win_id, geo_id)
+        if not display.ready:
+            try:
+                self.writer.submit(display.resolved, self.lookup_screen,
+                                   process_name, window_name, geo_key,
+                                   proc_id, win_id, geo_id)
+            except WriterError as e:
+                # stay in the previous window and look the screen up again next time
+                print('Could not store the window %r: %s' % (window_name, e))
+                self.last_screen_change = None
+                return
+            self.pending_screens.append(display)
+
+        self.store_keys()  # happens before as these keypresses belong to the previous window
+        self.current_window = display
+
+    def cache_screens(self):
+        """ Caches the ids that the writer has looked up since the last
+            screen change """
+        pending = []
+        for display in self.pending_screens:
+            if display.ready:
+                process_name, window_name = display.screen
+                self.process_cache[process_name] = display.proc_id
+                self.geometry_cache[display.geo_key] = display.geo_id
+                self.window_cache[(display.proc_id, window_name)] = display.win_id
+            elif not display.failed:
+                pending.append(display)
+        self.pending_screens = pending
+
+    def lookup_screen(self, session, process_name, window_name, geo_key, proc_id, win_id, geo_id):
+        """ Resolves the ids that were not found in the caches, reading them from
+            the database or inserting new rows. Runs on the writer thread. """
+        if proc_id is None:
+            proc_id = session.query(
+                Process.id
+            ).filter_by(
+                name=process_name
+            ).scalar()
+            if proc_id is None:
+                cur_process = Process(process_name)
+                session.add(cur_process)
+                session.flush()
+                proc_id = cur_process.id
+
+        if geo_id is None:
+            win_x, win_y, win_width, win_height = geo_key
+            geo_id = session.query(
+                Geometry.id
+            ).filter_by(
+                xpos=win_x,
+                ypos=win_y,
+                width=win_width,
+                height=win_height
+            ).scalar()
+            if geo_id is None:
+                cur_geometry = Geometry(win_x, win_y, win_width, win_height)
+                session.add(cur_geometry)
+                session.flush()
+                geo_id = cur_geometry.id
+
+        if win_id is None:
+            win_id = session.query(Window.id).filter_by(
+                title_hash=models.title_hash(window_name),
+                process_id=proc_id
+            ).order_by(Window.id).limit(1).scalar()
+            if win_id is None:
+                cur_window = Window(window_name, proc_id)
+                session.add(cur_window)
+                session.flush()
+                win_id = cur_window.id
+
+        return proc_id, win_id, geo_id
 
     def store_clipboard(self):
 
+        clipboard = qt_clipboard()
+        mimeData = clipboard.mimeData()
         clipboard_content = clipboard.text()
         types = str(mimeData.formats())
 
@@ -527,57 +868,90 @@ class ActivityStore:
         image_height = image.height()
         image_width = image.width()
 
-        # print("WAS CTRL+C", self.was_ctrl_c)
-        # print("WAS CTRL+V", self.was_ctrl_v)
-        # print("WAS CTRL+X", self.was_ctrl_x)
-
-
-        # print (clipboard_content)
-
-        keys = [press.key for press in self.key_presses]
-        timings = [press.time for press in self.key_presses]
-        add = lambda count, press: count + (0 if press.is_repeat else 1)
-        nrkeys = reduce(add, self.key_presses, 0)
-
-        lastTwoKeys = []
-
-        hot_key_used = False
-
-        for key in keys[-2:]:
-            print ("KEY", key)
-            print(str(key))
-
-            lastTwoKeys.append(key)
-
-        print ("LAST TWO KEYS", lastTwoKeys)
-
-        hot_key_used = False
-
-        if ("Ctrl" in str(lastTwoKeys[0:])):
-            hot_key_used = True
-
-        # Prepare for storing clipboard data in SQLite database
-        self.session.add(
-            Clipboard(clipboard_content.encode('utf8'), types, hasHtml, hasImage, hasText, hasUrls, image_height,
-                      image_width, self.was_ctrl_c, self.was_ctrl_v, self.was_ctrl_x,
-                      self.current_window.proc_id,
-                      self.current_window.win_id,
-                      self.current_window.geo_id))
-
-        self.trycommit()
-
-        self.started = NOW()
+        content = clipboard_content.encode('utf8')
+        flags = (hasHtml, hasImage, hasText, hasUrls,
+                 self.was_ctrl_c, self.was_ctrl_v, self.was_ctrl_x,
+                 image_height, image_width)
+        self.record_clipboard(content, types, flags)
+
+    def got_selection(self, selection, content, targets, requested):
+        """ Receives X selection contents from the sniffer's watcher thread.
+            requested is True for the content fetched on a Ctrl+V. """
+        types = str(targets)
+        if selection != 'CLIPBOARD':
+            types = '%s %s' % (selection, types)
+        flags = ('text/html' in targets,
+                 any(target.startswith('image/') for target in targets),
+                 content is not None,
+                 'text/uri-list' in targets,
+                 self.was_ctrl_c, requested, self.was_ctrl_x,
+                 0, 0)
+        self.record_clipboard(content or '', types, flags)
+
+    def record_clipboard(self, content, types, flags):
+        if self.journal is not None:
+            self.journal.append(CLIPBOARD, time.time(), flags, (content, types))
+        else:
+            self.add_clipboard(content, types, *flags)
+
+    def add_clipboard(self, content, types, has_html, has_image, has_text, has_url,
+                      was_ctrl_c, was_ctrl_v, was_ctrl_x, image_height, image_width):
+        """ Stores a clipboard change in the current window. The content
+            and types ids are filled in on the writer thread, see
+            fill_clipboard; until then the row holds them inline, as rows of
+            older versions do, and keeps them if the lookup fails. """
+        digest = models.keyed_hash(content)
+        row = Clipboard(None, None, has_html, has_image, has_text, has_url,
+                        image_height, image_width, was_ctrl_c, was_ctrl_v, was_ctrl_x,
+                        self.current_window.proc_id,
+                        self.current_window.win_id,
+                        self.current_window.geo_id)
+        row.encrypt_text(content)
+        row.types = types
+        row.created_at = self.event_datetime()
+        self.writer.add(row, self.current_window, lookup=(
+            lambda session: self.lookup_clipboard(session, content, digest, types),
+            lambda row, ids: self.fill_clipboard(row, digest, types, ids)))
+
+        self.started = self.event_datetime()
+
+    def lookup_clipboard(self, session, content, digest, types):
+        """ Returns the ClipboardContent and ClipboardTypes ids of a clipboard
+            change, inserting them if they are neither cached nor in the
+            database. Runs on the writer thread. """
+        content_id = self.clipboard_contents.get(digest)
+        types_id = self.clipboard_types.get(types)
+        if content_id is None:
+            content_id = session.query(ClipboardContent.id).filter_by(digest=digest).scalar()
+            if content_id is None:
+                stored = ClipboardContent(content)
+                session.add(stored)
+                session.flush()
+                content_id = stored.id
+        if types_id is None:
+            types_id = session.query(ClipboardTypes.id).filter_by(types=types).scalar()
+            if types_id is None:
+                type_set = ClipboardTypes(types)
+                session.add(type_set)
+                session.flush()
+                types_id = type_set.id
+        return content_id, types_id
+
+    def fill_clipboard(self, row, digest, types, ids):
+        """ Caches the committed ids of a clipboard change and points row at
+            them instead of its inline content. Runs on the writer thread. """
+        content_id, types_id = ids
+        self.clipboard_contents[digest] = content_id
+        self.clipboard_types[types] = types_id
+        row.content_id = content_id
+        row.types_id = types_id
+        row.clipboard_content = ''
+        row.types = ''
 
     def store_keys(self):
         """ Stores the current queued key-presses """
-        if self.repeat_char:
-            self.filter_many()
-
         if self.key_presses:
-            keys = [press.key for press in self.key_presses]
-            timings = [press.time for press in self.key_presses]
-            add = lambda count, press: count + (0 if press.is_repeat else 1)
-            nrkeys = reduce(add, self.key_presses, 0)
+            keys, timings, nrkeys = self.key_presses.flush()
 
             curtext = u""
             if not self.store_text:
@@ -585,19 +959,53 @@ class ActivityStore:
             else:
                 curtext = ''.join(keys)
 
-            self.session.add(Keys(curtext.encode('utf8'),
-                                  keys,
-                                  timings,
-                                  nrkeys,
-                                  self.started,
-                                  self.current_window.proc_id,
-                                  self.current_window.win_id,
-                                  self.current_window.geo_id))
-
-            self.trycommit()
-            self.started = NOW()
-            self.key_presses = []
-            self.last_key_time = time.time()
+            # the key codes are filled in on the writer thread, see fill_key_codes
+            row = Keys(curtext.encode('utf8'),
+                       [],
+                       timings,
+                       nrkeys,
+                       self.started,
+                       self.current_window.proc_id,
+                       self.current_window.win_id,
+                       self.current_window.geo_id)
+            row.created_at = self.event_datetime()
+            if self.index_body and curtext:
+                body_index.add_tokens(row, curtext.encode('utf8'))
+            lookup = None
+            if keys:
+                lookup = (lambda session: self.lookup_key_symbols(session, keys),
+                          lambda row, codes: self.fill_key_codes(row, keys, codes))
+            # counted once the writer has filled in the ids of the window
+            self.writer.add(row, self.current_window, lambda row: self.rollups.add_keys(
+                row.process_id, row.window_id, row.created_at, timings), lookup)
+
+            self.started = self.event_datetime()
+            self.last_key_time = self.current_time()
+
+    def fill_key_codes(self, row, keys, codes):
+        """ Caches the KeySymbol ids in codes, which are committed, and
+            stores the ids of keys in row. Runs on the writer thread; if the
+            vocabulary cannot be written the row keeps no key codes, while
+            the text and timings of the keys are still stored. """
+        self.key_symbols.update(codes)
+        row.encrypt_keys([self.key_symbols[key] for key in keys])
+
+    def lookup_key_symbols(self, session, symbols):
+        """ Returns key string -> KeySymbol id for the symbols that are not
+            in key_symbols, inserting the ones not in the database. Runs on
+            the writer thread. """
+        codes = {}
+        for symbol in set(symbols) - set(self.key_symbols):
+            code = session.query(KeySymbol.id).filter_by(
+                symbol=models.key_symbol_value(symbol)
+            ).scalar()
+            if code is None:
+                key_symbol = KeySymbol(symbol)
+                session.add(key_symbol)
+                session.flush()
+                code = key_symbol.id
+            codes[symbol] = code
+        return codes
 
     def got_key(self, keycode, state, string, is_repeat):
         """ Receives key-presses and queues them for storage.
@@ -621,7 +1029,10 @@ class ActivityStore:
             if (self.lastKeyWasCtrl):
                 # print ("STRG-V")
                 self.was_ctrl_v = True
-                self.store_clipboard()
+                if self.native_clipboard:
+                    self.sniffer.request_selection()
+                else:
+                    self.store_clipboard()
 
         if (keycode == '3' or string == 'c'):
             print "was c"
@@ -653,20 +1064,39 @@ class ActivityStore:
 
         # print ("STRING AFTER", string)
 
-        self.key_presses.append(KeyPress(string, now - self.last_key_time, is_repeat))
+        if self.journal is not None:
+            self.journal.append(KEY, now, (is_repeat,), (to_utf8(string),))
+        else:
+            self.queue_key(string, is_repeat, now)
+
+    def queue_key(self, string, is_repeat, now):
+        """ Queues an already formatted key-press until the window changes """
+        self.key_presses.append(string, now - self.last_key_time, is_repeat)
         self.last_key_time = now
 
     def store_click(self, button, x, y):
         """ Stores incoming mouse-clicks """
-        self.session.add(Click(button,
-                               True,
-                               x, y,
-                               len(self.mouse_path),
-                               self.current_window.proc_id,
-                               self.current_window.win_id,
-                               self.current_window.geo_id))
-        self.mouse_path = []
-        self.trycommit()
+        self.add_click(button, x, y,
+                       len(self.mouse_path),
+                       self.mouse_path.encode(),
+                       self.mouse_path.distance,
+                       self.mouse_path.duration())
+        self.mouse_path.clear()
+
+    def add_click(self, button, x, y, nrmoves, path, distance, duration):
+        row = Click(button,
+                    True,
+                    x, y,
+                    nrmoves,
+                    self.current_window.proc_id,
+                    self.current_window.win_id,
+                    self.current_window.geo_id,
+                    path,
+                    distance,
+                    duration)
+        row.created_at = self.event_datetime()
+        self.writer.add(row, self.current_window, lambda row: self.rollups.add_click(
+            row.process_id, row.window_id, row.created_at, button, nrmoves))
 
     def got_mouse_click(self, button, x, y):
         """ Receives mouse clicks and sends them for storage.
@@ -678,24 +1108,112 @@ class ActivityStore:
                 return
             self.last_scroll[button] = time.time()
 
+        if self.journal is not None:
+            self.journal.append(CLICK, time.time(),
+                                (button, x, y, len(self.mouse_path),
+                                 self.mouse_path.distance, self.mouse_path.duration()),
+                                (self.mouse_path.encode() or '',))
+            self.mouse_path.clear()
+            return
+
         self.store_click(button, x, y)
 
     def got_mouse_move(self, x, y):
         """ Queues mouse movements.
             x,y are the new coorinates on moving the mouse"""
-        self.mouse_path.append([x, y])
+        self.mouse_path.append(x, y, time.time())
 
     def close(self):
-        """ stops the sniffer and stores the latest keys. To be used on shutdown of program"""
+        """ stops the sniffer, stores the latest keys and flushes the writer. To be used on shutdown of program"""
         self.sniffer.cancel()
-        self.store_keys()
-
-    def change_password(self, new_encrypter):
-        self.session = self.session_maker()
-        keys = self.session.query(Keys).all()
-        for k in keys:
-            dtext = k.decrypt_text()
-            dkeys = k.decrypt_keys()
-            k.encrypt_text(dtext, new_encrypter)
-            k.encrypt_keys(dkeys, new_encrypter)
-        self.session.commit()
+        if self.journal is not None:
+            self.compactor.stop()
+            self.store_journal_keys()
+        else:
+            self.store_keys()
+            self.writer.stop()
+
+    def current_time(self):
+        """ The time of the event being stored, which is the recorded time
+            while folding the journal """
+        if self.replay_time is not None:
+            return self.replay_time
+        return time.time()
+
+    def event_datetime(self):
+        return datetime.fromtimestamp(self.current_time())
+
+    def fold_journal(self, session, records):
+        """ Replays the records of one journal segment into session. As in
+            direct mode, keys stay queued until the window changes. Returns
+            the records of the keys still queued and of their screen, which
+            the compactor keeps with the checkpoint so that a restart replays
+            them before the next segment. Runs on the compactor thread. """
+        self.writer = SessionSink(session)
+        if not self.journal_resumed:
+            records = itertools.chain(pending_records(session), records)
+            self.journal_resumed = True
+        try:
+            for record in records:
+                kind, when, fields, strings = record
+                if kind != SCREEN and self.current_window.screen is None:
+                    continue  # nothing to attribute events to before the first screen change
+                self.replay_time = when
+                if self.last_key_time is None:
+                    # the first event of this run, the time it started from
+                    self.last_key_time = when
+                    self.started = self.event_datetime()
+                if kind == KEY:
+                    self.queue_key(strings[0].decode('utf8'), fields[0], when)
+                    self.journal_keys.append(record)
+                elif kind == CLICK:
+                    button, x, y, nrmoves, distance, duration = fields
+                    self.add_click(button, x, y, nrmoves, strings[0] or None, distance, duration)
+                elif kind == SCREEN:
+                    process_name, window_name = [v.decode('utf8', 'replace') for v in strings]
+                    self.change_screen(process_name, window_name, *fields)
+                    self.journal_screen = record
+                elif kind == CLIPBOARD:
+                    self.add_clipboard(strings[0], strings[1], *fields)
+                if not self.key_presses:
+                    self.journal_keys = []
+            self.rollups.flush(session)
+        finally:
+            self.replay_time = None
+        if not self.journal_keys:
+            return None
+        # the whole of it is encrypted with the checkpoint
+        return ''.join(encode_record(*record, sealed=False)
+                       for record in [self.journal_screen] + self.journal_keys)
+
+    def store_journal_keys(self):
+        """ Stores the keys still queued after the last segment, on shutdown """
+        session = self.session_maker()
+        try:
+            self.fold_journal(session, [])
+            self.store_keys()
+            self.rollups.flush(session)
+            session.query(JournalSegment).update({'pending': None})
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print('Could not store the queued keys, they are stored on the next start: %s' % e)
+        finally:
+            session.close()
+
+    def discard_journal_state(self):
+        """ Forgets everything built from a journal segment that failed to fold """
+        self.process_cache.clear()
+        self.geometry_cache.clear()
+        self.window_cache.clear()
+        self.key_symbols.clear()
+        self.clipboard_contents.clear()
+        self.clipboard_types.clear()
+        self.rollups.clear()
+        self.current_window = Display()
+        self.pending_screens = []
+        self.key_presses.clear()
+        self.journal_keys = []
+        self.journal_screen = None
+        self.journal_resumed = False
+        self.last_key_time = None
@@ -0,0 +1,209 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Opt-in search index of typed text. Every Keys row gets a BodyToken row per
+# distinct lower case word and trigram of its text, stored as a truncated
+# keyed hash so the index reveals no more than which rows share a token.
+# selfstats --body works out the words and trigrams any match of its
+# regular expression must contain, and only decrypts the rows that have all
+# of them. Rows older than BodyIndex.start_id are searched by decrypting
+# them all, as before.
+
+import re
+import sre_parse
+import sre_constants
+
+from sqlalchemy import func, select, or_
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy.models import Keys, BodyToken, BodyIndex
+
+# words as \w and \b see them in the UTF-8 text that selfstats --body
+# searches: runs of ASCII letters, digits and underscores
+WORD = re.compile(r'[0-9A-Za-z_]+')
+
+# more tokens make a query more selective but each costs an index lookup
+MAX_QUERY_TOKENS = 32
+
+
+def blind(token):
+    return models.keyed_hash('body ' + token.encode('utf8'))[:cfg.BODY_TOKEN_BYTES]
+
+
+def words_and_trigrams(text):
+    found = set(u'w' + word.lower() for word in WORD.findall(text))
+    text = text.lower()
+    found.update(u't' + text[i:i + 3] for i in xrange(len(text) - 2))
+    return found
+
+
+def text_tokens(row, text):
+    """ The blind tokens of the plain text of a Keys row, covering both the
+        text as typed and as shown by selfstats --human-readable """
+    text = text.rstrip('\0')
+    if not text:
+        return set()
+    plain = words_and_trigrams(text.decode('utf8', 'replace'))
+    plain.update(words_and_trigrams(row.to_humanreadable(text).decode('utf8', 'replace')))
+    return set(blind(token) for token in plain)
+
+
+def add_tokens(row, text):
+    """ Attaches the BodyToken rows of text to a new Keys row """
+    row.tokens = [BodyToken(token) for token in text_tokens(row, text)]
+
+
+def literal_runs(parsed, runs, run, boundary):
+    """ Appends to runs the (text, word) pieces of literal text that every
+        match of the parsed pattern contains, where word means the piece is
+        between \\b's. Returns the run that is still open. """
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            if run is None:
+                run = [[], boundary]
+            run[0].append(chr(av))
+            boundary = False
+        elif op == sre_constants.SUBPATTERN:
+            run = literal_runs(av[-1], runs, run, boundary)
+            boundary = False
+        elif op == sre_constants.AT and av == sre_constants.AT_BOUNDARY:
+            if run is not None:
+                runs.append((''.join(run[0]), run[1]))
+                run = None
+            boundary = True
+        else:
+            if run is not None:
+                runs.append((''.join(run[0]), False))
+                run = None
+            boundary = False
+    return run
+
+
+def query_tokens(pattern):
+    """ The blind tokens that every Keys row matching pattern has, at most
+        MAX_QUERY_TOKENS, or None if pattern says too little to use the
+        index """
+    # parsed as bytes, like the regular expression the rows are searched with
+    if isinstance(pattern, unicode):
+        pattern = pattern.encode('utf8')
+    runs = []
+    run = literal_runs(sre_parse.parse(pattern, re.I), runs, None, False)
+    if run is not None:
+        runs.append((''.join(run[0]), False))
+
+    tokens = set()
+    for piece, word in runs:
+        # bytes that are not whole UTF-8 characters end a piece of text
+        texts = piece.decode('utf8', 'replace').split(u'\ufffd')
+        for text in texts:
+            if word and len(texts) == 1 and WORD.match(text) and WORD.match(text).end() == len(text):
+                tokens.add(u'w' + text.lower())
+            text = text.lower()
+            tokens.update(u't' + text[i:i + 3] for i in xrange(len(text) - 2))
+    if not tokens:
+        return None
+    # words first, they are rarer than trigrams
+    tokens = sorted(tokens, key=lambda token: (token[0] != u'w', token))[:MAX_QUERY_TOKENS]
+    return [blind(token) for token in tokens]
+
+
+def start_id(session):
+    """ The first Keys id covered by the index, or None if there is none """
+    return session.query(BodyIndex.start_id).scalar()
+
+
+def enable(session_maker, readers):
+    """ Starts indexing from the next Keys row on, if not already done.
+        readers are the session makers of the main database and shards. """
+    session = session_maker()
+    if start_id(session) is None:
+        last = 0
+        for maker in readers:
+            reader = maker()
+            last = max(last, reader.query(func.max(Keys.id)).scalar() or 0)
+            reader.close()
+        session.add(BodyIndex(last + 1))
+        session.commit()
+    session.close()
+
+
+def narrow(q, tokens, first_id):
+    """ Restricts a Keys query to the rows that have all tokens, or are
+        older than the index """
+    matching = select([BodyToken.keys_id]).where(BodyToken.token.in_(tokens)).group_by(
+        BodyToken.keys_id).having(func.count() == len(tokens))
+    return q.filter(or_(Keys.id < first_id, Keys.id.in_(matching)))
+
+
+def backfill(session_maker, readers, chunk_size=cfg.BODY_INDEX_CHUNK):
+    """ Indexes the Keys rows older than the index, newest first, lowering
+        BodyIndex.start_id after every chunk so an interrupted backfill
+        continues where it stopped. readers are the session makers of the
+        main database and shards, oldest first. Needs models.ENCRYPTER and
+        models.LOOKUP_KEY. Returns the number of rows indexed. """
+    main = session_maker()
+    state = main.query(BodyIndex).first()
+    if state is None:
+        main.close()
+        enable(session_maker, readers)
+        main = session_maker()
+        state = main.query(BodyIndex).first()
+
+    indexed = 0
+    for maker in reversed(readers):
+        session = maker()
+        while True:
+            rows = session.query(Keys).filter(Keys.id < state.start_id).order_by(
+                Keys.id.desc()).limit(chunk_size).all()
+            if not rows:
+                break
+            ids = [row.id for row in rows]
+            session.execute(BodyToken.__table__.delete().where(BodyToken.keys_id.in_(ids)))
+            tokens = []
+            for row in rows:
+                tokens.extend({'token': token, 'keys_id': row.id}
+                              for token in text_tokens(row, row.decrypt_text()))
+            if tokens:
+                session.execute(BodyToken.__table__.insert(), tokens)
+            session.commit()
+            state.start_id = ids[-1]
+            main.commit()
+            indexed += len(rows)
+            session.expunge_all()
+        session.close()
+    state.start_id = 0
+    main.commit()
+    main.close()
+    return indexed
+
+
+def clear(session_maker, readers):
+    """ Drops all tokens, which are useless under another password, and
+        restarts the index from the next Keys row """
+    session = session_maker()
+    indexing = start_id(session) is not None
+    session.query(BodyIndex).delete()
+    session.commit()
+    session.close()
+    for maker in readers:
+        reader = maker()
+        reader.execute(BodyToken.__table__.delete())
+        reader.commit()
+        reader.close()
+    if indexing:
+        enable(session_maker, readers)
@@ -21,3 +21,106 @@ DATA_DIR = '../DATA'
 DBNAME = 'selfspy.sqlite'
 LOCK_FILE = 'selfspy.pid'
 LOCK = None
+
+# How often (seconds) and after how many queued rows the database writer
+# thread commits a batch.
+WRITER_FLUSH_INTERVAL = 1.0
+WRITER_BATCH_SIZE = 100
+
+# Number of process, window and geometry ids remembered by the logger, so
+# screen changes to recently seen windows need no database lookup.
+DIMENSION_CACHE_SIZE = 1024
+
+# Number of compiled regular expressions kept for the REGEXP function that
+# selfstats filters run inside SQLite.
+REGEXP_CACHE_SIZE = 64
+
+# SQLite tuning used by the logger, one of models.STORAGE_PROFILES.
+STORAGE_PROFILE = 'balanced'
+
+# Bounded exponential backoff when a commit finds the database locked,
+# for example while selfstats is reading.
+COMMIT_RETRIES = 12
+COMMIT_BACKOFF_MIN = 0.05  # seconds
+COMMIT_BACKOFF_MAX = 5.0  # seconds
+
+# Mouse movements closer than this many pixels to the last kept point are
+# left out of the stored mouse path (they are still counted).
+MOUSE_PATH_TOLERANCE = 3
+
+# Journal mode (selfspy --journal): events are appended to segment files in
+# JOURNAL_DIR under the data directory and folded into the database in the
+# background. A segment is closed after JOURNAL_SEGMENT_SIZE bytes or
+# JOURNAL_SEGMENT_SECONDS seconds; closed segments are looked for every
+# JOURNAL_COMPACT_INTERVAL seconds.
+JOURNAL_DIR = 'journal'
+JOURNAL_SEGMENT_SIZE = 1024 * 1024
+JOURNAL_SEGMENT_SECONDS = 60
+JOURNAL_COMPACT_INTERVAL = 5
+
+# --change-password re-encrypts this many rows per committed chunk, using this
+# many processes (None for one per CPU).
+REENCRYPT_CHUNK_SIZE = 2000
+REENCRYPT_WORKERS = None
+
+# X11 selection watching (sniff_x): the selections followed, how many seconds
+# a selection has to keep its owner before its content is fetched, the most
+# bytes fetched of a content and how long to wait for the owner to answer.
+CLIPBOARD_SELECTIONS = ['CLIPBOARD', 'PRIMARY']
+CLIPBOARD_SETTLE = 0.5
+CLIPBOARD_MAX_BYTES = 1024 * 1024
+CLIPBOARD_TIMEOUT = 2.0
+
+# Activity rollups (rollup.py): active seconds are counted with this many
+# seconds of activity after each keystroke or click, like selfstats --active.
+# Events may arrive up to ROLLUP_HORIZON seconds out of order. The backfill
+# commits after this many Keys and Click rows.
+ROLLUP_ACTIVE_SECONDS = 180
+ROLLUP_HORIZON = 24 * 3600
+ROLLUP_BACKFILL_CHUNK = 5000
+
+# Schema migrations (migrations.py). Backfills commit a chunk of rows at a
+# time and pause between chunks so the logger can write. The rates are used
+# for the time estimates; migrations estimated to finish within
+# MIGRATION_AUTO_SECONDS are run when selfspy starts.
+MIGRATION_CHUNK_SIZE = 1000
+MIGRATION_PAUSE = 0.05  # seconds
+MIGRATION_INDEX_RATE = 200000  # rows per second
+MIGRATION_BACKFILL_RATE = 20000  # rows per second
+MIGRATION_AUTO_SECONDS = 2.0
+
+# Sharded storage (selfspy --shards): Keys, Click and Clipboard rows go to one
+# file per month in SHARD_DIR under the data directory, everything else stays
+# in DBNAME.
+SHARD_DIR = 'shards'
+
+# Retention (retention.py): key sequences older than RETENTION_TEXT_DAYS
+# keep only their timings, and key sequences, clicks and clipboard events
+# older than RETENTION_DETAIL_DAYS are dropped, leaving the hourly activity
+# rollups. None keeps everything. Rows are handled a chunk at a time, and up
+# to RETENTION_VACUUM_PAGES freed pages are returned to the file system after
+# each chunk. When selfspy starts it applies the policies for at most
+# RETENTION_AUTO_SECONDS.
+RETENTION_TEXT_DAYS = None
+RETENTION_DETAIL_DAYS = None
+RETENTION_CHUNK_SIZE = 1000
+RETENTION_VACUUM_PAGES = 256
+RETENTION_AUTO_SECONDS = 2.0
+
+# Search index of typed text (body_index.py). Tokens are keyed hashes of
+# words and trigrams cut to BODY_TOKEN_BYTES bytes; a collision only adds a
+# candidate that the regular expression then rejects. The backfill commits
+# after this many Keys rows.
+BODY_TOKEN_BYTES = 8
+BODY_INDEX_CHUNK = 1000
+
+# Columnar export (selfstats --export, export.py): rows are written in chunks
+# of at most this many rows, which bounds the memory the export needs.
+EXPORT_CHUNK_ROWS = 100000
+
+# selfstats reads the columns it needs in chunks of this many rows.
+SELFSTATS_CHUNK_ROWS = 10000
+
+# selfstats --format output is written in blocks of about this many bytes,
+# the first row at once.
+OUTPUT_BUFFER_BYTES = 1 << 16
@@ -0,0 +1,198 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Columnar export for offline analysis (selfstats --export DIR). The key
+# sequences, clicks and clipboard events selected by the selfstats filters
+# are written a chunk of at most cfg.EXPORT_CHUNK_ROWS rows at a time, as
+# DIR/<table>/<chunk>/<column>.npy. Every column is a plain .npy file, so
+# numpy.load(fname, mmap_mode='r') maps it without reading it. The process
+# and window columns are codes into DIR/processes.npy and DIR/windows.npy,
+# with the process code of every window in DIR/window_process.npy. The
+# timings of the key sequences of a chunk are one flat array; the timings of
+# row i are timings[timings_offsets[i]:timings_offsets[i + 1]].
+
+import os
+import glob
+
+import numpy
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy.models import Keys, Click, Clipboard, ClipboardContent, Process, Window
+
+TIME = 'datetime64[us]'
+
+# (name, column, dtype, value stored for NULL) of every exported table
+KEYS_COLUMNS = [('id', Keys.id, numpy.int64, 0),
+                ('started', Keys.started, TIME, 'NaT'),
+                ('created_at', Keys.created_at, TIME, 'NaT'),
+                ('process', Keys.process_id, numpy.int32, -1),
+                ('window', Keys.window_id, numpy.int32, -1),
+                ('nrkeys', Keys.nrkeys, numpy.int32, 0)]
+
+CLICK_COLUMNS = [('id', Click.id, numpy.int64, 0),
+                 ('created_at', Click.created_at, TIME, 'NaT'),
+                 ('process', Click.process_id, numpy.int32, -1),
+                 ('window', Click.window_id, numpy.int32, -1),
+                 ('button', Click.button, numpy.int8, 0),
+                 ('press', Click.press, numpy.bool_, False),
+                 ('x', Click.x, numpy.int32, 0),
+                 ('y', Click.y, numpy.int32, 0),
+                 ('nrmoves', Click.nrmoves, numpy.int32, 0),
+                 ('distance', Click.distance, numpy.float64, numpy.nan),
+                 ('duration', Click.duration, numpy.float64, numpy.nan)]
+
+CLIPBOARD_COLUMNS = [('id', Clipboard.id, numpy.int64, 0),
+                     ('created_at', Clipboard.created_at, TIME, 'NaT'),
+                     ('process', Clipboard.process_id, numpy.int32, -1),
+                     ('window', Clipboard.window_id, numpy.int32, -1),
+                     ('was_ctrl_c', Clipboard.was_ctrl_c, numpy.bool_, False),
+                     ('was_ctrl_v', Clipboard.was_ctrl_v, numpy.bool_, False),
+                     ('was_ctrl_x', Clipboard.was_ctrl_x, numpy.bool_, False),
+                     ('has_html', Clipboard.has_html, numpy.bool_, False),
+                     ('has_image', Clipboard.has_image, numpy.bool_, False),
+                     ('has_text', Clipboard.has_text, numpy.bool_, False),
+                     ('has_url', Clipboard.has_url, numpy.bool_, False),
+                     ('image_height', Clipboard.image_height, numpy.int32, -1),
+                     ('image_width', Clipboard.image_width, numpy.int32, -1),
+                     ('size', ClipboardContent.size, numpy.int64, -1)]
+
+# SQLite allows at most 999 parameters in a query
+IN_CHUNK = 500
+
+
+class Dimension:
+    """ Dictionary encoding of the ids of a dimension table, codes are
+        handed out in the order the ids are first seen. None is coded -1. """
+
+    def __init__(self):
+        self.codes = {}
+        self.ids = []
+
+    def encode(self, ids):
+        codes = self.codes
+        for i in ids:
+            if i is not None and i not in codes:
+                codes[i] = len(self.ids)
+                self.ids.append(i)
+        return [codes.get(i, -1) for i in ids]
+
+
+class Exporter:
+    def __init__(self, directory, chunk_rows=cfg.EXPORT_CHUNK_ROWS):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.processes = Dimension()
+        self.windows = Dimension()
+
+    def write_chunk(self, table, number, arrays):
+        path = os.path.join(self.directory, table, '%06d' % number)
+        os.makedirs(path)
+        for name, values in arrays:
+            numpy.save(os.path.join(path, name + '.npy'), values)
+
+    def column_arrays(self, columns, rows):
+        arrays = []
+        for i, (name, column, dtype, missing) in enumerate(columns):
+            values = [row[i] for row in rows]
+            if name == 'process':
+                values = self.processes.encode(values)
+            elif name == 'window':
+                values = self.windows.encode(values)
+            else:
+                values = [missing if v is None else v for v in values]
+            arrays.append((name, numpy.array(values, dtype=dtype)))
+        return arrays
+
+    def export_table(self, table, queries, model, columns, timings=False, limit=None):
+        """ Writes the rows of queries, which are ordered by id, a chunk at a
+            time, at most limit of them. Returns the number of rows
+            written. """
+        entities = [column for _, column, _, _ in columns]
+        if timings:
+            entities.append(Keys.timings)
+        written = chunk = 0
+        for q in queries:
+            if limit is not None and written >= limit:
+                break
+            if model is Clipboard:
+                q = q.outerjoin(ClipboardContent, Clipboard.content_id == ClipboardContent.id)
+            q = q.with_entities(*entities)
+            last_id = 0
+            while limit is None or written < limit:
+                size = self.chunk_rows if limit is None else min(self.chunk_rows, limit - written)
+                rows = q.filter(model.id > last_id).limit(size).all()
+                if not rows:
+                    break
+                arrays = self.column_arrays(columns, rows)
+                if timings:
+                    arrays.extend(timing_arrays(row[-1] for row in rows))
+                self.write_chunk(table, chunk, arrays)
+                chunk += 1
+                written += len(rows)
+                last_id = rows[-1][0]
+        return written
+
+    def write_dimensions(self, session):
+        """ Writes the names of the processes and titles of the windows the
+            exported rows refer to, in code order """
+        titles = {}
+        for ids in chunked(self.windows.ids):
+            for window_id, title, process_id in session.query(
+                    Window.id, Window.title, Window.process_id).filter(Window.id.in_(ids)):
+                titles[window_id] = (models.maybe_decrypt(title).rstrip('\0').decode('utf8', 'replace'),
+                                     process_id)
+        window_process = self.processes.encode([titles.get(i, (None, None))[1]
+                                                for i in self.windows.ids])
+        names = {}
+        for ids in chunked(self.processes.ids):
+            names.update(session.query(Process.id, Process.name).filter(Process.id.in_(ids)))
+
+        save = lambda name, values: numpy.save(os.path.join(self.directory, name + '.npy'), values)
+        save('processes', unicode_array(names.get(i, u'') for i in self.processes.ids))
+        save('windows', unicode_array(titles.get(i, (u'', None))[0] for i in self.windows.ids))
+        save('window_process', numpy.array(window_process, dtype=numpy.int32))
+
+
+def chunked(ids):
+    for i in xrange(0, len(ids), IN_CHUNK):
+        yield ids[i:i + IN_CHUNK]
+
+
+def unicode_array(values):
+    values = list(values)
+    width = max([len(v) for v in values] + [1])
+    return numpy.array(values, dtype='U%d' % width)
+
+
+def timing_arrays(blobs):
+    lengths = [0]
+    timings = []
+    for blob in blobs:
+        values = models.decode_timings(blob)
+        timings.extend(values)
+        lengths.append(len(values))
+    return [('timings', numpy.array(timings, dtype=numpy.float64)),
+            ('timings_offsets', numpy.cumsum(lengths, dtype=numpy.int64))]
+
+
+def read(directory, table, mmap_mode='r'):
+    """ Yields a {column: array} dict for every chunk of an exported table,
+        with the arrays memory mapped """
+    for path in sorted(glob.glob(os.path.join(directory, table, '*'))):
+        yield dict((os.path.basename(fname)[:-len('.npy')], numpy.load(fname, mmap_mode=mmap_mode))
+                   for fname in glob.glob(os.path.join(path, '*.npy')))
@@ -0,0 +1,341 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# An append-only event journal. The sniffer hooks only append small binary
+# records to the active segment file; a Compactor thread folds closed
+# segments into the database, one transaction per segment, and deletes them.
+# Segments left over from a crash are folded on the next start.
+
+import io
+import os
+import re
+import time
+import zlib
+import struct
+import threading
+
+from sqlalchemy import func
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy.models import JournalSegment, maybe_encrypt, maybe_decrypt
+
+KEY, CLICK, SCREEN, CLIPBOARD = range(1, 5)
+
+# crc32, payload length, record type, event time
+HEADER = struct.Struct('<IIBd')
+LENGTH = struct.Struct('<I')
+
+# Fixed part of each record type and how many length-prefixed strings follow.
+LAYOUTS = {
+    KEY: (struct.Struct('<?'), 1),  # is_repeat; key
+    CLICK: (struct.Struct('<BiiIdd'), 1),  # button, x, y, nrmoves, distance, duration; path
+    SCREEN: (struct.Struct('<iiii'), 2),  # x, y, width, height; process, title
+    CLIPBOARD: (struct.Struct('<???????ii'), 2),  # has_html, has_image, has_text, has_url,
+                                                  # ctrl_c, ctrl_v, ctrl_x, height, width;
+                                                  # content, types
+}
+
+SEGMENT_RE = re.compile(r'^(\d{8})\.journal$')
+
+
+def to_utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf8')
+    return s
+
+
+def segment_name(number):
+    return '%08d.journal' % number
+
+
+def seal(data):
+    """ Encrypts the strings of a record, which hold keys, titles and
+        clipboard contents, like the database columns they end up in. Their
+        length goes inside, as the \0 padding could be part of them. """
+    if not models.ENCRYPTER:
+        return data
+    return maybe_encrypt(LENGTH.pack(len(data)) + data)
+
+
+def unseal(data):
+    if not models.ENCRYPTER:
+        return data
+    data = maybe_decrypt(data)
+    length, = LENGTH.unpack_from(data)
+    return data[LENGTH.size:LENGTH.size + length]
+
+
+def encode_record(kind, when, fields, strings, sealed=True):
+    """ A record for the journal. With sealed, its strings are encrypted,
+        see seal. """
+    fixed, nstrings = LAYOUTS[kind]
+    assert len(strings) == nstrings
+    data = []
+    for s in strings:
+        data.append(LENGTH.pack(len(s)))
+        data.append(s)
+    data = ''.join(data)
+    if sealed:
+        data = seal(data)
+    payload = fixed.pack(*fields) + data
+    body = struct.pack('<Bd', kind, when) + payload
+    crc = zlib.crc32(body) & 0xffffffff
+    return HEADER.pack(crc, len(payload), kind, when) + payload
+
+
+def decode_payload(kind, payload, sealed=True):
+    fixed, nstrings = LAYOUTS[kind]
+    fields = fixed.unpack_from(payload)
+    if sealed:
+        payload = unseal(payload[fixed.size:])
+        pos = 0
+    else:
+        pos = fixed.size
+    strings = []
+    for _ in range(nstrings):
+        length, = LENGTH.unpack_from(payload, pos)
+        pos += LENGTH.size
+        strings.append(payload[pos:pos + length])
+        pos += length
+    return fields, strings
+
+
+def read_records(f, sealed=True):
+    """ Yields (kind, time, fields, strings) for each intact record in the
+        file f, see encode_record for sealed. Reading stops at the first truncated or corrupt record, which
+        is where an interrupted write left the file. """
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        crc, length, kind, when = HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or kind not in LAYOUTS:
+            return
+        if zlib.crc32(struct.pack('<Bd', kind, when) + payload) & 0xffffffff != crc:
+            return
+        fields, strings = decode_payload(kind, payload, sealed)
+        yield kind, when, fields, strings
+
+
+def read_segment(fname):
+    with open(fname, 'rb') as f:
+        for record in read_records(f):
+            yield record
+
+
+def segments(directory):
+    """ The numbers of the segment files in directory, oldest first """
+    if not os.path.isdir(directory):
+        return []
+    numbers = []
+    for name in os.listdir(directory):
+        match = SEGMENT_RE.match(name)
+        if match:
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+
+def checkpoint(session):
+    """ The number of the last segment folded into the database, or 0 """
+    return session.query(func.max(JournalSegment.number)).scalar() or 0
+
+
+def pending_records(session):
+    """ The records that the fold of the last segment kept back, see
+        Compactor. The \0 padding of the encryption is too short to be read
+        as a record. """
+    pending = session.query(JournalSegment.pending).order_by(
+        JournalSegment.number.desc()).limit(1).scalar()
+    if pending is None:
+        return []
+    return list(read_records(io.BytesIO(maybe_decrypt(str(pending))), sealed=False))
+
+
+class Journal:
+    """ The segmented journal files in one directory. A segment is closed when
+        it grows past segment_size bytes or gets older than segment_seconds,
+        so folded data reaches the database within about that time. The last
+        screen change is repeated at the start of every segment, so each
+        segment can be folded on its own. New segments are numbered after
+        both the segments on disk and last_folded, the checkpoint of the
+        database, as a clean shutdown leaves no segments behind. """
+
+    def __init__(self, directory, last_folded=0,
+                 segment_size=cfg.JOURNAL_SEGMENT_SIZE,
+                 segment_seconds=cfg.JOURNAL_SEGMENT_SECONDS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_seconds = segment_seconds
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.opened = None
+        self.last_screen = None
+        self.number = max(self.segments() + [last_folded]) + 1
+
+    def segments(self):
+        return segments(self.directory)
+
+    def closed_segments(self):
+        with self.lock:
+            active = self.number if self.file is not None else None
+        return [n for n in self.segments() if n != active]
+
+    def path(self, number):
+        return os.path.join(self.directory, segment_name(number))
+
+    def append(self, kind, when, fields, strings=()):
+        record = encode_record(kind, when, fields, strings)
+        with self.lock:
+            if self.file is None:
+                self._open()
+            elif self._due():
+                self._rotate()
+            self.file.write(record)
+            self.file.flush()
+            if kind == SCREEN:
+                self.last_screen = record
+
+    def rotate_if_due(self):
+        with self.lock:
+            if self.file is not None and self._due():
+                self._rotate()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _due(self):
+        return (self.file.tell() >= self.segment_size
+                or time.time() - self.opened >= self.segment_seconds)
+
+    def _open(self):
+        self.file = open(self.path(self.number), 'ab')
+        self.opened = time.time()
+        if self.last_screen is not None:
+            self.file.write(self.last_screen)
+
+    def _close(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        self.number += 1
+
+    def _rotate(self):
+        self._close()
+        self._open()
+
+
+class Compactor(threading.Thread):
+    """ Folds closed journal segments into the database. fold(session, records)
+        turns the records of one segment into rows and returns the encoded
+        records of any events it keeps in memory for the next segment, such
+        as the keys of a window that is still active. The rows and a
+        JournalSegment checkpoint holding those records, encrypted like
+        typed text, are committed together before the segment file is
+        deleted; see pending_records. Segments are folded in order, so everything up to the
+        checkpoint is known to be in the database, and a segment numbered like
+        the checkpoint is one that was folded but not yet deleted when selfspy
+        stopped. If folding or committing fails, discard() is called to drop
+        any state built from the failed segment and the segment is retried
+        later. """
+
+    def __init__(self, journal, session_maker, fold, discard,
+                 interval=cfg.JOURNAL_COMPACT_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.journal = journal
+        self.session_maker = session_maker
+        self.fold = fold
+        self.discard = discard
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        self.compact()
+        while True:
+            stopping = self.stopping.wait(self.interval)
+            self.journal.rotate_if_due()
+            self.compact()
+            if stopping:
+                break
+
+    def stop(self):
+        """ Closes the active segment, folds everything and ends the thread """
+        self.journal.close()
+        self.stopping.set()
+        self.join()
+
+    def compact(self):
+        for number in self.journal.closed_segments():
+            if not self.fold_segment(number):
+                break
+
+    def fold_segment(self, number):
+        fname = self.journal.path(number)
+        session = self.session_maker()
+        try:
+            last = checkpoint(session)
+            if number != last:
+                # an older number would be a segment numbered before the
+                # checkpoint was known; its rows are not in the database yet
+                pending = self.fold(session, read_segment(fname))
+                if pending is not None:
+                    pending = maybe_encrypt(pending)
+                session.query(JournalSegment).delete()
+                session.add(JournalSegment(max(number, last), pending))
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            self.discard()
+            print('Could not fold journal segment %d, will retry: %s' % (number, e))
+            return False
+        finally:
+            session.close()
+
+        os.remove(fname)
+        return True
+
+
+class SessionSink:
+    """ Stands in for DbWriter while folding the journal, writing straight
+        into the session of the segment being folded. """
+
+    def __init__(self, session):
+        self.session = session
+
+    def add(self, obj, screen=None, stored=None, lookup=None):
+        if screen is not None and not screen.fill(obj):
+            return
+        if lookup is not None:
+            func, done = lookup
+            done(obj, func(self.session))
+        self.session.add(obj)
+        if stored is not None:
+            stored(obj)
+
+    def submit(self, done, func, *args):
+        done(func(self.session, *args), None)
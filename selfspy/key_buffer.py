@@ -0,0 +1,94 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+
+
+class KeyBuffer(object):
+    """ The key presses queued for the current window, kept as parallel arrays:
+        an interned symbol code, a run length, the seconds since the previous
+        press and one repeat flag bit per entry.
+
+        With collapse set, a run of the same special key (anything longer than
+        one character) is merged into one entry as it is appended, written out
+        as <[Key]xN> and keeping the interval and repeat flag of the last press
+        of the run. """
+
+    __slots__ = ('collapse', 'symbols', 'symbol_codes',
+                 'codes', 'runs', 'intervals', 'repeats')
+
+    def __init__(self, collapse=True):
+        self.collapse = collapse
+        self.symbols = []
+        self.symbol_codes = {}
+        self.clear()
+
+    def clear(self):
+        self.codes = array('i')
+        self.runs = array('i')
+        self.intervals = array('d')
+        self.repeats = bytearray()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, key, interval, is_repeat):
+        code = self.symbol_codes.get(key)
+        if code is None:
+            code = len(self.symbols)
+            self.symbols.append(key)
+            self.symbol_codes[key] = code
+
+        last = len(self.codes) - 1
+        if self.collapse and last >= 0 and self.codes[last] == code and len(key) > 1:
+            self.runs[last] += 1
+            self.intervals[last] = interval
+            self.set_repeat(last, is_repeat)
+            return
+
+        self.codes.append(code)
+        self.runs.append(1)
+        self.intervals.append(interval)
+        self.set_repeat(last + 1, is_repeat)
+
+    def set_repeat(self, i, is_repeat):
+        byte, bit = i >> 3, i & 7
+        if byte == len(self.repeats):
+            self.repeats.append(0)
+        if is_repeat:
+            self.repeats[byte] |= 1 << bit
+        else:
+            self.repeats[byte] &= ~(1 << bit) & 0xff
+
+    def flush(self):
+        """ Returns (keys, timings, nrkeys) for the queued presses and empties
+            the buffer. nrkeys does not count keyboard repeats. """
+        symbols = self.symbols
+        runs = self.runs
+        repeats = self.repeats
+        keys = []
+        nrkeys = 0
+        for i, code in enumerate(self.codes):
+            key = symbols[code]
+            if runs[i] > 1:
+                key = '%s]x%d>' % (key[:-2], runs[i])
+            keys.append(key)
+            if not (repeats[i >> 3] >> (i & 7)) & 1:
+                nrkeys += 1
+        timings = self.intervals.tolist()
+        self.clear()
+        return keys, timings, nrkeys
@@ -0,0 +1,271 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Versioned schema migrations. create_all only creates missing tables, so
+# indexes and columns added to existing tables, and columns derived from
+# other columns, are brought in by the numbered migrations below. Progress is
+# kept in the SchemaVersion table: backfills commit one chunk of rows at a
+# time together with their position, so they can run while the logger keeps
+# writing and continue where they stopped after an interruption. Each
+# migration brings the columns and indexes its own steps need, because the
+# logger runs the quick ones when it starts and leaves the long ones pending.
+
+import time
+
+from sqlalchemy import func, case
+from sqlalchemy.schema import CreateIndex as CreateIndexDDL
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy import rollup
+from selfspy import shards
+from selfspy.models import Keys, Click, Clipboard, Window, JournalSegment, SchemaVersion
+
+
+class CreateIndex:
+    """ Creates an index declared on a model. SQLite builds an index in one
+        statement, holding the write lock until it is done; the logger's
+        commits wait and retry meanwhile. """
+
+    def __init__(self, cls, name):
+        self.table = cls.__table__
+        self.index = [index for index in self.table.indexes if index.name == name][0]
+
+    def describe(self):
+        return 'create index %s on %s(%s)' % (
+            self.index.name, self.table.name, ', '.join(c.name for c in self.index.columns))
+
+    def exists(self, session):
+        return session.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name",
+                               {'name': self.index.name}).scalar() is not None
+
+    def estimate(self, session, last_id):
+        """ Returns (rows, seconds, bytes) """
+        if self.exists(session):
+            return 0, 0.0, 0
+        rows = session.execute('SELECT count(*) FROM %s' % self.table.name).scalar()
+        key_bytes = session.execute('SELECT avg(%s) FROM (SELECT * FROM %s LIMIT 1000)' % (
+            ' + '.join('coalesce(length(%s), 0)' % c.name for c in self.index.columns),
+            self.table.name)).scalar() or 0
+        # every entry holds the key, the rowid and a few bytes of header
+        return rows, float(rows) / cfg.MIGRATION_INDEX_RATE, int(rows * (key_bytes + 12))
+
+    def run(self, session, state):
+        if not self.exists(session):
+            session.execute(CreateIndexDDL(self.index))
+            session.commit()
+
+
+class AddColumn:
+    """ Adds a column declared on a model. Only the schema is rewritten, so
+        this is instant whatever the size of the table. """
+
+    def __init__(self, cls, name):
+        self.table = cls.__table__
+        self.column = self.table.c[name]
+
+    def describe(self):
+        return 'add column %s.%s' % (self.table.name, self.column.name)
+
+    def exists(self, session):
+        return self.column.name in [row[1] for row in session.execute('PRAGMA table_info(%s)' % self.table.name)]
+
+    def estimate(self, session, last_id):
+        return 0, 0.0, 0
+
+    def run(self, session, state):
+        if not self.exists(session):
+            session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                self.table.name, self.column.name,
+                self.column.type.compile(session.bind.dialect)))
+            session.commit()
+
+
+class Backfill:
+    """ Fills in a derived column. chunk(session, last_id, chunk_size) updates
+        the chunk_size rows of cls after last_id without committing and
+        returns the id of the last row it looked at (None when there are no
+        more rows) and the number of rows changed. """
+
+    def __init__(self, cls, description, chunk):
+        self.cls = cls
+        self.description = description
+        self.chunk = chunk
+
+    def describe(self):
+        return self.description
+
+    def estimate(self, session, last_id):
+        rows = session.query(func.count(self.cls.id)).filter(self.cls.id > last_id).scalar()
+        return rows, float(rows) / cfg.MIGRATION_BACKFILL_RATE, 0
+
+    def run(self, session, state):
+        while True:
+            last_id, _ = self.chunk(session, state.last_id, cfg.MIGRATION_CHUNK_SIZE)
+            if last_id is None:
+                return
+            state.last_id = last_id
+            session.commit()
+            time.sleep(cfg.MIGRATION_PAUSE)
+
+
+def dedupe_windows_chunk(session, last_id, chunk_size):
+    """ A Backfill chunk that sets Window.title_hash and merges each window
+        into the first one of its process with the same title, repointing
+        the events and rollups of the main database and all shards. Windows
+        are grouped by (process_id, title_hash) whether or not they already
+        had a title_hash; the first window of a group is the one a logger
+        finds by its hash, so it is the one kept. Needs models.ENCRYPTER and
+        models.LOOKUP_KEY. """
+    rows = session.query(Window.id, Window.process_id, Window.title, Window.title_hash).filter(
+        Window.id > last_id).order_by(Window.id).limit(chunk_size).all()
+    if not rows:
+        return None, 0
+
+    first = {}
+    merged = {}
+    for row in rows:
+        digest = models.stored_title_hash(models.maybe_decrypt(row.title))
+        key = (row.process_id, digest)
+        if key not in first:
+            first[key] = session.query(Window.id).filter(
+                Window.process_id == row.process_id, Window.title_hash == digest,
+                Window.id <= last_id).order_by(Window.id).limit(1).scalar()
+        if first[key] is None:
+            if row.title_hash != digest:
+                session.query(Window).filter_by(id=row.id).update(
+                    {'title_hash': digest}, synchronize_session=False)
+            first[key] = row.id
+        else:
+            merged[row.id] = first[key]
+
+    if merged:
+        # shards first: if this is interrupted, the chunk is done again
+        shard_set = shards.ShardSet(session.bind.url.database)
+        for maker in shard_set.readers(None)[1:]:
+            shard = maker()
+            repoint_windows(shard, merged)
+            shard.commit()
+            shard.close()
+        repoint_windows(session, merged)
+        rollup.merge_windows(session, merged)
+        session.query(Window).filter(Window.id.in_(list(merged))).delete(synchronize_session=False)
+    return rows[-1].id, len(merged)
+
+
+def repoint_windows(session, merged):
+    for cls in (Keys, Click, Clipboard):
+        session.execute(cls.__table__.update().where(cls.window_id.in_(list(merged))).values(
+            window_id=case(merged, value=cls.window_id)))
+
+
+class Migration:
+    def __init__(self, version, name, steps):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+MIGRATIONS = [
+    Migration(1, u'index Keys.started',
+              [CreateIndex(Keys, 'ix_keys_started')]),
+    Migration(2, u'index process and time of Keys and Click',
+              [CreateIndex(Keys, 'ix_keys_process_created'),
+               CreateIndex(Click, 'ix_click_process_created')]),
+    Migration(3, u'index process and title of Window',
+              [CreateIndex(Window, 'ix_window_process_title')]),
+    Migration(4, u'binary key timings',
+              [Backfill(Keys, 'convert key timings stored as JSON', models.upgrade_timings_chunk)]),
+    Migration(5, u'keyed hash of window titles',
+              [AddColumn(Window, 'title_hash'),
+               CreateIndex(Window, 'ix_window_process_title_hash'),
+               Backfill(Window, 'hash window titles and merge duplicate windows', dedupe_windows_chunk)]),
+    # the columns the logger writes; title_hash again because migration 5 may
+    # be left pending for its backfill
+    Migration(6, u'mouse paths, clipboard contents and journal checkpoints',
+              [AddColumn(Click, 'path'),
+               AddColumn(Click, 'distance'),
+               AddColumn(Click, 'duration'),
+               AddColumn(Clipboard, 'content_id'),
+               AddColumn(Clipboard, 'types_id'),
+               CreateIndex(Clipboard, 'ix_clipboard_content_id'),
+               AddColumn(Window, 'title_hash'),
+               AddColumn(JournalSegment, 'pending')]),
+]
+
+
+def pending(session):
+    """ Returns the migrations that are not finished, in order, with their
+        SchemaVersion rows (None if they were never started) """
+    states = dict((state.version, state) for state in session.query(SchemaVersion))
+    return [(migration, states.get(migration.version)) for migration in MIGRATIONS
+            if migration.version not in states or not states[migration.version].finished]
+
+
+def estimate(session, migration, state=None):
+    """ Returns the (rows, seconds, bytes) left to do of migration. Times
+        come from the rates in config and are rough. """
+    total = [0, 0.0, 0]
+    first = state.step if state is not None else 0
+    for i, step in enumerate(migration.steps[first:], first):
+        last_id = state.last_id if state is not None and i == state.step else 0
+        for j, n in enumerate(step.estimate(session, last_id)):
+            total[j] += n
+    return tuple(total)
+
+
+def migrate(session_maker, dry_run=False, max_seconds=None):
+    """ Runs the pending migrations in order, printing an estimate of each
+        first. With dry_run only the estimates are printed. With max_seconds,
+        quietly runs the migrations estimated to take at most that long and
+        leaves the others pending. Returns the migrations left pending. """
+    session = session_maker()
+    try:
+        todo = pending(session)
+        left = []
+        for migration, state in todo:
+            rows, seconds, size = estimate(session, migration, state)
+            if max_seconds is not None:
+                if seconds > max_seconds:
+                    left.append(migration)
+                    continue
+            else:
+                print('Migration %d, %s: %d rows, about %.1f seconds, %.1f MB' % (
+                    migration.version, migration.name, rows, seconds, size / 1048576.0))
+                for step in migration.steps:
+                    print('  %s' % step.describe())
+            if not dry_run:
+                run(session, migration, state)
+        if dry_run:
+            return [m for m, _ in todo]
+        return left
+    finally:
+        session.close()
+
+
+def run(session, migration, state=None):
+    if state is None:
+        state = SchemaVersion(migration.version, migration.name)
+        session.add(state)
+        session.commit()
+    for i in range(state.step, len(migration.steps)):
+        migration.steps[i].run(session, state)
+        state.step = i + 1
+        state.last_id = 0
+        session.commit()
+    state.finished = True
+    session.commit()
@@ -15,27 +15,110 @@
 # You should have received a copy of the GNU General Public License
 # along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import zlib
 import json
 import re
+import hmac
+import hashlib
+from array import array
 
 import datetime
 
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy import (
-    Index, Column, Boolean, Integer, Unicode, DateTime, Binary, ForeignKey,
-    create_engine
+    Index, Column, Boolean, Integer, Float, Unicode, DateTime, Binary,
+    ForeignKey, create_engine, event
 )
-from sqlalchemy.orm import sessionmaker, relationship, backref
-
-
-def initialize(fname):
+from sqlalchemy.orm import sessionmaker, relationship, backref, object_session
+
+from selfspy import config as cfg
+from selfspy.mouse_path import decode_path
+from selfspy.lru import LRUCache
+
+# Trade-offs between durability and write throughput. "durable" keeps the
+# classic rollback journal and fsyncs every commit, "balanced" uses WAL and
+# only syncs at checkpoints, "fast" also stops syncing entirely and may lose
+# the last transactions on power loss (but never corrupts the database).
+STORAGE_PROFILES = {
+    'durable': {'busy_timeout': 5000,
+                'journal_mode': 'DELETE',
+                'synchronous': 'FULL',
+                'mmap_size': 0,
+                'cache_size': -2000,
+                'wal_autocheckpoint': 1000},
+    'balanced': {'busy_timeout': 5000,
+                 'journal_mode': 'WAL',
+                 'synchronous': 'NORMAL',
+                 'mmap_size': 64 * 1024 * 1024,
+                 'cache_size': -8000,
+                 'wal_autocheckpoint': 1000},
+    'fast': {'busy_timeout': 10000,
+             'journal_mode': 'WAL',
+             'synchronous': 'OFF',
+             'mmap_size': 256 * 1024 * 1024,
+             'cache_size': -32000,
+             'wal_autocheckpoint': 10000},
+}
+
+# busy_timeout goes first so that switching journal mode waits for locks.
+PRAGMA_ORDER = ['busy_timeout', 'journal_mode', 'synchronous', 'mmap_size',
+                'cache_size', 'wal_autocheckpoint']
+
+
+def make_engine(fname, profile=cfg.STORAGE_PROFILE):
     engine = create_engine('sqlite:///%s?check_same_thread=False' % fname)
+    pragmas = STORAGE_PROFILES[profile]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name in PRAGMA_ORDER:
+            if name == 'journal_mode' and cursor.execute('PRAGMA page_count').fetchone()[0] == 0:
+                # only possible before the first write, see retention.vacuum
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cursor.execute('PRAGMA %s = %s' % (name, pragmas[name]))
+        cursor.close()
+        dbapi_connection.create_function('regexp', 2, sql_regexp)
+        dbapi_connection.create_function('decrypt', 1, sql_decrypt)
+
+    return engine
+
+
+PATTERNS = LRUCache(cfg.REGEXP_CACHE_SIZE)
+
+
+def sql_regexp(pattern, value):
+    """ The SQL function behind "value REGEXP pattern". Case insensitive, like
+        the regular expressions of selfstats. """
+    if value is None:
+        return False
+    reg = PATTERNS.get(pattern)
+    if reg is None:
+        reg = PATTERNS[pattern] = re.compile(pattern, re.I)
+    return reg.search(value) is not None
+
+
+def sql_decrypt(blob):
+    """ The SQL function decrypt(column): the text of a column written with
+        maybe_encrypt, as far as ENCRYPTER can decrypt it """
+    if blob is None:
+        return None
+    try:
+        text = maybe_decrypt(str(blob)).rstrip('\0')
+    except ValueError:
+        text = str(blob)
+    return text.decode('utf8', 'replace')
+
+
+def initialize(fname, profile=cfg.STORAGE_PROFILE):
+    engine = make_engine(fname, profile)
     Base.metadata.create_all(engine)
     return sessionmaker(bind=engine)
 
 
 ENCRYPTER = None
+LOOKUP_KEY = None
 
 Base = declarative_base()
 
@@ -49,11 +132,53 @@ class SpookMixin(object):
     created_at = Column(DateTime, default=datetime.datetime.now, index=True)
 
 
+class ClipboardContent(SpookMixin, Base):
+    # Every distinct clipboard content, stored once compressed and encrypted.
+    # digest is a keyed hash of the plain content, so equal contents can be
+    # found without decrypting and without revealing them.
+    digest = Column(Binary, nullable=False, unique=True)
+    content = Column(Binary, nullable=False)
+    size = Column(Integer, nullable=False)
+
+    def __init__(self, content):
+        self.digest = keyed_hash(content)
+        self.size = len(content)
+        self.encrypt_content(content)
+
+    def encrypt_content(self, content, other_encrypter=None):
+        self.content = maybe_encrypt(zlib.compress(content), other_encrypter=other_encrypter)
+
+    def decrypt_content(self):
+        return zlib.decompress(maybe_decrypt(self.content))
+
+    def __repr__(self):
+        return "<ClipboardContent %d (%d bytes)>" % (self.id, self.size)
+
+
+class ClipboardTypes(SpookMixin, Base):
+    # The distinct sets of MIME types offered by the clipboard
+    types = Column(Binary, nullable=False, unique=True)
+
+    def __init__(self, types):
+        self.types = types
+
+    def __repr__(self):
+        return "<ClipboardTypes '%s'>" % self.types
+
+
 class Clipboard(SpookMixin, Base):
     # Clipboard class for storing data in database, receives data from activity_store.py
+    # clipboard_content and types are only filled in rows stored by older
+    # versions, newer rows reference ClipboardContent and ClipboardTypes.
     clipboard_content = Column(Binary, nullable=False)
     types = Column(Binary, nullable=False)
 
+    content_id = Column(Integer, ForeignKey('clipboardcontent.id'), index=True)
+    content = relationship("ClipboardContent")
+
+    types_id = Column(Integer, ForeignKey('clipboardtypes.id'))
+    type_set = relationship("ClipboardTypes")
+
     was_ctrl_c = Column(Boolean)
     was_ctrl_v = Column(Boolean)
     was_ctrl_x = Column(Boolean)
@@ -77,11 +202,12 @@ class Clipboard(SpookMixin, Base):
     geometry_id = Column(Integer, ForeignKey('geometry.id'), nullable=False)
     geometry = relationship("Geometry", backref=backref('clipboard'))
 
-    def __init__(self, clipboard_content, types, has_html, has_image, has_text, has_url, image_height, image_width, was_ctrl_c, was_ctrl_v, was_ctrl_x, process_id,
+    def __init__(self, content_id, types_id, has_html, has_image, has_text, has_url, image_height, image_width, was_ctrl_c, was_ctrl_v, was_ctrl_x, process_id,
                  window_id, geometry_id):
-        self.encrypt_text(clipboard_content)
-
-        self.types = types
+        self.clipboard_content = ''
+        self.types = ''
+        self.content_id = content_id
+        self.types_id = types_id
 
         self.has_html = has_html
         self.has_text = has_text
@@ -101,12 +227,127 @@ class Clipboard(SpookMixin, Base):
 
 
     def __repr__(self):
-        return "<Clipboard (%d, %d, %d)>" % (self.clipboard_content, self.types, self.mime_type)
+        return "<Clipboard (%s, %s)>" % (self.content_id, self.types_id)
 
     def encrypt_text(self, text, other_encrypter=None):
         ztext = maybe_encrypt(text, other_encrypter=other_encrypter)
         self.clipboard_content = ztext
 
+    def decrypt_text(self):
+        if self.content_id is not None:
+            return self.content.decrypt_content()
+        return maybe_decrypt(self.clipboard_content).rstrip('\0')
+
+    def load_types(self):
+        if self.types_id is not None:
+            return self.type_set.types
+        return self.types
+
+
+class JournalSegment(SpookMixin, Base):
+    # The last journal segment folded into the database, see journal.py
+    number = Column(Integer, nullable=False)
+    # journal records of the keys still queued after it, and their screen
+    pending = Column(Binary)
+
+    def __init__(self, number, pending=None):
+        self.number = number
+        self.pending = pending
+
+    def __repr__(self):
+        return "<JournalSegment %d>" % self.number
+
+
+# Counters of the activity rollup tables, see rollup.py
+ROLLUP_COUNTS = ('keystrokes', 'key_rows', 'clicks', 'button1', 'button2', 'button3',
+                 'button4', 'button5', 'button6', 'button7', 'mousings')
+
+
+class RollupMixin(object):
+    # Activity summed per bucket of time, process and window. The rows with
+    # window_id 0 cover all windows of a process and the rows with process_id
+    # 0 cover everything; their active_seconds is the time active in any of
+    # the windows below them, not the sum.
+    bucket = Column(DateTime, primary_key=True)
+    process_id = Column(Integer, primary_key=True, autoincrement=False)
+    window_id = Column(Integer, primary_key=True, autoincrement=False)
+
+    keystrokes = Column(Integer, nullable=False, default=0)
+    key_rows = Column(Integer, nullable=False, default=0)
+    clicks = Column(Integer, nullable=False, default=0)
+    button1 = Column(Integer, nullable=False, default=0)
+    button2 = Column(Integer, nullable=False, default=0)
+    button3 = Column(Integer, nullable=False, default=0)
+    button4 = Column(Integer, nullable=False, default=0)
+    button5 = Column(Integer, nullable=False, default=0)
+    button6 = Column(Integer, nullable=False, default=0)
+    button7 = Column(Integer, nullable=False, default=0)
+    mousings = Column(Integer, nullable=False, default=0)
+    active_seconds = Column(Float, nullable=False, default=0.0)
+
+
+class MinuteActivity(RollupMixin, Base):
+    __tablename__ = 'minuteactivity'
+    length = 60
+
+
+class HourActivity(RollupMixin, Base):
+    __tablename__ = 'houractivity'
+    length = 3600
+
+
+class SchemaVersion(SpookMixin, Base):
+    # Migrations applied to the database, see migrations.py. While a
+    # migration runs, step is the step in progress and last_id the last row
+    # a backfill step has done; finished is set when all steps are done.
+    version = Column(Integer, nullable=False, unique=True)
+    name = Column(Unicode, nullable=False)
+    step = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    finished = Column(Boolean, nullable=False)
+
+    def __init__(self, version, name):
+        self.version = version
+        self.name = name
+        self.step = 0
+        self.last_id = 0
+        self.finished = False
+
+    def __repr__(self):
+        return "<SchemaVersion %d %s>" % (self.version, self.name)
+
+
+class Reencryption(SpookMixin, Base):
+    # Progress of a --change-password run, see reencrypt.py. Rows of table up
+    # to last_id, and all tables before it, use the new password.
+    table = Column(Unicode, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    check = Column(Binary, nullable=False)
+
+    def __init__(self, table, last_id, check):
+        self.table = table
+        self.last_id = last_id
+        self.check = check
+
+    def __repr__(self):
+        return "<Reencryption %s %d>" % (self.table, self.last_id)
+
+
+class Retention(SpookMixin, Base):
+    # Progress of the retention policies, see retention.py. name is
+    # "policy/table", prefixed with "YYYY-MM/" for a shard. Rows up to last_id
+    # that were created before horizon have been downsampled.
+    name = Column(Unicode, nullable=False, unique=True)
+    last_id = Column(Integer, nullable=False)
+    horizon = Column(DateTime)
+
+    def __init__(self, name):
+        self.name = name
+        self.last_id = 0
+
+    def __repr__(self):
+        return "<Retention %s %d>" % (self.name, self.last_id)
+
 
 class Process(SpookMixin, Base):
     name = Column(Unicode, index=True, unique=True)
@@ -124,10 +365,16 @@ class Window(SpookMixin, Base):
 
     browser_strings = ["Chrome", "Firefox", "Edge", "Opera", "Safari", "chrome", "firefox", "edge", "opera", "safari"]
 
+    __table_args__ = (Index('ix_window_process_title', 'process_id', 'title'),
+                      Index('ix_window_process_title_hash', 'process_id', 'title_hash'))
+
     is_browser = Column(Boolean)
     is_text_processing = Column(Boolean)
 
     title = Column(Binary, index=True)
+    # keyed_hash of the plain title, to find windows by title when titles
+    # are encrypted
+    title_hash = Column(Binary)
 
     process_id = Column(Integer, ForeignKey('process.id'), nullable=False, index=True)
     process = relationship("Process", backref=backref('windows'))
@@ -149,6 +396,7 @@ class Window(SpookMixin, Base):
                 self.is_text_processing = False
 
         self.encrypt_text(title)
+        self.title_hash = title_hash(title)
         self.process_id = process_id
 
     def encrypt_text(self, text, other_encrypter=None):
@@ -184,6 +432,13 @@ class Click(SpookMixin, Base):
     y = Column(Integer, nullable=False)
     nrmoves = Column(Integer, nullable=False)
 
+    __table_args__ = (Index('ix_click_process_created', 'process_id', 'created_at'),)
+
+    # mouse movement since the previous click, see mouse_path.py
+    path = Column(Binary)
+    distance = Column(Float)
+    duration = Column(Float)
+
     process_id = Column(Integer, ForeignKey('process.id'), nullable=False, index=True)
     process = relationship("Process", backref=backref('clicks'))
 
@@ -193,17 +448,27 @@ class Click(SpookMixin, Base):
     geometry_id = Column(Integer, ForeignKey('geometry.id'), nullable=False)
     geometry = relationship("Geometry", backref=backref('clicks'))
 
-    def __init__(self, button, press, x, y, nrmoves, process_id, window_id, geometry_id):
+    def __init__(self, button, press, x, y, nrmoves, process_id, window_id, geometry_id,
+                 path=None, distance=None, duration=None):
         self.button = button
         self.press = press
         self.x = x
         self.y = y
         self.nrmoves = nrmoves
 
+        self.path = path
+        self.distance = distance
+        self.duration = duration
+
         self.process_id = process_id
         self.window_id = window_id
         self.geometry_id = geometry_id
 
+    def load_path(self):
+        if self.path is None:
+            return []
+        return decode_path(self.path)
+
     def __repr__(self):
         return "<Click (%d, %d), (%d, %d, %d)>" % (self.x, self.y, self.button, self.press, self.nrmoves)
 
@@ -233,9 +498,245 @@ def maybe_decrypt(s, other_encrypter=None):
     return s
 
 
+def make_lookup_key(key):
+    """ Derives the key of keyed_hash from a Blowfish key (None for no
+        encryption), so lookups do not reuse the encryption key itself """
+    if key is None:
+        return None
+    return hmac.new(key, 'selfspy lookup', hashlib.sha256).digest()
+
+
+def keyed_hash(s, key=None):
+    """ HMAC-SHA256 of s under key, or LOOKUP_KEY by default. Without a
+        key this is an ordinary hash of s. """
+    if key is None:
+        key = LOOKUP_KEY
+    return hmac.new(key or '', s, hashlib.sha256).digest()
+
+
+def content_digest(stored, key):
+    """ The ClipboardContent.digest under key of a decrypted stored content """
+    return keyed_hash(zlib.decompress(stored), key)
+
+
+def title_hash(title, key=None):
+    """ The Window.title_hash of a plain title """
+    if isinstance(title, unicode):
+        title = title.encode('utf8')
+    return keyed_hash(title, key)
+
+
+def stored_title_hash(stored, key=None):
+    """ The Window.title_hash under key of a decrypted stored title, which
+        has the padding of maybe_encrypt """
+    return title_hash(str(stored).rstrip('\0'), key)
+
+
+def upgrade_clipboard(session, chunk_size=1000):
+    """ Moves clipboard contents and types stored inline by older versions to
+        the shared ClipboardContent and ClipboardTypes rows, one committed
+        chunk of rows at a time. Returns the number of rows converted. """
+    contents = {}
+    type_sets = {}
+    converted = 0
+    last_id = 0
+    while True:
+        rows = session.query(Clipboard.id, Clipboard.clipboard_content, Clipboard.types).filter(
+            Clipboard.id > last_id, Clipboard.content_id == None
+        ).order_by(Clipboard.id).limit(chunk_size).all()
+        if not rows:
+            return converted
+
+        for row_id, blob, types in rows:
+            content = maybe_decrypt(blob).rstrip('\0')
+            digest = keyed_hash(content)
+            if digest not in contents:
+                stored = session.query(ClipboardContent.id).filter_by(digest=digest).scalar()
+                if stored is None:
+                    row = ClipboardContent(content)
+                    session.add(row)
+                    session.flush()
+                    stored = row.id
+                contents[digest] = stored
+            if types not in type_sets:
+                stored = session.query(ClipboardTypes.id).filter_by(types=types).scalar()
+                if stored is None:
+                    row = ClipboardTypes(types)
+                    session.add(row)
+                    session.flush()
+                    stored = row.id
+                type_sets[types] = stored
+            session.query(Clipboard).filter_by(id=row_id).update(
+                {'content_id': contents[digest], 'types_id': type_sets[types],
+                 'clipboard_content': '', 'types': ''},
+                synchronize_session=False)
+            converted += 1
+        session.commit()
+        last_id = rows[-1][0]
+
+
+# Keys.timings formats, tagged by their first byte. Millisecond formats store
+# the differences of the rounded running total, so rounding errors do not add
+# up over a row. Legacy rows are zlib compressed JSON lists of floats; a zlib
+# stream never starts with one of these bytes.
+TIMINGS_FORMATS = {
+    '\x01': ('H', 1000),  # uint16 milliseconds
+    '\x02': ('i', 1000),  # int32 milliseconds
+    '\x03': ('d', 1),  # float64 seconds, for anything else
+}
+TIMINGS_UINT16_MS, TIMINGS_INT32_MS, TIMINGS_FLOAT64 = '\x01', '\x02', '\x03'
+
+
+def encode_timings(timings):
+    millis = []
+    total = 0.0
+    prev = 0
+    for t in timings:
+        total += t
+        cur = int(round(total * 1000))
+        millis.append(cur - prev)
+        prev = cur
+
+    if all(0 <= m <= 0xffff for m in millis):
+        tag, values = TIMINGS_UINT16_MS, array('H', millis)
+    elif all(-2 ** 31 <= m < 2 ** 31 for m in millis):
+        tag, values = TIMINGS_INT32_MS, array('i', millis)
+    else:
+        tag, values = TIMINGS_FLOAT64, array('d', timings)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return tag + zlib.compress(values.tostring())
+
+
+def decode_timings(blob):
+    fmt = TIMINGS_FORMATS.get(blob[:1])
+    if fmt is None:
+        return json.loads(zlib.decompress(blob))
+
+    typecode, scale = fmt
+    values = array(typecode)
+    values.fromstring(zlib.decompress(blob[1:]))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    if scale == 1:
+        return values.tolist()
+    return [v / 1000.0 for v in values]
+
+
+def count_timings(blob):
+    """ len(decode_timings(blob)), without building the list """
+    fmt = TIMINGS_FORMATS.get(blob[:1])
+    if fmt is None:
+        return len(json.loads(zlib.decompress(blob)))
+    return len(zlib.decompress(blob[1:])) // array(fmt[0]).itemsize
+
+
+def upgrade_timings_chunk(session, last_id, chunk_size=1000):
+    """ Rewrites legacy JSON timings of the chunk_size Keys rows after last_id
+        in the current format, without committing. Returns the id of the last
+        row looked at (None when there are no more rows) and the number of
+        rows converted. """
+    rows = session.query(Keys.id, Keys.timings).filter(
+        Keys.id > last_id
+    ).order_by(Keys.id).limit(chunk_size).all()
+    if not rows:
+        return None, 0
+
+    converted = 0
+    for row_id, blob in rows:
+        if blob and blob[:1] not in TIMINGS_FORMATS:
+            session.query(Keys).filter_by(id=row_id).update(
+                {'timings': encode_timings(decode_timings(blob))},
+                synchronize_session=False)
+            converted += 1
+    return rows[-1][0], converted
+
+
+def upgrade_timings(session, chunk_size=1000):
+    """ Rewrites legacy JSON timings in the current format, one committed
+        chunk of rows at a time. Returns the number of rows converted. """
+    converted = 0
+    last_id = 0
+    while True:
+        last_id, done = upgrade_timings_chunk(session, last_id, chunk_size)
+        session.commit()
+        if last_id is None:
+            return converted
+        converted += done
+
+
+class KeySymbol(SpookMixin, Base):
+    # The vocabulary of key strings, e.g. 'a' or '<[Ctrl: c]>'. Keys rows
+    # store the ids of these rows instead of the strings. The symbol is
+    # encrypted like the rest of the typed text; encryption is deterministic,
+    # so it can still be looked up by value.
+    symbol = Column(Binary, nullable=False, unique=True)
+
+    def __init__(self, symbol):
+        self.encrypt_symbol(symbol)
+
+    def encrypt_symbol(self, symbol, other_encrypter=None):
+        self.symbol = maybe_encrypt(to_utf8(symbol), other_encrypter=other_encrypter)
+
+    def decrypt_symbol(self):
+        return maybe_decrypt(self.symbol).rstrip('\0').decode('utf8')
+
+    def __repr__(self):
+        return "<KeySymbol %d>" % self.id
+
+
+def to_utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf8')
+    return s
+
+
+def key_symbol_value(symbol):
+    """ The stored KeySymbol.symbol of a key string, for lookups """
+    return maybe_encrypt(to_utf8(symbol))
+
+
+def load_key_symbols(session):
+    """ Returns KeySymbol id -> key string for the whole vocabulary """
+    return dict((ks.id, ks.decrypt_symbol()) for ks in session.query(KeySymbol))
+
+
+# Keys.keys formats, tagged by the first byte before encryption. Each key is
+# stored as the id of its KeySymbol row. Legacy rows are zlib compressed JSON
+# lists of key strings.
+KEY_CODES_FORMATS = {
+    '\x01': 'H',
+    '\x02': 'i',
+}
+
+
+def encode_key_codes(codes):
+    if not codes or max(codes) <= 0xffff:
+        tag, values = '\x01', array('H', codes)
+    else:
+        tag, values = '\x02', array('i', codes)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return tag + zlib.compress(values.tostring())
+
+
+def decode_key_codes(data):
+    """ Returns the array of KeySymbol ids, or None for a legacy JSON row """
+    typecode = KEY_CODES_FORMATS.get(data[:1])
+    if typecode is None:
+        return None
+    values = array(typecode)
+    values.fromstring(zlib.decompress(data[1:]))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
 class Keys(SpookMixin, Base):
+    __table_args__ = (Index('ix_keys_process_created', 'process_id', 'created_at'),)
+
     text = Column(Binary, nullable=False)
-    started = Column(DateTime, nullable=False)
+    started = Column(DateTime, nullable=False, index=True)
 
     process_id = Column(Integer, ForeignKey('process.id'), nullable=False, index=True)
     process = relationship("Process", backref=backref('keys'))
@@ -251,11 +752,13 @@ class Keys(SpookMixin, Base):
     keys = Column(Binary)
     timings = Column(Binary)
 
-    def __init__(self, text, keys, timings, nrkeys, started, process_id, window_id, geometry_id):
-        ztimings = zlib.compress(json.dumps(timings))
+    tokens = relationship("BodyToken")
+
+    def __init__(self, text, key_codes, timings, nrkeys, started, process_id, window_id, geometry_id):
+        ztimings = encode_timings(timings)
 
         self.encrypt_text(text)
-        self.encrypt_keys(keys)
+        self.encrypt_keys(key_codes)
 
         self.nrkeys = nrkeys
         self.timings = ztimings
@@ -269,8 +772,8 @@ class Keys(SpookMixin, Base):
         ztext = maybe_encrypt(text, other_encrypter=other_encrypter)
         self.text = ztext
 
-    def encrypt_keys(self, keys, other_encrypter=None):
-        zkeys = maybe_encrypt(zlib.compress(json.dumps(keys)),
+    def encrypt_keys(self, key_codes, other_encrypter=None):
+        zkeys = maybe_encrypt(encode_key_codes(key_codes),
                               other_encrypter=other_encrypter)
         self.keys = zkeys
 
@@ -280,9 +783,20 @@ class Keys(SpookMixin, Base):
     def decrypt_humanreadable(self):
         return self.to_humanreadable(self.decrypt_text())
 
-    def decrypt_keys(self):
+    def decrypt_key_codes(self):
+        """ The KeySymbol ids of the keys, or None if the row was stored as JSON """
+        return decode_key_codes(maybe_decrypt(self.keys))
+
+    def decrypt_keys(self, symbols=None):
+        """ The key strings. symbols maps KeySymbol ids to strings, as returned
+            by load_key_symbols, and is loaded if not given. """
         keys = maybe_decrypt(self.keys)
-        return json.loads(zlib.decompress(keys))
+        codes = decode_key_codes(keys)
+        if codes is None:
+            return json.loads(zlib.decompress(keys))
+        if symbols is None:
+            symbols = load_key_symbols(object_session(self))
+        return [symbols[code] for code in codes]
 
     def to_humanreadable(self, text):
         backrex = re.compile("\<\[Backspace\]x?(\d+)?\>", re.IGNORECASE)
@@ -303,7 +817,33 @@ class Keys(SpookMixin, Base):
         return text
 
     def load_timings(self):
-        return json.loads(zlib.decompress(self.timings))
+        return decode_timings(self.timings)
 
     def __repr__(self):
         return "<Keys %s>" % self.nrkeys
+
+
+class BodyToken(Base):
+    # The search index of typed text, see body_index.py: one row per blind
+    # token of the words and trigrams of a Keys row
+    __tablename__ = 'bodytoken'
+    __table_args__ = (Index('ix_bodytoken_keys', 'keys_id'),
+                      {'sqlite_with_rowid': False})
+
+    token = Column(Binary, primary_key=True)
+    keys_id = Column(Integer, ForeignKey('keys.id'), primary_key=True, autoincrement=False)
+
+    def __init__(self, token):
+        self.token = token
+
+
+class BodyIndex(SpookMixin, Base):
+    # Keys rows from start_id on have their tokens in BodyToken. The logger
+    # indexes new rows once this row exists; a backfill lowers start_id.
+    start_id = Column(Integer, nullable=False)
+
+    def __init__(self, start_id):
+        self.start_id = start_id
+
+    def __repr__(self):
+        return "<BodyIndex %d>" % self.start_id
@@ -0,0 +1,112 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import math
+import zlib
+from array import array
+
+from selfspy import config as cfg
+
+INT16_MIN, INT16_MAX = -2 ** 15, 2 ** 15 - 1
+
+
+class MousePath:
+    """ The mouse movements between two clicks, kept as a flat x, y int array.
+        Points closer than tolerance pixels to the previously kept point are
+        dropped as they arrive (radial distance simplification), but count,
+        distance and duration always describe the raw movement. """
+
+    def __init__(self, tolerance=cfg.MOUSE_PATH_TOLERANCE):
+        self.tolerance2 = tolerance * tolerance
+        self.clear()
+
+    def clear(self):
+        self.points = array('i')
+        self.count = 0
+        self.distance = 0.0
+        self.first_time = None
+        self.last_time = None
+        self.last_x = None
+        self.last_y = None
+
+    def append(self, x, y, now):
+        if self.count:
+            self.distance += math.hypot(x - self.last_x, y - self.last_y)
+        else:
+            self.first_time = now
+        self.count += 1
+        self.last_time = now
+        self.last_x = x
+        self.last_y = y
+
+        if self.points:
+            dx = x - self.points[-2]
+            dy = y - self.points[-1]
+            if dx * dx + dy * dy < self.tolerance2:
+                return
+        self.points.append(x)
+        self.points.append(y)
+
+    def __len__(self):
+        return self.count
+
+    def duration(self):
+        if not self.count:
+            return 0.0
+        return self.last_time - self.first_time
+
+    def encode(self):
+        """ Returns the simplified path as a compact blob, or None if the mouse did not move """
+        if not self.count:
+            return None
+        points = array('i', self.points)
+        if points[-2:] != array('i', [self.last_x, self.last_y]):
+            points.extend([self.last_x, self.last_y])
+        return encode_path(points)
+
+
+def encode_path(points):
+    """ Delta encodes a flat x, y array and compresses it. The first byte is the
+        array typecode of the deltas, 'h' if they all fit in 16 bits, else 'i'. """
+    deltas = array('i', points[:2])
+    for i in xrange(2, len(points)):
+        deltas.append(points[i] - points[i - 2])
+
+    typecode = 'h'
+    if deltas and (min(deltas) < INT16_MIN or max(deltas) > INT16_MAX):
+        typecode = 'i'
+    deltas = array(typecode, deltas)
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    return typecode + zlib.compress(deltas.tostring())
+
+
+def decode_path(blob):
+    """ Returns the list of (x, y) points stored by encode_path """
+    deltas = array(blob[0])
+    deltas.fromstring(zlib.decompress(blob[1:]))
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+
+    path = []
+    x = y = 0
+    for i in xrange(0, len(deltas), 2):
+        x += deltas[i]
+        y += deltas[i + 1]
+        path.append((x, y))
+    return path
@@ -0,0 +1,90 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Machine readable output of selfstats (--format): one JSON object per line,
+# or CSV or TSV with a header line, in UTF-8. Lines are gathered in a buffer
+# that is written after the first row, so the first result shows at once,
+# and then whenever it holds cfg.OUTPUT_BUFFER_BYTES.
+
+import csv
+import json
+import datetime
+from collections import OrderedDict
+
+from selfspy import config as cfg
+
+FORMATS = ['jsonl', 'csv', 'tsv']
+
+
+def plain(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+class Writer:
+    def __init__(self, fields, stream):
+        self.fields = fields
+        self.stream = stream
+        self.buffer = []
+        self.size = 0
+        self.rows = 0
+
+    def write(self, line):
+        self.buffer.append(line)
+        self.size += len(line)
+
+    def row(self, values):
+        self.write_row(values)
+        self.rows += 1
+        if self.rows == 1 or self.size >= cfg.OUTPUT_BUFFER_BYTES:
+            self.flush()
+
+    def flush(self):
+        self.stream.write(''.join(self.buffer))
+        self.stream.flush()
+        self.buffer = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+
+
+class JsonLines(Writer):
+    def write_row(self, values):
+        self.write(json.dumps(OrderedDict(zip(self.fields, values)), default=plain) + '\n')
+
+
+class Delimited(Writer):
+    def __init__(self, fields, stream, dialect):
+        Writer.__init__(self, fields, stream)
+        # csv calls self.write with every formatted line
+        self.csv = csv.writer(self, dialect, lineterminator='\n')
+        self.csv.writerow(fields)
+
+    def write_row(self, values):
+        self.csv.writerow([plain(value) for value in values])
+
+
+def make_writer(fmt, fields, stream):
+    """ A writer of rows with the given fields in fmt, one of FORMATS, to
+        the byte stream stream """
+    if fmt == 'jsonl':
+        return JsonLines(fields, stream)
+    return Delimited(fields, stream, 'excel-tab' if fmt == 'tsv' else 'excel')
@@ -15,7 +15,21 @@
 # You should have received a copy of the GNU General Public License
 # along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
 
+# Period computes the union of the active intervals [time, time + cutoff]
+# one time at a time. unions does the same for many groups of times at once
+# with numpy: the times are sorted by group and time, and a new interval
+# starts wherever the group changes or a time comes after the end of the
+# interval before it. Periods collects the times of the groups of a
+# selfstats summary and hands them to unions, or to a Period per group when
+# numpy is not installed.
+
 import bisect
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Period:
@@ -35,7 +49,7 @@ class Period:
             return False
 
         def maybe_merge(i):
-            if ltimes > i + 1:
+            if len(self.times) > i + 1:
                 if self.times[i][1] >= self.times[i + 1][0]:
                     self.times[i] = (self.times[i][0], self.times[i + 1][1])
                     self.times.pop(i + 1)
@@ -59,3 +73,92 @@ class Period:
 
     def calc_total(self):
         return sum(t2 - t1 for t1, t2 in self.times)
+
+
+class Union:
+    """ The active intervals of a group as computed by unions, read like a
+        Period """
+
+    def __init__(self, starts, ends, total):
+        self.starts = starts
+        self.ends = ends
+        self.total = total
+
+    @property
+    def times(self):
+        return zip(self.starts.tolist(), self.ends.tolist())
+
+    def calc_total(self):
+        return self.total
+
+
+def unions(groups, times, cutoff, maxtime):
+    """ The union of the intervals [time, min(time + cutoff, maxtime)] of
+        every group, the same intervals and totals as a Period fed the times
+        of the group. groups is an array of group numbers from 0, times an
+        array of the times of the groups. Returns a list with a Union for
+        every group number up to the largest. """
+    groups = numpy.asarray(groups)
+    times = numpy.asarray(times, dtype=numpy.float64)
+    nr_groups = int(groups.max()) + 1 if len(groups) else 0
+    order = numpy.lexsort((times, groups))
+    times = times[order]
+    groups = groups[order]
+    del order
+
+    # the ends grow with the times of a group, so the end of the interval
+    # before a time is the end of the time before it
+    ends = numpy.minimum(times + cutoff, maxtime)
+    new = numpy.ones(len(times), dtype=bool)
+    new[1:] = (groups[1:] != groups[:-1]) | (times[1:] > ends[:-1])
+    first = numpy.flatnonzero(new)
+    del new
+    starts = times[first]
+    ends = ends[numpy.append(first[1:], len(times)) - 1]
+    groups = groups[first]
+
+    # bincount adds up the lengths in order, like Period.calc_total
+    totals = numpy.bincount(groups, weights=ends - starts, minlength=nr_groups)
+    bounds = numpy.searchsorted(groups, numpy.arange(nr_groups + 1))
+    return [Union(starts[bounds[i]:bounds[i + 1]], ends[bounds[i]:bounds[i + 1]], float(totals[i]))
+            for i in xrange(nr_groups)]
+
+
+def empty_period(cutoff, maxtime):
+    if numpy is None:
+        return Period(cutoff, maxtime)
+    empty = numpy.zeros(0)
+    return Union(empty, empty, 0.0)
+
+
+class Periods:
+    """ Collects times for any number of groups, named by any hashable key,
+        and computes the active intervals of all of them at once """
+
+    def __init__(self, cutoff, maxtime):
+        self.cutoff = cutoff
+        self.maxtime = maxtime
+        self.keys = {}
+        self.groups = array('i')
+        self.times = array('d')
+
+    def extend(self, key, times):
+        group = self.keys.setdefault(key, len(self.keys))
+        self.times.extend(times)
+        self.groups.extend([group] * (len(self.times) - len(self.groups)))
+
+    def calc(self):
+        """ Returns {key: Union or Period} for every key given to extend """
+        if not self.times:
+            periods = []
+        elif numpy is None:
+            periods = [Period(self.cutoff, self.maxtime) for _ in self.keys]
+            for group, time in zip(self.groups, self.times):
+                periods[group].append(time)
+        else:
+            periods = unions(numpy.frombuffer(self.groups, dtype=numpy.intc),
+                             numpy.frombuffer(self.times, dtype=numpy.float64),
+                             self.cutoff, self.maxtime)
+        periods.extend(empty_period(self.cutoff, self.maxtime)
+                       for _ in xrange(len(self.keys) - len(periods)))
+        return dict((key, periods[group]) for key, group in self.keys.items())
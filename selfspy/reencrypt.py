@@ -0,0 +1,213 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Re-encryption of every encrypted column for --change-password. Tables are
+# streamed in id order, one committed chunk at a time, and the position is
+# saved in the Reencryption table in the same transaction as the chunk, so an
+# interrupted run continues where it stopped when started again with the
+# same passwords.
+
+import multiprocessing
+
+from sqlalchemy import select, bindparam
+from Crypto.Cipher import Blowfish
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy import shards
+from selfspy.check_password import MAGIC_STRING
+from selfspy.models import Reencryption
+
+ENCRYPTED_COLUMNS = [
+    (models.Keys, ['text', 'keys']),
+    (models.Window, ['title']),
+    (models.Clipboard, ['clipboard_content']),
+    (models.KeySymbol, ['symbol']),
+    (models.ClipboardContent, ['content']),
+    (models.JournalSegment, ['pending']),
+]
+
+# Keyed hash columns, recomputed under the new password from the plain value
+# of the first encrypted column of their table
+KEYED_HASHES = {
+    u'clipboardcontent': ('digest', models.content_digest),
+    u'window': ('title_hash', models.stored_title_hash),
+}
+
+DONE = u'done'
+
+_old_cipher = None
+_new_cipher = None
+_new_lookup_key = None
+
+
+def _init_ciphers(old_key, new_key):
+    global _old_cipher, _new_cipher, _new_lookup_key
+    _old_cipher = Blowfish.new(old_key) if old_key else None
+    _new_cipher = Blowfish.new(new_key) if new_key else None
+    _new_lookup_key = models.make_lookup_key(new_key or None)
+
+
+def _decrypt(blob):
+    if blob is not None and _old_cipher is not None:
+        blob = _old_cipher.decrypt(blob)
+    return blob
+
+
+def _encrypt(blob):
+    if blob is not None and _new_cipher is not None:
+        blob = _new_cipher.encrypt(models.pad(blob, 8))
+    return blob
+
+
+def _recrypt_rows(args):
+    table_name, rows = args
+    rehash = KEYED_HASHES.get(table_name)
+    done = []
+    for row in rows:
+        plain = [_decrypt(blob) for blob in row[1:]]
+        new = (row[0],) + tuple(_encrypt(blob) for blob in plain)
+        if rehash is not None:
+            new += (rehash[1](plain[0], _new_lookup_key),)
+        done.append(new)
+    return done
+
+
+def new_password_check(new_key):
+    """ Identifies the new password of a run without storing it """
+    if not new_key:
+        return ''
+    return Blowfish.new(new_key).encrypt(MAGIC_STRING)
+
+
+def in_progress(session_maker):
+    """ True if a password change was started and the password digest has
+        not been replaced yet """
+    session = session_maker()
+    try:
+        return session.query(Reencryption).count() > 0
+    finally:
+        session.close()
+
+
+def jobs(session_maker, shard_set=None):
+    """ The tables to re-encrypt as (name, session maker, model, columns):
+        those of the main database, then the ones of every shard """
+    todo = [(unicode(cls.__tablename__), session_maker, cls, columns)
+            for cls, columns in ENCRYPTED_COLUMNS]
+    if shard_set is not None:
+        for month in shard_set.months():
+            for cls, columns in ENCRYPTED_COLUMNS:
+                if cls in shards.FACT_MODELS:
+                    todo.append((u'%s/%s' % (shard_set.name(month), cls.__tablename__),
+                                 shard_set.session_maker(month), cls, columns))
+    return todo
+
+
+def reencrypt(session_maker, old_key, new_key,
+              chunk_size=cfg.REENCRYPT_CHUNK_SIZE,
+              workers=cfg.REENCRYPT_WORKERS,
+              shard_set=None):
+    """ Re-encrypts all encrypted columns from old_key to new_key (Blowfish
+        keys, None for no encryption), resuming an interrupted run. Raises
+        ValueError if an interrupted run was for another new password. Call
+        finish() once the password digest has been replaced. """
+    todo = jobs(session_maker, shard_set)
+    check = new_password_check(new_key)
+    session = session_maker()
+    state = session.query(Reencryption).first()
+    if state is None:
+        state = Reencryption(todo[0][0], 0, check)
+        session.add(state)
+        session.commit()
+    elif state.check != check:
+        session.close()
+        raise ValueError('An interrupted password change to another password is in progress. Use the same new password to finish it.')
+
+    _init_ciphers(old_key, new_key)
+    pool = None
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_ciphers, (old_key, new_key))
+
+    try:
+        names = [name for name, _, _, _ in todo]
+        session.close()
+        for i, (name, maker, cls, columns) in enumerate(todo):
+            # shard sessions see the Reencryption table of the main database,
+            # so the position is committed together with each chunk
+            session = maker()
+            state = session.query(Reencryption).first()
+            if state.table == DONE or names.index(state.table) > i:
+                session.close()
+                continue
+            print('Re-encrypting %s...' % name)
+            next_table = names[i + 1] if i + 1 < len(names) else DONE
+            reencrypt_table(session, state, cls.__table__, columns, next_table,
+                            chunk_size, pool, workers)
+            session.close()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        session.close()
+
+
+def reencrypt_table(session, state, table, columns, next_table, chunk_size, pool, workers):
+    id_col = table.c.id
+    query = select([id_col] + [table.c[name] for name in columns]).order_by(id_col).limit(chunk_size)
+    table_name = unicode(table.name)
+    if table_name in KEYED_HASHES:
+        columns = columns + [KEYED_HASHES[table_name][0]]
+    update = table.update().where(id_col == bindparam('_id')).values(
+        dict((name, bindparam('_' + name)) for name in columns))
+
+    while True:
+        rows = [tuple(row) for row in session.execute(query.where(id_col > state.last_id))]
+        if not rows:
+            state.table = next_table
+            state.last_id = 0
+            session.commit()
+            return
+
+        if pool is None:
+            done = _recrypt_rows((table_name, rows))
+        else:
+            step = -(-len(rows) // workers)
+            done = []
+            for part in pool.map(_recrypt_rows, [(table_name, rows[j:j + step])
+                                                 for j in range(0, len(rows), step)]):
+                done.extend(part)
+
+        params = []
+        for row in done:
+            param = {'_id': row[0]}
+            for name, blob in zip(columns, row[1:]):
+                param['_' + name] = blob
+            params.append(param)
+        session.execute(update, params)
+        state.last_id = rows[-1][0]
+        session.commit()
+
+
+def finish(session_maker):
+    """ Forgets the finished run, after the password digest was replaced """
+    session = session_maker()
+    session.query(Reencryption).delete()
+    session.commit()
+    session.close()
@@ -0,0 +1,287 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Retention policies. Each policy downsamples the rows older than a number
+# of days: DropText blanks the text and keys of key sequences and keeps their
+# timings, so activity and keystroke counts stay as they were, and
+# DropDetail deletes key sequences, clicks, clipboard events and per-minute
+# rollups, leaving the per-hour rollups that selfstats summaries are read
+# from. Rows are visited in id order a chunk at a time, and the position is
+# kept in the Retention table, so a run can stop after any chunk and the next
+# one continues there.
+
+import os
+import time
+import datetime
+
+from sqlalchemy import func
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy import rollup
+from selfspy import shards
+from selfspy.models import (Keys, Click, Clipboard, ClipboardContent,
+                            MinuteActivity, Retention, BodyToken)
+
+
+class DropText:
+    """ Blanks the text and keys of key sequences """
+
+    name = u'text'
+    models = [Keys]
+
+    def __init__(self, days):
+        self.days = days
+
+    def describe(self):
+        return 'drop the text of keystrokes older than %d days' % self.days
+
+    def apply(self, session, cls, ids):
+        session.execute(cls.__table__.update().where(cls.id.in_(ids)).values(
+            text=models.maybe_encrypt(''),
+            keys=models.maybe_encrypt(models.encode_key_codes([]))))
+        drop_tokens(session, cls, ids)
+
+
+class DropDetail:
+    """ Deletes events and per-minute rollups, keeping per-hour rollups """
+
+    name = u'detail'
+    models = [Keys, Click, Clipboard]
+
+    def __init__(self, days):
+        self.days = days
+
+    def describe(self):
+        return 'keep only hourly activity of events older than %d days' % self.days
+
+    def apply(self, session, cls, ids):
+        session.execute(cls.__table__.delete().where(cls.id.in_(ids)))
+        drop_tokens(session, cls, ids)
+
+
+def drop_tokens(session, cls, ids):
+    """ Removes the search index entries of dropped text """
+    if cls is Keys:
+        session.execute(BodyToken.__table__.delete().where(BodyToken.keys_id.in_(ids)))
+
+
+def policies(text_days=cfg.RETENTION_TEXT_DAYS, detail_days=cfg.RETENTION_DETAIL_DAYS):
+    found = []
+    if text_days is not None:
+        found.append(DropText(text_days))
+    if detail_days is not None:
+        found.append(DropDetail(detail_days))
+    return found
+
+
+def horizon(policy, now):
+    """ Rows created before this are downsampled by policy. Whole hours, so
+        every dropped event is summarized by a complete HourActivity row. """
+    return (now - datetime.timedelta(days=policy.days)).replace(minute=0, second=0, microsecond=0)
+
+
+def horizons(session):
+    """ Returns {policy name: horizon} of the policies that have been applied """
+    found = {}
+    for state in session.query(Retention).filter(Retention.horizon != None):
+        name = state.name.split('/')[-2]
+        found[name] = max(found.get(name, state.horizon), state.horizon)
+    return found
+
+
+class Deadline:
+    def __init__(self, max_seconds):
+        self.end = None if max_seconds is None else time.time() + max_seconds
+
+    def passed(self):
+        return self.end is not None and time.time() > self.end
+
+
+def get_state(session, name):
+    state = session.query(Retention).filter(Retention.name == name).first()
+    if state is None:
+        state = Retention(name)
+        session.add(state)
+    return state
+
+
+def vacuum(session):
+    """ Returns freed pages to the file system. Needs auto_vacuum, which
+        SQLite only turns on for new databases or with a full VACUUM;
+        otherwise the freed pages are reused for new rows. Returns False if
+        auto_vacuum is off. """
+    if session.execute('PRAGMA auto_vacuum').scalar() != 2:
+        return False
+    session.execute('PRAGMA incremental_vacuum(%d)' % cfg.RETENTION_VACUUM_PAGES)
+    return True
+
+
+def apply_table(session, label, policy, cls, until, chunk_size, deadline):
+    """ Applies policy to the rows of cls created before until, a chunk at a
+        time. Stops at the first row created after until, which normally is
+        the end of the old rows as ids grow with time. Returns the number of
+        rows changed, or None if the deadline passed first. """
+    state = get_state(session, u'%s%s/%s' % (label, policy.name, cls.__tablename__))
+    changed = 0
+    while True:
+        rows = session.query(cls.id, cls.created_at).filter(
+            cls.id > state.last_id).order_by(cls.id).limit(chunk_size).all()
+        old = []
+        for row in rows:
+            if row.created_at >= until:
+                break
+            old.append(row.id)
+        if old:
+            policy.apply(session, cls, old)
+            state.last_id = old[-1]
+            changed += len(old)
+        state.horizon = until
+        session.commit()
+        vacuum(session)
+        if len(old) < chunk_size:
+            return changed
+        if deadline.passed():
+            return None
+
+
+def prune_minutes(session, until, chunk_size, deadline):
+    """ Deletes the per-minute rollups before until. Returns False if the
+        deadline passed first. """
+    table = MinuteActivity.__table__
+    while True:
+        deleted = session.execute(
+            'DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s WHERE bucket < :until LIMIT :n)'
+            % (table.name, table.name), {'until': until, 'n': chunk_size}).rowcount
+        session.commit()
+        vacuum(session)
+        if deleted < chunk_size:
+            return True
+        if deadline.passed():
+            return False
+
+
+def prune_contents(session, readers, chunk_size):
+    """ Deletes the clipboard contents no clipboard event refers to anymore.
+        readers are sessions on the main database and every shard. """
+    last_id = 0
+    while True:
+        ids = [row[0] for row in session.query(ClipboardContent.id).filter(
+            ClipboardContent.id > last_id).order_by(ClipboardContent.id).limit(chunk_size)]
+        if not ids:
+            return
+        used = set()
+        for reader in readers:
+            used.update(row[0] for row in reader.query(Clipboard.content_id).filter(
+                Clipboard.content_id.in_(ids)).distinct())
+        unused = [i for i in ids if i not in used]
+        if unused:
+            session.query(ClipboardContent).filter(
+                ClipboardContent.id.in_(unused)).delete(synchronize_session=False)
+            session.commit()
+            vacuum(session)
+        last_id = ids[-1]
+
+
+def estimate(session_maker, shard_set, policy, now=None):
+    """ The number of rows policy would change now """
+    until = horizon(policy, now or datetime.datetime.now())
+    count = 0
+    labels = [(u'', session_maker)] + [(shard_set.name(month) + u'/', shard_set.session_maker(month))
+                                       for month in shard_set.months()]
+    for label, maker in labels:
+        session = maker()
+        for cls in policy.models:
+            state = session.query(Retention).filter(
+                Retention.name == u'%s%s/%s' % (label, policy.name, cls.__tablename__)).first()
+            count += session.query(func.count(cls.id)).filter(
+                cls.id > (state.last_id if state else 0), cls.created_at < until).scalar()
+        session.close()
+    return count
+
+
+def run(session_maker, shard_set, todo, max_seconds=None, chunk_size=cfg.RETENTION_CHUNK_SIZE,
+        now=None, verbose=True):
+    """ Applies the policies in todo to the main database and the shards of
+        shard_set. With max_seconds, stops after the first chunk that ends
+        later than that. Returns True if everything was done. """
+    now = now or datetime.datetime.now()
+    deadline = Deadline(max_seconds)
+    main = session_maker()
+    try:
+        for policy in todo:
+            until = horizon(policy, now)
+            if isinstance(policy, DropDetail) and not covered(main, shard_set):
+                print ('Not dropping events older than %d days: the activity rollups do not cover them yet. Run selfspy --backfill-rollups first.' % policy.days)
+                continue
+            if verbose:
+                print ('Retention: %s (before %s)' % (policy.describe(), until))
+
+            labels = [(u'', main)]
+            deleted_clipboard = False
+            current = shards.month_of(datetime.datetime.now())
+            for month in shard_set.months():
+                label = shard_set.name(month) + u'/'
+                if (isinstance(policy, DropDetail) and month != current
+                        and shards.month_start(shards.next_month(month)) <= until):
+                    drop_shard(main, shard_set, month, label)
+                    deleted_clipboard = True
+                    continue
+                labels.append((label, shard_set.session_maker(month)()))
+
+            for label, session in labels:
+                for cls in policy.models:
+                    changed = apply_table(session, label, policy, cls, until, chunk_size, deadline)
+                    if changed is None:
+                        return False
+                    if cls is Clipboard and changed:
+                        deleted_clipboard = True
+
+            if isinstance(policy, DropDetail):
+                if not prune_minutes(main, until, chunk_size, deadline):
+                    return False
+                if deleted_clipboard:
+                    prune_contents(main, [session for _, session in labels], chunk_size)
+        if verbose and main.execute('PRAGMA auto_vacuum').scalar() != 2:
+            print ('The database was created without incremental vacuum, so freed space is reused but the file does not shrink. Run VACUUM on it once with the sqlite3 tool to change that.')
+        return True
+    finally:
+        main.close()
+
+
+def covered(main, shard_set):
+    """ True if the activity rollups cover all events of the main database
+        and every shard """
+    sources = [main] + [shard_set.session_maker(month)() for month in shard_set.months()]
+    try:
+        return rollup.covers(main, None, sources)
+    finally:
+        for session in sources[1:]:
+            session.close()
+
+
+def drop_shard(main, shard_set, month, label):
+    """ Removes a shard that only holds events older than DropDetail's
+        horizon. The logger only writes to the shard of the current month,
+        which is never dropped. """
+    shard_set.close(month)
+    path = shard_set.path(month)
+    for fname in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(fname):
+            os.remove(fname)
+    main.query(Retention).filter(Retention.name.like(label + u'%')).delete(synchronize_session=False)
+    main.commit()
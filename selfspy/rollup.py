@@ -0,0 +1,388 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-minute and per-hour activity rollups. The logger counts every stored
+# key sequence and click in a Rollups object and writes the counts into
+# MinuteActivity and HourActivity in the same transaction as the rows, so
+# selfstats can summarize long periods without reading Keys and Click.
+
+import time
+import bisect
+import datetime
+import heapq
+import itertools
+import threading
+
+from sqlalchemy import and_, bindparam, func
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy.models import Keys, Click, MinuteActivity, HourActivity, ROLLUP_COUNTS
+
+FIELDS = ROLLUP_COUNTS + ('active_seconds',)
+KEYSTROKES, KEY_ROWS, CLICKS = 0, 1, 2
+MOUSINGS = FIELDS.index('mousings')
+ACTIVE = FIELDS.index('active_seconds')
+
+
+def timestamp(dt):
+    return time.mktime(dt.timetuple())
+
+
+def key_times(created_at, timings):
+    """ The times of the keystrokes of a Keys row, oldest first, the way
+        selfstats has always computed them """
+    current_time = timestamp(created_at)
+    abs_times = [current_time]
+    for t in timings:
+        current_time -= t
+        abs_times.append(current_time)
+    abs_times.reverse()
+    return abs_times
+
+
+def minute_of(t):
+    return datetime.datetime.fromtimestamp(t - t % 60)
+
+
+class ActiveTime:
+    """ Stands in for a Period when the active time comes from rollups """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def calc_total(self):
+        return self.seconds
+
+
+class Rollups:
+    """ Pending rollup counts, keyed by (minute, process_id, window_id).
+        Every event is counted for its window, its process and the total (see
+        models.RollupMixin). Active time is counted as the part of
+        [time, time + cutoff] not yet covered by earlier events of the same
+        group, so the buckets of a group add up to the same union of intervals
+        that a Period computes. Thread safe. """
+
+    def __init__(self, cutoff=cfg.ROLLUP_ACTIVE_SECONDS, horizon=cfg.ROLLUP_HORIZON):
+        self.cutoff = cutoff
+        self.horizon = horizon
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.covered = {}  # (process_id, window_id) -> sorted disjoint [start, end] lists
+        self.newest = 0
+        self.pruned = 0
+
+    def add_keys(self, process_id, window_id, created_at, timings):
+        times = key_times(created_at, timings)
+        groups = self.groups(process_id, window_id)
+        with self.lock:
+            self.count(timestamp(created_at), groups, KEY_ROWS, 1)
+            for t in times[1:]:
+                self.count(t, groups, KEYSTROKES, 1)
+            for t in times:
+                self.activate(t, groups)
+
+    def add_click(self, process_id, window_id, created_at, button, nrmoves):
+        t = timestamp(created_at)
+        groups = self.groups(process_id, window_id)
+        with self.lock:
+            self.count(t, groups, CLICKS, 1)
+            self.count(t, groups, MOUSINGS, nrmoves)
+            if 1 <= button <= 7:
+                self.count(t, groups, FIELDS.index('button%d' % button), 1)
+            self.activate(t, groups)
+
+    def seed_start(self, session):
+        """ The time from which seed has to read rows, or None if nothing
+            has been rolled up yet. The last minute with rollups holds the end
+            of the activity of the last event, which is at most a cutoff
+            earlier, and only events another cutoff before that can overlap
+            the events to come. """
+        last = session.query(func.max(MinuteActivity.bucket)).scalar()
+        if last is None:
+            return None
+        return last - datetime.timedelta(seconds=2 * self.cutoff)
+
+    def seed(self, since, sources):
+        """ Covers the activity of the Keys and Click rows stored from since
+            on in the sessions of sources without counting it again, so
+            events logged after a restart do not count time that the previous
+            run already counted. since comes from seed_start. """
+        for source in sources:
+            for row in source.query(Keys.created_at, Keys.timings, Keys.process_id,
+                                    Keys.window_id).filter(Keys.created_at >= since):
+                self.add_keys(row.process_id, row.window_id, row.created_at,
+                              models.decode_timings(row.timings))
+            for row in source.query(Click.created_at, Click.button, Click.process_id,
+                                    Click.window_id).filter(Click.created_at >= since):
+                self.add_click(row.process_id, row.window_id, row.created_at, row.button, 0)
+        with self.lock:
+            self.pending = {}
+
+    def groups(self, process_id, window_id):
+        return [(0, 0), (process_id, 0), (process_id, window_id)]
+
+    def count(self, t, groups, field, n):
+        minute = minute_of(t)
+        for group in groups:
+            self.bucket(minute, group)[field] += n
+
+    def bucket(self, minute, group):
+        key = (minute,) + group
+        counts = self.pending.get(key)
+        if counts is None:
+            counts = self.pending[key] = [0] * len(FIELDS)
+        return counts
+
+    def activate(self, t, groups):
+        if t > self.newest:
+            self.newest = t
+            if t - self.pruned > self.cutoff:
+                self.prune()
+        for group in groups:
+            for start, end in self.cover(group, t, t + self.cutoff):
+                while start < end:
+                    minute_end = min(end, start - start % 60 + 60)
+                    self.bucket(minute_of(start), group)[ACTIVE] += minute_end - start
+                    start = minute_end
+
+    def cover(self, group, start, end):
+        """ Adds [start, end] to the covered intervals of group and returns
+            the pieces of it that were not covered before """
+        intervals = self.covered.setdefault(group, [])
+        i = bisect.bisect_left(intervals, [start])
+        if i > 0 and intervals[i - 1][1] >= start:
+            i -= 1
+        new = []
+        pos = start
+        j = i
+        while j < len(intervals) and intervals[j][0] <= end:
+            if intervals[j][0] > pos:
+                new.append((pos, intervals[j][0]))
+            pos = max(pos, intervals[j][1])
+            j += 1
+        if pos < end:
+            new.append((pos, end))
+        merged = [min(start, intervals[i][0]) if i < j else start,
+                  max(end, intervals[j - 1][1]) if i < j else end]
+        intervals[i:j] = [merged]
+        return new
+
+    def prune(self):
+        """ Forgets intervals too old to be overlapped by new events """
+        self.pruned = self.newest
+        limit = self.newest - self.horizon - self.cutoff
+        for group, intervals in self.covered.items():
+            while intervals and intervals[0][1] < limit:
+                intervals.pop(0)
+            if not intervals:
+                del self.covered[group]
+
+    def flush(self, session):
+        """ Adds the pending counts to the rollup tables in session and
+            returns them, to be given to restore() if the commit fails """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            hours = {}
+            for (minute, process_id, window_id), counts in pending.iteritems():
+                key = (minute.replace(minute=0), process_id, window_id)
+                total = hours.get(key)
+                if total is None:
+                    hours[key] = list(counts)
+                else:
+                    for i, n in enumerate(counts):
+                        total[i] += n
+            write(session, MinuteActivity, pending)
+            write(session, HourActivity, hours)
+        return pending
+
+    def restore(self, pending):
+        """ Puts counts returned by flush() back after a failed commit """
+        with self.lock:
+            for key, counts in pending.iteritems():
+                total = self.bucket(key[0], key[1:])
+                for i, n in enumerate(counts):
+                    total[i] += n
+
+    def clear(self):
+        with self.lock:
+            self.pending = {}
+            self.covered = {}
+            self.newest = 0
+            self.pruned = 0
+
+
+def write(session, cls, buckets):
+    table = cls.__table__
+    c = table.c
+    values = dict((name, c[name] + bindparam('_' + name)) for name in ROLLUP_COUNTS)
+    values['active_seconds'] = func.min(c.active_seconds + bindparam('_active_seconds'), cls.length)
+    update = table.update().where(and_(
+        c.bucket == bindparam('_bucket'),
+        c.process_id == bindparam('_process_id'),
+        c.window_id == bindparam('_window_id'))).values(values)
+
+    inserts = []
+    for (bucket, process_id, window_id), counts in buckets.iteritems():
+        params = dict(('_' + name, n) for name, n in zip(FIELDS, counts))
+        params.update(_bucket=bucket, _process_id=process_id, _window_id=window_id)
+        if session.execute(update, params).rowcount == 0:
+            row = dict(zip(FIELDS, counts))
+            row['active_seconds'] = min(row['active_seconds'], cls.length)
+            row.update(bucket=bucket, process_id=process_id, window_id=window_id)
+            inserts.append(row)
+    if inserts:
+        session.execute(table.insert(), inserts)
+
+
+def merge_windows(session, merged):
+    """ Adds the rollups of the windows in merged, {old id: new id}, to the
+        rollups of the new ids, without committing """
+    for cls in (MinuteActivity, HourActivity):
+        moved = session.query(cls).filter(cls.window_id.in_(list(merged)))
+        buckets = {}
+        for row in moved:
+            key = (row.bucket, row.process_id, merged[row.window_id])
+            counts = buckets.setdefault(key, [0] * len(FIELDS))
+            for i, name in enumerate(FIELDS):
+                counts[i] += getattr(row, name)
+        moved.delete(synchronize_session=False)
+        write(session, cls, buckets)
+
+
+def first_bucket(session):
+    """ The first minute with rollups, or None if there are none """
+    return session.query(func.min(MinuteActivity.bucket)).scalar()
+
+
+def earliest(sources):
+    """ The creation time of the oldest Keys or Click row in the sessions of
+        sources, or None if there are none """
+    found = [t for source in sources
+             for t in (source.query(func.min(Keys.created_at)).scalar(),
+                       source.query(func.min(Click.created_at)).scalar())
+             if t is not None]
+    return min(found) if found else None
+
+
+def backfill(session, chunk_size=cfg.ROLLUP_BACKFILL_CHUNK, sources=None, kept=None):
+    """ Rebuilds the rollup tables from the Keys and Click rows, committing
+        every chunk_size rows. The rows are read from the sessions in sources
+        (oldest rows first, as from ShardSet.readers) or else from session.
+        The rollups before the hour of the oldest row, and before kept (the
+        horizon of retention.DropDetail), count events that were dropped and
+        are left as they are. Returns the number of rows counted. """
+    if sources is None:
+        sources = [session]
+    start = earliest(sources)
+    if start is None:
+        return 0
+    start = start.replace(minute=0, second=0, microsecond=0)
+    if kept is not None:
+        start = max(start, kept)
+    session.query(MinuteActivity).filter(MinuteActivity.bucket >= start).delete()
+    session.query(HourActivity).filter(HourActivity.bucket >= start).delete()
+    session.commit()
+
+    def stream(query, id_col):
+        last_id = 0
+        while True:
+            rows = query.filter(id_col > last_id).order_by(id_col).limit(chunk_size).all()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            last_id = rows[-1].id
+
+    keys = itertools.chain.from_iterable(
+        stream(source.query(Keys.id, Keys.created_at, Keys.timings,
+                            Keys.process_id, Keys.window_id).filter(Keys.created_at >= start), Keys.id)
+        for source in sources)
+    clicks = itertools.chain.from_iterable(
+        stream(source.query(Click.id, Click.created_at, Click.button, Click.nrmoves,
+                            Click.process_id, Click.window_id).filter(Click.created_at >= start), Click.id)
+        for source in sources)
+
+    rollups = Rollups()
+    counted = 0
+    events = heapq.merge(((row.created_at, 0, row) for row in keys),
+                         ((row.created_at, 1, row) for row in clicks))
+    for created_at, kind, row in events:
+        if kind == 0:
+            rollups.add_keys(row.process_id, row.window_id, created_at,
+                             models.decode_timings(row.timings))
+        else:
+            rollups.add_click(row.process_id, row.window_id, created_at,
+                              row.button, row.nrmoves)
+        counted += 1
+        if counted % chunk_size == 0:
+            rollups.flush(session)
+            session.commit()
+    rollups.flush(session)
+    session.commit()
+    return counted
+
+
+def totals(session, start=None, end=None):
+    """ Sums the rollups of [start, end) per (process_id, window_id), where
+        start and end are whole minutes or None for an open end. Whole hours
+        are read from HourActivity and the minutes around them from
+        MinuteActivity. Returns {(process_id, window_id): [FIELDS...]}. """
+    hour_from = start
+    if start is not None and (start.minute or start.second):
+        hour_from = start.replace(minute=0, second=0) + datetime.timedelta(hours=1)
+    hour_to = end
+    if end is not None:
+        hour_to = end.replace(minute=0, second=0)
+
+    if hour_from is not None and hour_to is not None and hour_from >= hour_to:
+        parts = [(MinuteActivity, start, end)]
+    else:
+        parts = [(HourActivity, hour_from, hour_to)]
+        if start is not None and start < hour_from:
+            parts.append((MinuteActivity, start, hour_from))
+        if end is not None and hour_to < end:
+            parts.append((MinuteActivity, hour_to, end))
+
+    result = {}
+    for cls, part_start, part_end in parts:
+        q = session.query(cls.process_id, cls.window_id,
+                          *[func.sum(getattr(cls, name)) for name in FIELDS])
+        if part_start is not None:
+            q = q.filter(cls.bucket >= part_start)
+        if part_end is not None:
+            q = q.filter(cls.bucket < part_end)
+        for row in q.group_by(cls.process_id, cls.window_id):
+            counts = result.setdefault(tuple(row[:2]), [0] * len(FIELDS))
+            for i, n in enumerate(row[2:]):
+                counts[i] += n or 0
+    return result
+
+
+def covers(session, start, sources=None):
+    """ True if the rollups hold everything stored from start (None for the
+        beginning) on in the sessions of sources, or else in session.
+        Rollups start with the first event logged by a version that keeps
+        them, unless they were backfilled. """
+    first = first_bucket(session)
+    if first is None:
+        return False
+    if start is not None and start >= first:
+        return True
+    oldest = earliest([session] if sources is None else sources)
+    return oldest is None or oldest.replace(second=0, microsecond=0) >= first
@@ -0,0 +1,130 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Monthly shard files. With selfspy --shards the Keys, Click and Clipboard
+# rows of each month are written to a file of their own, named YYYY-MM.sqlite
+# in cfg.SHARD_DIR. The main database keeps the processes, windows,
+# geometries and everything else, and the rows stored before sharding was
+# turned on. A shard is opened with the main database attached, so
+# unqualified table names find the rows of the shard and the dimensions of
+# the main database. Only the shard of the current month is written to;
+# older ones can be made read-only or moved elsewhere and linked back.
+
+import os
+import re
+import datetime
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import sessionmaker
+
+from selfspy import config as cfg
+from selfspy import models
+
+FACT_MODELS = [models.Keys, models.Click, models.Clipboard]
+FACT_TABLES = [cls.__table__ for cls in FACT_MODELS] + [models.BodyToken.__table__]
+
+SHARD_NAME = re.compile(r'^(\d{4})-(\d{2})\.sqlite$')
+
+
+def month_of(dt):
+    return dt.year, dt.month
+
+
+def month_start(month):
+    return datetime.datetime(month[0], month[1], 1)
+
+
+def next_month(month):
+    year, mon = month
+    if mon == 12:
+        return year + 1, 1
+    return year, mon + 1
+
+
+class ShardSet:
+    def __init__(self, db_name, profile=cfg.STORAGE_PROFILE):
+        self.db_name = os.path.abspath(db_name)
+        self.directory = os.path.join(os.path.dirname(self.db_name), cfg.SHARD_DIR)
+        self.profile = profile
+        self.makers = {}
+        self.last_ids = None
+
+    def name(self, month):
+        return u'%04d-%02d' % month
+
+    def path(self, month):
+        return os.path.join(self.directory, '%s.sqlite' % self.name(month))
+
+    def months(self):
+        """ The months that have a shard file, oldest first """
+        if not os.path.isdir(self.directory):
+            return []
+        found = [SHARD_NAME.match(fname) for fname in os.listdir(self.directory)]
+        return sorted((int(m.group(1)), int(m.group(2))) for m in found if m)
+
+    def session_maker(self, month):
+        """ Sessions on the shard of month, creating it if needed """
+        maker = self.makers.get(month)
+        if maker is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            engine = models.make_engine(self.path(month), self.profile)
+
+            @event.listens_for(engine, 'connect')
+            def attach_main(dbapi_connection, connection_record):
+                dbapi_connection.execute('ATTACH DATABASE ? AS main_db', (self.db_name,))
+
+            models.Base.metadata.create_all(engine, tables=FACT_TABLES)
+            maker = self.makers[month] = sessionmaker(bind=engine)
+        return maker
+
+    def close(self, month):
+        """ Closes the pooled connections to the shard of month, whose
+            sessions must be closed already, and forgets its session maker """
+        maker = self.makers.pop(month, None)
+        if maker is not None:
+            maker.kw['bind'].dispose()
+
+    def readers(self, main_maker, start=None, end=None):
+        """ Session makers for the rows of [start, end) (None for an open
+            end): the main database, then the shards of the months that
+            overlap, oldest first """
+        makers = [main_maker]
+        for month in self.months():
+            if end is not None and month_start(month) >= end:
+                continue
+            if start is not None and month_start(next_month(month)) <= start:
+                continue
+            makers.append(self.session_maker(month))
+        return makers
+
+    def next_id(self, row):
+        """ A row id for row that is unique over the main database and all
+            shards, so rows keep telling apart when shards are read together """
+        if self.last_ids is None:
+            self.last_ids = {}
+            makers = [sessionmaker(bind=models.make_engine(self.db_name, self.profile))]
+            makers.extend(self.session_maker(month) for month in self.months())
+            for maker in makers:
+                session = maker()
+                for cls in FACT_MODELS:
+                    last = session.query(func.max(cls.id)).scalar() or 0
+                    self.last_ids[cls] = max(self.last_ids.get(cls, 0), last)
+                session.close()
+        cls = type(row)
+        self.last_ids[cls] += 1
+        return self.last_ids[cls]
@@ -18,13 +18,33 @@
 
 # This file is loosely based on examples/record_demo.py in python-xlib
 
+import os
 import sys
-
-from Xlib import X, XK, display
-from Xlib.ext import record
+import time
+import select
+import struct
+import threading
+
+from Xlib import threaded  # makes Display objects safe to share between threads
+from Xlib import X, XK, Xatom, display
+from Xlib.ext import record, xfixes
 from Xlib.error import XError
 from Xlib.protocol import rq
 
+from selfspy import config as cfg
+
+
+# RECORD hands us core events as 32 byte wire structs. KeyPress, ButtonPress
+# and MotionNotify share one layout: type, detail, sequence number, time,
+# root, event, child, root_x, root_y, event_x, event_y, state, same_screen.
+# The other core events are also 32 bytes; the ones we have no use for, like
+# the KeyRelease and ButtonRelease that come with our device_events range,
+# are stepped over without decoding them.
+EVENT_SIZE = 32
+INPUT_EVENT = struct.Struct('=BBHIIIIhhhhHBx')
+FAST_EVENTS = frozenset([X.KeyPress, X.ButtonPress, X.MotionNotify])
+SKIPPED_EVENTS = frozenset(range(X.KeyPress, X.LASTEvent)) - FAST_EVENTS - frozenset([X.MappingNotify])
+
 
 def state_to_idx(state):  # this could be a dict, but I might want to extend it.
     if state == 1:
@@ -47,6 +67,7 @@ class Sniffer:
         self.mouse_button_hook = lambda x: True
         self.mouse_move_hook = lambda x: True
         self.screen_hook = lambda x: True
+        self.selection_watcher = None
 
         self.contextEventMask = [X.KeyPress, X.MotionNotify]
 
@@ -56,6 +77,19 @@ class Sniffer:
 
         self.atom_NET_WM_NAME = self.the_display.intern_atom('_NET_WM_NAME')
         self.atom_UTF8_STRING = self.the_display.intern_atom('UTF8_STRING')
+        self.atom_NET_ACTIVE_WINDOW = self.the_display.intern_atom('_NET_ACTIVE_WINDOW')
+
+        # With an EWMH window manager, the active window, its title and its
+        # geometry are followed from X events on the_display (see
+        # track_focus), so input events need no X round trips. Otherwise we
+        # fall back to querying the focused window for every RECORD reply.
+        self.focus_tracking = False
+        self.window_info = {}  # window id -> [class, title, x, y, width, height]
+        # active window id -> id of the window it takes its WM_CLASS from
+        self.class_windows = {}
+        self.active_window = None
+        self.current_screen = None
+        self.last_screen = None
 
     def run(self):
         # Check if the extension is present
@@ -65,6 +99,8 @@ class Sniffer:
         else:
             print "RECORD extension present"
 
+        self.focus_tracking = self.start_focus_tracking()
+
         # Create a recording context; we only want key and mouse events
         self.ctx = self.record_display.record_create_context(
                 0,
@@ -101,34 +137,190 @@ class Sniffer:
             # not an event
             return
 
-        cur_class, cur_window, cur_name = self.get_cur_window()
-        if cur_class:
-            cur_geo = self.get_geometry(cur_window)
-            if cur_geo:
-                self.screen_hook(cur_class,
-                                 cur_name,
-                                 cur_geo.x,
-                                 cur_geo.y,
-                                 cur_geo.width,
-                                 cur_geo.height)
-
-        data = reply.data
-        while len(data):
-            ef = rq.EventField(None)
-            event, data = ef.parse_binary_value(data, self.record_display.display, None, None)
-            if event.type in [X.KeyPress]:
-                # X.KeyRelease, we don't log this anyway
-                self.key_hook(*self.key_event(event))
-            elif event.type in [X.ButtonPress]:
-                # X.ButtonRelease we don't log this anyway.
-                self.mouse_button_hook(*self.button_event(event))
-            elif event.type == X.MotionNotify:
-                self.mouse_move_hook(event.root_x, event.root_y)
-            elif event.type == X.MappingNotify:
-                self.the_display.refresh_keyboard_mapping()
-                newkeymap = self.the_display._keymap_codes
-                print 'Change keymap!', newkeymap == self.keymap
-                self.keymap = newkeymap
+        if self.focus_tracking:
+            screen = self.current_screen
+            if screen is not None and screen != self.last_screen:
+                self.last_screen = screen
+                self.screen_hook(*screen)
+        else:
+            cur_class, cur_window, cur_name = self.get_cur_window()
+            if cur_class:
+                cur_geo = self.get_geometry(cur_window)
+                if cur_geo:
+                    self.screen_hook(cur_class,
+                                     cur_name,
+                                     cur_geo.x,
+                                     cur_geo.y,
+                                     cur_geo.width,
+                                     cur_geo.height)
+
+        self.dispatch_events(reply.data)
+
+    def dispatch_events(self, data):
+        """ Walks the events in a RECORD reply. The event types we log are
+            unpacked straight from the buffer into the hooks and other core
+            events are skipped; only MappingNotify, unknown types and short
+            records go through python-xlib's generic parser. """
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+        unpack_from = INPUT_EVENT.unpack_from
+        while pos < end:
+            etype = ord(data[pos]) & 0x7f
+            if etype in SKIPPED_EVENTS and end - pos >= EVENT_SIZE:
+                pos += EVENT_SIZE
+            elif etype in FAST_EVENTS and end - pos >= EVENT_SIZE:
+                (etype, detail, sequence_number, _, _, _, _,
+                 root_x, root_y, _, _, state, _) = unpack_from(view, pos)
+                pos += EVENT_SIZE
+                etype &= 0x7f
+                if etype == X.KeyPress:
+                    self.key_hook(*self.key_event(detail, state, sequence_number))
+                elif etype == X.ButtonPress:
+                    self.mouse_button_hook(detail, root_x, root_y)
+                else:
+                    self.mouse_move_hook(root_x, root_y)
+            else:
+                # EventField only ever reads one 32 byte event, so don't copy
+                # the rest of the reply for it
+                chunk = data[pos:pos + EVENT_SIZE]
+                ef = rq.EventField(None)
+                event, rest = ef.parse_binary_value(chunk, self.record_display.display, None, None)
+                pos += len(chunk) - len(rest)
+                self.handle_event(event)
+
+    def handle_event(self, event):
+        if event.type in [X.KeyPress]:
+            # X.KeyRelease, we don't log this anyway
+            self.key_hook(*self.key_event(event.detail, event.state, event.sequence_number))
+        elif event.type in [X.ButtonPress]:
+            # X.ButtonRelease we don't log this anyway.
+            self.mouse_button_hook(event.detail, event.root_x, event.root_y)
+        elif event.type == X.MotionNotify:
+            self.mouse_move_hook(event.root_x, event.root_y)
+        elif event.type == X.MappingNotify:
+            self.the_display.refresh_keyboard_mapping(event)
+            newkeymap = self.the_display._keymap_codes
+            print 'Change keymap!', newkeymap == self.keymap
+            self.keymap = newkeymap
+
+    def watch_selections(self, hook):
+        """ Reports changes of the X selections to hook, see SelectionWatcher.
+            Returns False if the X server lacks the XFIXES extension. """
+        if not self.the_display.has_extension('XFIXES'):
+            return False
+        self.selection_watcher = SelectionWatcher(hook)
+        self.selection_watcher.start()
+        return True
+
+    def request_selection(self, selection='CLIPBOARD'):
+        """ Asks for the current content of selection, e.g. on a paste """
+        if self.selection_watcher is not None:
+            self.selection_watcher.request(selection)
+
+    def start_focus_tracking(self):
+        """ Starts following _NET_ACTIVE_WINDOW on the root window. Returns False
+            if the window manager does not maintain it. """
+        root = self.the_display.screen().root
+        try:
+            active = root.get_full_property(self.atom_NET_ACTIVE_WINDOW, X.AnyPropertyType)
+        except XError:
+            active = None
+        if active is None:
+            return False
+
+        root.change_attributes(event_mask=X.PropertyChangeMask)
+        self.root = root
+        self.update_active_window()
+
+        t = threading.Thread(target=self.track_focus)
+        t.daemon = True
+        t.start()
+        return True
+
+    def track_focus(self):
+        while True:
+            event = self.the_display.next_event()
+            try:
+                self.handle_focus_event(event)
+            except XError:
+                pass  # the window went away before we could ask about it
+
+    def handle_focus_event(self, event):
+        if event.type == X.PropertyNotify:
+            wid = event.window.id
+            if wid == self.root.id:
+                if event.atom == self.atom_NET_ACTIVE_WINDOW:
+                    self.update_active_window()
+            elif event.atom in (self.atom_NET_WM_NAME, Xatom.WM_NAME):
+                info = self.window_info.get(wid)
+                if info is not None:
+                    info[1] = self.get_wm_name(event.window) or u''
+                    self.publish_screen(wid)
+        elif event.type == X.ConfigureNotify:
+            info = self.window_info.get(event.window.id)
+            if info is not None:
+                info[2:] = [event.x, event.y, event.width, event.height]
+                self.publish_screen(event.window.id)
+        elif event.type == X.DestroyNotify:
+            self.window_info.pop(event.window.id, None)
+            for wid, class_wid in self.class_windows.items():
+                if class_wid == event.window.id:
+                    del self.class_windows[wid]
+            if event.window.id == self.active_window:
+                self.active_window = None
+                self.current_screen = None
+        elif event.type == X.MappingNotify:
+            self.the_display.refresh_keyboard_mapping(event)
+            self.keymap = self.the_display._keymap_codes
+
+    def update_active_window(self):
+        prop = self.root.get_full_property(self.atom_NET_ACTIVE_WINDOW, X.AnyPropertyType)
+        if prop is None or not len(prop.value) or not prop.value[0]:
+            self.active_window = None
+            self.current_screen = None
+            return
+
+        wid = self.class_windows.get(prop.value[0])
+        if wid is None:
+            win, cur_class = self.find_class_window(prop.value[0])
+            if win is None:
+                self.active_window = None
+                self.current_screen = None
+                return
+            wid = self.class_windows[prop.value[0]] = win.id
+            if wid not in self.window_info:
+                win.change_attributes(event_mask=X.PropertyChangeMask | X.StructureNotifyMask)
+                geo = win.get_geometry()
+                self.window_info[wid] = [cur_class.decode('latin1'),
+                                         self.get_wm_name(win) or u'',
+                                         geo.x, geo.y, geo.width, geo.height]
+        self.active_window = wid
+        self.publish_screen(wid)
+
+    def find_class_window(self, wid):
+        """ Returns window wid, or its closest ancestor if wid has no
+            WM_CLASS, like get_cur_window, with the class. The window is
+            None if no ancestor below the root has a class either. """
+        win = self.the_display.create_resource_object('window', wid)
+        while True:
+            cur_class = win.get_wm_class()
+            if cur_class and cur_class[1]:
+                return win, cur_class[1]
+            win = win.query_tree().parent
+            if type(win) is int or not win.id or win.id == self.root.id:
+                return None, None
+
+    def publish_screen(self, wid):
+        """ Makes the cached state of wid the current screen, if it is the
+            active window. Read by processevents on the RECORD thread. """
+        if wid != self.active_window:
+            return
+        info = self.window_info[wid]
+        if info[0]:
+            self.current_screen = tuple(info)
+        else:
+            self.current_screen = None
 
     def get_key_name(self, keycode, state):
         state_idx = state_to_idx(state)
@@ -138,8 +330,7 @@ class Sniffer:
         else:
             return self.lookup_keysym(cn)
 
-    def key_event(self, event):
-        flags = event.state
+    def key_event(self, detail, flags, sequence_number):
         modifiers = []
         if flags & X.ControlMask:
             modifiers.append('Ctrl')
@@ -149,13 +340,10 @@ class Sniffer:
             modifiers.append('Super')
         if flags & X.ShiftMask:
             modifiers.append('Shift')
-        return (event.detail,
+        return (detail,
                 modifiers,
-                self.get_key_name(event.detail, event.state),
-                event.sequence_number == 1)
-
-    def button_event(self, event):
-        return event.detail, event.root_x, event.root_y
+                self.get_key_name(detail, flags),
+                sequence_number == 1)
 
     def lookup_keysym(self, keysym):
         if keysym in self.keysymdict:
@@ -224,3 +412,139 @@ class Sniffer:
             except XError:
                 i += 1
         return geo
+
+
+# Targets tried for the text of a selection, best first
+TEXT_TARGETS = ['UTF8_STRING', 'text/plain;charset=utf-8', 'STRING', 'TEXT', 'text/plain']
+
+
+class SelectionWatcher(threading.Thread):
+    """ Follows the owners of the X selections in cfg.CLIPBOARD_SELECTIONS
+        through XFixes events on a display of its own, and calls
+        hook(selection, content, targets, requested) from this thread.
+        content is the UTF-8 text of the selection, at most
+        cfg.CLIPBOARD_MAX_BYTES of it, or None if it has no text; targets are
+        the MIME types offered. requested is True if the content was asked
+        for with request(). A selection is only fetched once it has kept its
+        owner for cfg.CLIPBOARD_SETTLE seconds, so a drag selecting text
+        costs one fetch. """
+
+    def __init__(self, hook, selections=cfg.CLIPBOARD_SELECTIONS):
+        super(SelectionWatcher, self).__init__()
+        self.daemon = True
+        self.hook = hook
+
+        self.display = display.Display()
+        self.display.xfixes_query_version()
+        self.window = self.display.screen().root.create_window(0, 0, 1, 1, 0, X.CopyFromParent)
+        self.atom_TARGETS = self.display.intern_atom('TARGETS')
+        self.atom_INCR = self.display.intern_atom('INCR')
+        self.atom_property = self.display.intern_atom('SELFSPY_SELECTION')
+        self.atom_names = {}
+
+        self.selections = {}  # atom -> name
+        self.selection_atoms = {}  # name -> atom
+        for name in selections:
+            atom = self.display.intern_atom(name)
+            self.selections[atom] = name
+            self.selection_atoms[name] = atom
+            self.display.xfixes_select_selection_input(
+                self.window, atom, xfixes.XFixesSetSelectionOwnerNotifyMask)
+        self.display.flush()
+
+        self.pending = {}  # selection atom -> time its owner changed
+        self.requested = set()
+        self.lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def request(self, selection):
+        """ Fetches selection as soon as possible, from any thread """
+        atom = self.selection_atoms.get(selection)
+        if atom is None:
+            return
+        with self.lock:
+            self.requested.add(atom)
+        os.write(self.wakeup_w, 'x')
+
+    def run(self):
+        while True:
+            with self.lock:
+                requested, self.requested = self.requested, set()
+            for atom in requested:
+                self.pending.pop(atom, None)
+                self.fetch(atom, True)
+
+            now = time.time()
+            for atom, changed in self.pending.items():
+                if now - changed >= cfg.CLIPBOARD_SETTLE:
+                    del self.pending[atom]
+                    self.fetch(atom, False)
+
+            timeout = None
+            if self.pending:
+                timeout = max(0, min(self.pending.values()) + cfg.CLIPBOARD_SETTLE - time.time())
+            self.wait_for_events(timeout)
+            while self.display.pending_events():
+                self.handle_event(self.display.next_event())
+
+    def wait_for_events(self, timeout):
+        if self.display.pending_events():
+            return
+        ready = select.select([self.display, self.wakeup_r], [], [], timeout)[0]
+        if self.wakeup_r in ready:
+            os.read(self.wakeup_r, 64)
+
+    def handle_event(self, event):
+        if isinstance(event, xfixes.SetSelectionOwnerNotify):
+            if event.selection in self.selections and event.owner and event.owner != self.window.id:
+                self.pending[event.selection] = time.time()
+
+    def fetch(self, selection, requested):
+        try:
+            targets = self.convert(selection, self.atom_TARGETS)
+            if targets is None or targets.format != 32:
+                return
+            names = [self.atom_name(atom) for atom in targets.value]
+            content = None
+            for name in TEXT_TARGETS:
+                if name in names:
+                    content = self.convert(selection, self.display.intern_atom(name))
+                    break
+            if content is not None:
+                if content.format != 8 or content.property_type == self.atom_INCR:
+                    content = None  # too large for a single transfer
+                elif name in ('STRING', 'TEXT'):
+                    content = content.value.decode('latin1').encode('utf8')
+                else:
+                    content = content.value
+        except XError:
+            return  # the owner went away
+        self.hook(self.selections[selection], content,
+                  [name for name in names if '/' in name], requested)
+
+    def convert(self, selection, target):
+        """ Asks the owner of selection for target and returns the property
+            it was delivered in, or None if the owner refused or timed out """
+        self.window.convert_selection(selection, target, self.atom_property, X.CurrentTime)
+        self.display.flush()
+        deadline = time.time() + cfg.CLIPBOARD_TIMEOUT
+        while True:
+            while self.display.pending_events():
+                event = self.display.next_event()
+                if event.type == X.SelectionNotify and event.selection == selection:
+                    if event.property == X.NONE:
+                        return None
+                    return self.window.get_property(
+                        self.atom_property, X.AnyPropertyType,
+                        0, cfg.CLIPBOARD_MAX_BYTES // 4, True)
+                self.handle_event(event)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            select.select([self.display], [], [], remaining)
+
+    def atom_name(self, atom):
+        name = self.atom_names.get(atom)
+        if name is None:
+            name = self.atom_names[atom] = self.display.get_atom_name(atom)
+        return name
@@ -19,15 +19,25 @@
 
 import os
 import sys
+import errno
 import re
 import datetime
 import time
 
 import argparse
+import itertools
 import ConfigParser
 
+from array import array
 from collections import Counter
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sqlalchemy import func, select
+
 from Crypto.Cipher import Blowfish
 import hashlib
 
@@ -35,14 +45,21 @@ import config as cfg
 
 from selfspy import check_password
 from selfspy.password_dialog import get_password
-from selfspy.period import Period
+from selfspy.period import Periods
 
 from selfspy import models
+from selfspy import rollup
+from selfspy import retention
+from selfspy import shards
+from selfspy import body_index
+from selfspy import output
 
 import codecs
 sys.stdout = codecs.getwriter('utf8')(sys.stdout)
 
-ACTIVE_SECONDS = 180
+ACTIVE_SECONDS = cfg.ROLLUP_ACTIVE_SECONDS
+# regular expressions that only match themselves, in ASCII
+LITERAL = re.compile(r'^[\w \-,;:!"#%&\'/<=>@`~]*$')
 PERIOD_LOOKUP = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
 ACTIVITY_ACTIONS = {'active', 'periods', 'pactive', 'tactive', 'ratios'}
 SUMMARY_ACTIONS = ACTIVITY_ACTIONS.union({'pkeys', 'tkeys', 'key_freqs', 'clicks', 'ratios'})
@@ -50,6 +67,9 @@ SUMMARY_ACTIONS = ACTIVITY_ACTIONS.union({'pkeys', 'tkeys', 'key_freqs', 'clicks
 PROCESS_ACTIONS = {'pkeys', 'pactive'}
 WINDOW_ACTIONS = {'tkeys', 'tactive'}
 
+# SQLite allows at most 999 parameters in a query
+IN_CHUNK = 500
+
 BUTTON_MAP = [('button1', 'left'),
               ('button2', 'middle'),
               ('button3', 'right'),
@@ -148,7 +168,7 @@ def make_time_string(dates, clock):
     return now.strftime('%Y-%m-%d %H:%M'), now
 
 
-def make_period(q, period, who, start, prop):
+def parse_period(period, who):
     if isinstance(period, list) and len(period)>0:
         if type(period[0]) is str:
             periodstr = "".join(period)
@@ -174,34 +194,122 @@ def make_period(q, period, who, start, prop):
             print '--limit unit "%s" not one of %s' % (period[1], PERIOD_LOOKUP.keys())
             sys.exit(1)
         d[PERIOD_LOOKUP[period[1]]] = val
+    return datetime.timedelta(**d)
 
+
+def make_period(q, period, who, start, prop):
+    delta = parse_period(period, who)
     if start:
-        return q.filter(prop <= start + datetime.timedelta(**d))
+        return q.filter(prop <= start + delta)
     else:
-        start = datetime.datetime.now() - datetime.timedelta(**d)
+        start = datetime.datetime.now() - delta
         return q.filter(prop >= start), start
 
 
-def create_times(row):
-    current_time = time.mktime(row.created_at.timetuple())
-    abs_times = [current_time]
-    for t in row.load_timings():
-        current_time -= t
-        abs_times.append(current_time)
-    abs_times.reverse()
-    return abs_times
+class KeyCodeCounter:
+    """ Counts KeySymbol ids in bulk. Codes are gathered in one int array and
+        counted a chunk at a time, with numpy.bincount when numpy is
+        installed. """
+
+    CHUNK = 1 << 20
+
+    def __init__(self):
+        self.pending = array('i')
+        self.counts = None if numpy is None else numpy.zeros(0, dtype=numpy.int64)
+        self.counter = Counter()
+
+    def add(self, codes):
+        if codes.typecode != 'i':
+            codes = array('i', codes)
+        self.pending.extend(codes)
+        if len(self.pending) >= self.CHUNK:
+            self.flush()
+
+    def flush(self):
+        if numpy is None:
+            self.counter.update(self.pending)
+        elif self.pending:
+            counts = numpy.bincount(numpy.frombuffer(self.pending, dtype='i%d' % self.pending.itemsize))
+            if len(counts) > len(self.counts):
+                counts[:len(self.counts)] += self.counts
+                self.counts = counts
+            else:
+                self.counts[:len(counts)] += counts
+        self.pending = array('i')
+
+    def symbol_counts(self, symbols):
+        """ Returns a Counter of key string -> presses. symbols maps KeySymbol
+            ids to key strings. """
+        self.flush()
+        result = Counter()
+        if numpy is None:
+            items = self.counter.iteritems()
+        else:
+            nonzero = numpy.flatnonzero(self.counts)
+            items = zip(nonzero.tolist(), self.counts[nonzero].tolist())
+        for code, count in items:
+            result[symbols[code]] += count
+        return result
+
+
+class Names:
+    """ The names of the rows of a dimension table that the selected rows
+        refer to, read in one query per database so rows do not each load
+        their process or window. first maps every id to the first id read
+        with the same name, so rows can be counted per id and still come out
+        grouped by name. """
+
+    def __init__(self, cls, column, decrypt=False):
+        self.cls = cls
+        self.column = column
+        self.decrypt = decrypt
+        self.names = {}
+        self.first = {}
+        self.ids = {}
+
+    def add(self, session, ids):
+        """ Reads the names of ids, a subquery or a list of ids """
+        if isinstance(ids, list):
+            for i in xrange(0, len(ids), IN_CHUNK):
+                self.read(session, ids[i:i + IN_CHUNK])
+        else:
+            self.read(session, ids)
+
+    def read(self, session, ids):
+        for i, name in session.query(self.cls.id, self.column).filter(self.cls.id.in_(ids)):
+            if i in self.names:
+                continue
+            if self.decrypt:
+                name = models.sql_decrypt(name)
+            self.names[i] = name
+            self.first[i] = self.ids.setdefault(name, i)
+
+    def __getitem__(self, i):
+        return self.names[i]
+
+
+def whole_minutes(delta):
+    return delta.total_seconds() % 60 == 0
 
 
 class Selfstats:
     def __init__(self, db_name, args):
         self.args = args
         self.session_maker = models.initialize(db_name)
+        self.shard_set = shards.ShardSet(db_name)
+        self.sessions = []
         self.inmouse = False
+        # reg_filter results, the filters are matched once per run
+        self.reg_filters = {}
+        # --format output goes here, see main
+        self.stream = getattr(sys.stdout, 'stream', sys.stdout)
 
         self.check_needs()
 
     def do(self):
-        if self.need_summary:
+        if self.args['export']:
+            self.export()
+        elif self.need_summary:
             self.calc_summary()
             self.show_summary()
         else:
@@ -209,6 +317,7 @@ class Selfstats:
 
     def check_needs(self):
         self.need_text = False
+        self.need_titles = False
         self.need_activity = False
         self.need_timings = False
         self.need_keys = False
@@ -235,30 +344,87 @@ class Selfstats:
 
         if any(self.args[k] for k in SUMMARY_ACTIONS):
             self.need_summary = True
+        # window titles are stored encrypted; listings only decrypt them if
+        # a password is given anyway
+        if self.need_window or self.args['export'] or self.args['title'] is not None:
+            self.need_titles = True
+
+    def reg_filter(self, name, names, table, column):
+        """ A subquery of the ids of the table rows where column matches the
+            --name regular expression, or None if it was not given. The match
+            runs inside SQLite: a plain ASCII string is searched with LIKE,
+            which is case insensitive too, anything else with the REGEXP
+            function of models.make_engine. Neither uses an index: both
+            decrypt and look at every row of table, only inside SQLite
+            instead of loading it into Python. Titles are matched decrypted,
+            so main sets the password first.
+            Returns (subquery, matches). """
+        if self.args[name] is None:
+            return None, 0
+        if name in self.reg_filters:
+            return self.reg_filters[name]
+        pattern = self.args[name]
+        if isinstance(pattern, str):
+            pattern = pattern.decode('utf8')
+        try:
+            re.compile(pattern, re.I)
+        except re.error, e:
+            print 'Error in regular expression', str(e)
+            sys.exit(1)
 
-    def maybe_reg_filter(self, q, name, names, table, source_prop, target_prop):
-        if self.args[name] is not None:
-            ids = []
-            try:
-                reg = re.compile(self.args[name], re.I)
-            except re.error, e:
-                print 'Error in regular expression', str(e)
-                sys.exit(1)
-
-            for x in self.session.query(table).all():
-                if reg.search(x.__getattribute__(source_prop)):
-                    ids.append(x.id)
-            if not self.inmouse:
-                print '%d %s matched' % (len(ids), names)
-            if ids:
-                q = q.filter(target_prop.in_(ids))
-            else:
-                return q, False
-        return q, True
+        if LITERAL.match(pattern):
+            escaped = pattern.replace('%', '\\%').replace('_', '\\_')
+            cond = column.like('%' + escaped + '%', escape='\\')
+        else:
+            cond = column.op('REGEXP')(pattern)
+        matches = self.session.query(func.count(table.id)).filter(cond).scalar()
+        if not self.inmouse:
+            print '%d %s matched' % (matches, names)
+        self.reg_filters[name] = select([table.id]).where(cond), matches
+        return self.reg_filters[name]
+
+    def time_range(self, exact_end):
+        """ Returns (start, end), the datetimes the rows asked for can have
+            been created in, None for an open end. Used to pick the shards to
+            read. Unless exact_end, --limit bounds the start of a key
+            sequence and not its creation, so the end is left open. """
+        start = limit_from = None
+        if self.args['date'] or self.args['clock']:
+            s, limit_from = make_time_string(self.args['date'], self.args['clock'])
+            start = datetime.datetime.strptime(s, '%Y-%m-%d %H:%M')
+        elif self.args['id'] is None and self.args['back'] is not None:
+            start = limit_from = datetime.datetime.now() - parse_period(self.args['back'], '--back')
+        if start is None or self.args['limit'] is None or not exact_end:
+            return start, None
+        return start, limit_from + parse_period(self.args['limit'], '--limit')
 
     def filter_prop(self, prop, startprop):
+        """ Yields the query for the selected prop rows of the main
+            database, then of every shard that can hold some """
         self.session = self.session_maker()
 
+        process_ids, found = self.reg_filter('process', 'process(es)', models.Process,
+                                             models.Process.name)
+        if process_ids is not None and not found:
+            return
+        title_ids, found = self.reg_filter('title', 'title(s)', models.Window,
+                                           func.decrypt(models.Window.title))
+        if title_ids is not None and not found:
+            return
+
+        start, end = self.time_range(startprop.key == 'created_at')
+        for maker in self.shard_set.readers(self.session_maker, start, end):
+            # rows only hold a weak reference to their session
+            self.session = maker()
+            self.sessions.append(self.session)
+            q = self.filter_session(prop, startprop)
+            if process_ids is not None:
+                q = q.filter(prop.process_id.in_(process_ids))
+            if title_ids is not None:
+                q = q.filter(prop.window_id.in_(title_ids))
+            yield q
+
+    def filter_session(self, prop, startprop):
         q = self.session.query(prop).order_by(prop.id)
 
         if self.args['date'] or self.args['clock']:
@@ -267,60 +433,174 @@ class Selfstats:
             if self.args['limit'] is not None:
                 q = make_period(q, self.args['limit'], '--limit', start, startprop)
         elif self.args['id'] is not None:
+            # --limit counts rows from here, see cursor_limit
             q = q.filter(prop.id >= self.args['id'])
-            if self.args['limit'] is not None:
-                q = q.filter(prop.id < self.args['id'] + int(self.args['limit'][0]))
         elif self.args['back'] is not None:
             q, start = make_period(q, self.args['back'], '--back', None, startprop)
             if self.args['limit'] is not None:
                 q = make_period(q, self.args['limit'], '--limit', start, startprop)
 
-        q, found = self.maybe_reg_filter(q, 'process', 'process(es)', models.Process, 'name', prop.process_id)
-        if not found:
-            return None
-
-        q, found = self.maybe_reg_filter(q, 'title', 'title(s)', models.Window, 'title', prop.window_id)
-        if not found:
-            return None
-
         return q
 
-    def filter_keys(self):
-        q = self.filter_prop(models.Keys, models.Keys.started)
-        if q is None:
-            return
-
-        if self.args['min_keys'] is not None:
-            q = q.filter(models.Keys.nrkeys >= self.args['min_keys'])
-
+    def cursor_limit(self):
+        """ With --id, --limit is the number of rows to read from --id on """
+        if (self.args['date'] or self.args['clock'] or self.args['id'] is None
+                or self.args['limit'] is None):
+            return None
+        return int(self.args['limit'][0])
+
+    def paginate(self, q, prop, columns=None):
+        """ Yields the rows of q, which is ordered by id, read a chunk of at
+            most cfg.SELFSTATS_CHUNK_ROWS rows at a time, each chunk
+            continuing after the last id of the one before, so at most a
+            chunk is held. With columns, the rows are tuples of the id and
+            columns only, read with Core queries without building ORM
+            objects. """
+        size = min(cfg.SELFSTATS_CHUNK_ROWS, self.cursor_limit() or cfg.SELFSTATS_CHUNK_ROWS)
+        if columns is not None:
+            q = q.with_entities(prop.id, *columns)
+        chunk = q
+        while True:
+            if columns is None:
+                rows = chunk.limit(size).all()
+            else:
+                rows = q.session.execute(chunk.limit(size).statement).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < size:
+                return
+            chunk = q.filter(prop.id > rows[-1].id)
+
+    def filter_keys(self, columns=None):
+        """ Yields the selected Keys rows. With columns, only those columns
+            are read, see paginate, unless --body needs the rows to decrypt
+            their text. """
+        limit = self.cursor_limit()
+        rows = self.matching_keys(columns)
+        return rows if limit is None else itertools.islice(rows, limit)
+
+    def matching_keys(self, columns):
+        bodrex = None
         if self.args['body']:
             try:
                 bodrex = re.compile(self.args['body'], re.I)
             except re.error, e:
                 print 'Error in regular expression', str(e)
                 sys.exit(1)
-            for x in q.all():
-                if(self.need_humanreadable):
-                    body = x.decrypt_humanreadable()
-                else:
-                    body = x.decrypt_text()
-                if bodrex.search(body):
+
+        tokens = first_id = None
+        if bodrex is not None:
+            session = self.session_maker()
+            first_id = body_index.start_id(session)
+            session.close()
+            if first_id is not None:
+                tokens = body_index.query_tokens(self.args['body'])
+
+        for q in self.filter_prop(models.Keys, models.Keys.started):
+            if self.args['min_keys'] is not None:
+                q = q.filter(models.Keys.nrkeys >= self.args['min_keys'])
+            if tokens is not None:
+                q = body_index.narrow(q, tokens, first_id)
+
+            if bodrex is not None:
+                for x in self.paginate(q, models.Keys):
+                    if(self.need_humanreadable):
+                        body = x.decrypt_humanreadable()
+                    else:
+                        body = x.decrypt_text()
+                    if bodrex.search(body):
+                        yield x
+            else:
+                for x in self.paginate(q, models.Keys, columns):
                     yield x
-        else:
-            for x in q:
-                yield x
 
-    def filter_clicks(self):
+    def filter_clicks(self, columns=None):
+        limit = self.cursor_limit()
+        rows = self.matching_clicks(columns)
+        return rows if limit is None else itertools.islice(rows, limit)
+
+    def matching_clicks(self, columns):
         self.inmouse = True
-        q = self.filter_prop(models.Click, models.Click.created_at)
-        if q is None:
-            return
+        for q in self.filter_prop(models.Click, models.Click.created_at):
+            for x in self.paginate(q, models.Click, columns):
+                yield x
+
+    def export(self):
+        """ Writes the selected rows as columns, see export.py """
+        if numpy is None:
+            print 'selfstats --export needs numpy'
+            sys.exit(1)
+        if self.args['body'] is not None:
+            print '--body cannot be used with --export'
+            sys.exit(1)
+        directory = self.args['export']
+        if os.path.exists(directory) and os.listdir(directory):
+            print '%s is not empty' % directory
+            sys.exit(1)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
 
-        for x in q:
-            yield x
+        from selfspy import export
+        self.retention_notice()
+        exporter = export.Exporter(directory)
+
+        keys = self.filter_prop(models.Keys, models.Keys.started)
+        if self.args['min_keys'] is not None:
+            keys = (q.filter(models.Keys.nrkeys >= self.args['min_keys']) for q in keys)
+        limit = self.cursor_limit()
+        nr_keys = exporter.export_table('keys', keys, models.Keys, export.KEYS_COLUMNS,
+                                        timings=True, limit=limit)
+        self.inmouse = True
+        nr_clicks = exporter.export_table('clicks', self.filter_prop(models.Click, models.Click.created_at),
+                                          models.Click, export.CLICK_COLUMNS, limit=limit)
+        nr_clipboard = exporter.export_table('clipboard', self.filter_prop(models.Clipboard, models.Clipboard.created_at),
+                                             models.Clipboard, export.CLIPBOARD_COLUMNS, limit=limit)
+
+        session = self.session_maker()
+        exporter.write_dimensions(session)
+        session.close()
+        print 'Exported %d key sequences, %d clicks and %d clipboard events to %s' % (
+            nr_keys, nr_clicks, nr_clipboard, directory)
+
+    def retention_notice(self):
+        """ Tells when the rows asked for reach back into downsampled data """
+        session = self.session_maker()
+        horizons = retention.horizons(session)
+        session.close()
+        start = self.time_range(False)[0]
+        detail = horizons.get(retention.DropDetail.name)
+        if detail is not None and (start is None or start < detail):
+            print 'Events before %s have been dropped by the retention policy; only summaries read from the activity rollups include them.' % detail
+        text = horizons.get(retention.DropText.name)
+        if text is not None and (start is None or start < text) and (
+                self.need_text or self.args['key_freqs']):
+            print 'The text of keystrokes before %s has been dropped by the retention policy.' % text
+
+    def load_names(self, props, processes=True, windows=True):
+        """ Reads the names of the processes and titles of the windows that
+            the rows selected of every (prop, startprop) of props refer to,
+            with the filtered queries as subqueries """
+        self.process_names = Names(models.Process, models.Process.name)
+        self.window_titles = Names(models.Window, models.Window.title, decrypt=True)
+        for prop, startprop in props:
+            for q in self.filter_prop(prop, startprop):
+                q = q.order_by(None)
+                if processes:
+                    self.process_names.add(q.session, q.with_entities(prop.process_id).distinct())
+                if windows:
+                    self.window_titles.add(q.session, q.with_entities(prop.window_id).distinct())
 
     def show_rows(self):
-        fkeys = self.filter_keys()
+        self.retention_notice()
+        self.load_names([(models.Keys, models.Keys.started)])
+        if self.args['showtext']:
+            fkeys = self.filter_keys()
+        else:
+            fkeys = self.filter_keys([models.Keys.started, models.Keys.created_at, models.Keys.process_id,
+                                      models.Keys.window_id, models.Keys.nrkeys])
+        if self.args['format'] != 'text':
+            return self.write_rows(fkeys)
+
         rows = 0
         print '<RowID> <Starting date and time> <Duration> <Process> <Window title> <Number of keys pressed>',
         if self.args['showtext'] and self.need_humanreadable:
@@ -332,17 +612,146 @@ class Selfstats:
 
         for row in fkeys:
             rows += 1
-            print row.id, row.started, pretty_seconds((row.created_at - row.started).total_seconds()), row.process.name, '"%s"' % row.window.title, row.nrkeys,
+            print row.id, row.started, pretty_seconds((row.created_at - row.started).total_seconds()), self.process_names[row.process_id], '"%s"' % self.window_titles[row.window_id], row.nrkeys,
             if self.args['showtext']:
-                if self.need_humanreadable:
-                    print row.decrypt_humanreadable().decode('utf8')
-                else:
-                    print row.decrypt_text().decode('utf8')
+                print self.row_text(row)
             else:
                 print
         print rows, 'rows'
 
+    def row_text(self, row):
+        if self.need_humanreadable:
+            return row.decrypt_humanreadable().decode('utf8')
+        return row.decrypt_text().decode('utf8')
+
+    def write_rows(self, fkeys):
+        """ Writes the listing in --format, see output.py """
+        fields = ['id', 'started', 'seconds', 'process', 'title', 'nrkeys']
+        if self.args['showtext']:
+            fields.append('text')
+        writer = output.make_writer(self.args['format'], fields, self.stream)
+        for row in fkeys:
+            values = [row.id, row.started, (row.created_at - row.started).total_seconds(),
+                      self.process_names[row.process_id], self.window_titles[row.window_id],
+                      row.nrkeys]
+            if self.args['showtext']:
+                values.append(self.row_text(row))
+            writer.row(values)
+        writer.close()
+
+    def rollup_range(self):
+        """ Returns (start, end) of the summarized period if the summary can
+            be answered from the activity rollups, otherwise None. start and
+            end are whole minutes, or None for an open end. A start given
+            with --back is rounded down to the minute. """
+        args = self.args
+        if (args['no_rollups'] or args['id'] is not None or args['body']
+                or args['min_keys'] is not None or args['key_freqs'] or args['periods']
+                or args['process'] is not None or args['title'] is not None):
+            return None
+        if self.need_activity and self.need_activity != cfg.ROLLUP_ACTIVE_SECONDS:
+            return None
+
+        start = end = None
+        if args['date'] or args['clock']:
+            s, _ = make_time_string(args['date'], args['clock'])
+            start = datetime.datetime.strptime(s, '%Y-%m-%d %H:%M')
+        elif args['back'] is not None:
+            back = parse_period(args['back'], '--back')
+            if not whole_minutes(back):
+                return None
+            start = (datetime.datetime.now() - back).replace(second=0, microsecond=0)
+        if start is not None and args['limit'] is not None:
+            limit = parse_period(args['limit'], '--limit')
+            if not whole_minutes(limit):
+                return None
+            end = start + limit
+
+        self.session = self.session_maker()
+        sources = [maker() for maker in self.shard_set.readers(self.session_maker, start, end)]
+        self.sessions.extend(sources)
+        if not rollup.covers(self.session, start, sources):
+            return None
+
+        # only hourly rollups are kept of the events dropped by retention
+        detail = retention.horizons(self.session).get(retention.DropDetail.name)
+        if detail is not None:
+            rounded = start, end
+            if start is not None and start < detail:
+                start = start.replace(minute=0)
+            if end is not None and end < detail and end.minute:
+                end = end.replace(minute=0) + datetime.timedelta(hours=1)
+            if (start, end) != rounded:
+                print 'Events before %s are only kept per hour; the period is rounded to whole hours.' % detail
+        return start, end
+
+    def calc_rollup_summary(self, start, end):
+        """ Fills in the summary from the rollups of [start, end). Returns
+            False, leaving the summary to the raw rows, if the active time of
+            a window title is asked for and the title belongs to more than
+            one window: the active seconds of rollups can be added up, but not
+            merged like the periods of overlapping windows. """
+        totals = rollup.totals(self.session, start, end)
+
+        def summary(counts):
+            c = dict(zip(rollup.FIELDS, counts))
+            d = {'nr': c['key_rows'],
+                 'keystrokes': c['keystrokes'],
+                 'clicks': c['clicks'],
+                 'noscroll_clicks': c['clicks'] - c['button4'] - c['button5'],
+                 'mousings': c['mousings']}
+            for button in range(1, 8):
+                d['button%d' % button] = c['button%d' % button]
+            if self.need_activity:
+                d['activity'] = rollup.ActiveTime(c['active_seconds'])
+            return d
+
+        def add(d1, name, d2):
+            if name not in d1:
+                d1[name] = d2
+                return
+            for key, val in d2.items():
+                if key == 'activity':
+                    d1[name][key].seconds += val.seconds
+                else:
+                    d1[name][key] += val
+
+        self.process_names = Names(models.Process, models.Process.name)
+        self.window_titles = Names(models.Window, models.Window.title, decrypt=True)
+        if self.need_process:
+            self.process_names.add(self.session, list(set(p for p, w in totals if p)))
+        if self.need_window:
+            self.window_titles.add(self.session, list(set(w for p, w in totals if w)))
+            if self.need_activity and len(self.window_titles.ids) < len(self.window_titles.names):
+                return False
+
+        processes = {}
+        windows = {}
+        for (process_id, window_id), counts in totals.items():
+            if not process_id:
+                self.summary = summary(counts)
+            elif not window_id:
+                if self.need_process:
+                    add(processes, self.process_names[process_id], summary(counts))
+            elif self.need_window:
+                add(windows, self.window_titles[window_id], summary(counts))
+
+        self.processes = processes
+        self.windows = windows
+        if not totals:
+            self.summary = {}
+        return True
+
     def calc_summary(self):
+        rollup_range = self.rollup_range()
+        if rollup_range is not None and self.calc_rollup_summary(*rollup_range):
+            return
+        self.retention_notice()
+        self.load_names([(models.Keys, models.Keys.started), (models.Click, models.Click.created_at)],
+                        self.need_process, self.need_window)
+        pfirst = self.need_process and self.process_names.first
+        wfirst = self.need_window and self.window_titles.first
+
         def updict(d1, d2, activity_times, sub=None):
             if sub is not None:
                 if sub not in d1:
@@ -355,31 +764,46 @@ class Selfstats:
                 d1[key] += val
 
             if self.need_activity:
-                if 'activity' not in d1:
-                    d1['activity'] = Period(self.need_activity, time.time())
-                d1['activity'].extend(activity_times)
+                targets[id(d1)] = d1
+                active.extend(id(d1), activity_times)
 
+        # the active times of every summary are collected and computed at once
+        active = Periods(self.need_activity, time.time())
+        targets = {}
         sumd = {}
         processes = {}
         windows = {}
         timings = []
         keys = Counter()
-        for row in self.filter_keys():
+        key_codes = KeyCodeCounter()
+        # the text and keys are only read for --key-freqs
+        key_columns = None if self.args['key_freqs'] else [
+            models.Keys.created_at, models.Keys.timings, models.Keys.process_id, models.Keys.window_id]
+        for row in self.filter_keys(key_columns):
+            if self.need_activity:
+                key_timings = models.decode_timings(row.timings)
+                timings = rollup.key_times(row.created_at, key_timings)
+                keystrokes = len(key_timings)
+            else:
+                keystrokes = models.count_timings(row.timings)
             d = {'nr': 1,
-                 'keystrokes': len(row.load_timings())}
+                 'keystrokes': keystrokes}
 
-            if self.need_activity:
-                timings = create_times(row)
             if self.need_process:
-                updict(processes, d, timings, sub=row.process.name)
+                updict(processes, d, timings, sub=pfirst[row.process_id])
             if self.need_window:
-                updict(windows, d, timings, sub=row.window.title)
+                updict(windows, d, timings, sub=wfirst[row.window_id])
             updict(sumd, d, timings)
 
             if self.args['key_freqs']:
-                keys.update(row.decrypt_keys())
+                codes = row.decrypt_key_codes()
+                if codes is None:
+                    keys.update(row.decrypt_keys())
+                else:
+                    key_codes.add(codes)
 
-        for click in self.filter_clicks():
+        for click in self.filter_clicks([models.Click.created_at, models.Click.button, models.Click.nrmoves,
+                                         models.Click.process_id, models.Click.window_id]):
             d = {'noscroll_clicks': click.button not in [4, 5],
                  'clicks': 1,
                  'button%d' % click.button: 1,
@@ -387,18 +811,81 @@ class Selfstats:
             if self.need_activity:
                 timings = [time.mktime(click.created_at.timetuple())]
             if self.need_process:
-                updict(processes, d, timings, sub=click.process.name)
+                updict(processes, d, timings, sub=pfirst[click.process_id])
             if self.need_window:
-                updict(windows, d, timings, sub=click.window.title)
+                updict(windows, d, timings, sub=wfirst[click.window_id])
             updict(sumd, d, timings)
 
-        self.processes = processes
-        self.windows = windows
+        for key, period in active.calc().items():
+            targets[key]['activity'] = period
+
+        # counted per first id of every name, named only now
+        self.processes = dict((self.process_names[i], d) for i, d in processes.items())
+        self.windows = dict((self.window_titles[i], d) for i, d in windows.items())
         self.summary = sumd
         if self.args['key_freqs']:
+            keys.update(key_codes.symbol_counts(models.load_key_symbols(self.session)))
             self.summary['key_freqs'] = keys
 
+    def summary_records(self):
+        """ Yields the summaries as (summary, name, value) records, in the
+            order show_summary prints them """
+        for key, name in [('keystrokes', 'keystrokes'), ('nr', 'key_sequences'), ('clicks', 'clicks'),
+                          ('noscroll_clicks', 'noscroll_clicks'), ('mousings', 'mousings')]:
+            yield name, None, self.summary.get(key, 0)
+
+        act = 0
+        if self.need_activity:
+            act = self.summary.get('activity')
+            act = act.calc_total() if act else 0
+            yield 'active', None, act
+
+        if self.args['clicks']:
+            for key, name in BUTTON_MAP:
+                yield 'clicks', name, self.summary.get(key, 0)
+
+        if self.args['key_freqs']:
+            for key, val in self.summary['key_freqs'].most_common():
+                yield 'key_freqs', key, val
+
+        for arg, groups in [('pkeys', self.processes), ('tkeys', self.windows)]:
+            if self.args[arg]:
+                data = sorted(groups.items(), key=lambda x: x[1].get('keystrokes', 0), reverse=True)
+                for name, d in data:
+                    yield arg, name, d.get('keystrokes', 0)
+
+        for arg, groups in [('pactive', self.processes), ('tactive', self.windows)]:
+            if self.args[arg]:
+                data = [(name, int(d['activity'].calc_total())) for name, d in groups.items()]
+                data.sort(key=lambda x: x[1], reverse=True)
+                for name, seconds in data:
+                    yield arg, name, seconds
+
+        if self.args['periods'] and 'activity' in self.summary:
+            for t1, t2 in self.summary['activity'].times:
+                yield ('periods', datetime.datetime.fromtimestamp(t1).replace(microsecond=0),
+                       datetime.datetime.fromtimestamp(t2).replace(microsecond=0))
+
+        if self.args['ratios']:
+            def tryget(prop):
+                return float(max(1, self.summary.get(prop, 1)))
+
+            mousings = tryget('mousings')
+            clicks = tryget('clicks')
+            keys = tryget('keystrokes')
+            yield 'ratios', 'keys/clicks', keys / clicks
+            yield 'ratios', 'active_seconds/keys', act / keys
+            yield 'ratios', 'mousings/keys', mousings / keys
+            yield 'ratios', 'mousings/clicks', mousings / clicks
+
     def show_summary(self):
+        if self.args['format'] != 'text':
+            writer = output.make_writer(self.args['format'], ['summary', 'name', 'value'], self.stream)
+            for record in self.summary_records():
+                writer.row(record)
+            writer.close()
+            return
+
         print '%d keystrokes in %d key sequences,' % (self.summary.get('keystrokes', 0), self.summary.get('nr', 0)),
         print '%d clicks (%d excluding scroll),' % (self.summary.get('clicks', 0), self.summary.get('noscroll_clicks', 0)),
         print '%d mouse movements' % (self.summary.get('mousings', 0))
@@ -507,7 +994,7 @@ def parse_config():
 
     parser = argparse.ArgumentParser(description="""Calculate statistics on selfspy data. Per default it will show non-text information that matches the filter. Adding '-s' means also show text. Adding any of the summary options will show those summaries over the given filter instead of the listing. Multiple summary options can be given to print several summaries over the same filter. If you give arguments that need to access text / keystrokes, you will be asked for the decryption password.""", epilog="""See the README file or http://gurgeh.github.com/selfspy for examples.""", parents=[conf_parser])
     parser.set_defaults(**defaults)
-    parser.add_argument('-p', '--password', help='Decryption password. Only needed if selfstats needs to access text / keystrokes data. If your database in not encrypted, specify -p="" here. If you don\'t specify a password in the command line arguments or in a config file, and the statistics you ask for require a password, a dialog will pop up asking for the password. If you give your password on the command line, remember that it will most likely be stored in plain text in your shell history.')
+    parser.add_argument('-p', '--password', help='Decryption password. Only needed if selfstats needs to access text / keystrokes data, or window titles for --title, --tkeys, --tactive or --export. Listings show decrypted window titles only when a password is given. If your database in not encrypted, specify -p="" here. If you don\'t specify a password in the command line arguments or in a config file, and the statistics you ask for require a password, a dialog will pop up asking for the password. If you give your password on the command line, remember that it will most likely be stored in plain text in your shell history.')
     parser.add_argument('-d', '--data-dir', help='Data directory for selfspy, where the database is stored. Remember that Selfspy must have read/write access. Default is %s' % cfg.DATA_DIR, default=cfg.DATA_DIR)
 
     parser.add_argument('-s', '--showtext', action='store_true', help='Also show the text column. This switch is ignored if at least one of the summary options are used. Requires password.')
@@ -519,11 +1006,11 @@ def parse_config():
 
     parser.add_argument('-b', '--back', nargs='+', type=str, help='--back <period> [<unit>] Start the listing or summary this much back in time. Use this as an alternative to --date, --clock and --id. If any of those are given, this option is ignored. <unit> is either "s" (seconds), "m" (minutes), "h" (hours), "d" (days) or "w" (weeks). If no unit is given, it is assumed to be hours.')
 
-    parser.add_argument('-l', '--limit', help='--limit <period> [<unit>]. If the start is given in --date/--clock, the limit is a time period given by <unit>. <unit> is either "s" (seconds), "m" (minutes), "h" (hours), "d" (days) or "w" (weeks). If no unit is given, it is assumed to be hours. If the start is given with --id, limit has no unit and means that the maximum row ID is --id + --limit.', nargs='+', type=str)
+    parser.add_argument('-l', '--limit', help='--limit <period> [<unit>]. If the start is given in --date/--clock, the limit is a time period given by <unit>. <unit> is either "s" (seconds), "m" (minutes), "h" (hours), "d" (days) or "w" (weeks). If no unit is given, it is assumed to be hours. If the start is given with --id, limit has no unit and is the number of rows to read from --id on, so the next page starts after the last row ID shown.', nargs='+', type=str)
 
     parser.add_argument('-m', '--min-keys', type=int, metavar='nr', help='Only allow entries with at least <nr> keystrokes')
 
-    parser.add_argument('-T', '--title', type=str, metavar='regexp', help='Only allow entries where a search for this <regexp> in the window title matches something. All regular expressions are case insensitive.')
+    parser.add_argument('-T', '--title', type=str, metavar='regexp', help='Only allow entries where a search for this <regexp> in the window title matches something. All regular expressions are case insensitive. Requires password, as every window title is decrypted to be searched.')
     parser.add_argument('-P', '--process', type=str, metavar='regexp', help='Only allow entries where a search for this <regexp> in the process matches something.')
     parser.add_argument('-B', '--body', type=str, metavar='regexp', help='Only allow entries where a search for this <regexp> in the body matches something. Do not use this filter when summarizing ratios or activity, as it has no effect on mouse clicks. Requires password.')
 
@@ -541,9 +1028,15 @@ def parse_config():
     parser.add_argument('--pactive', type=int, metavar='seconds', nargs='?', const=ACTIVE_SECONDS, help='List processes, sorted by time spent active in them. Optional argument works same as for --active.')
     parser.add_argument('--tactive', type=int, metavar='seconds', nargs='?', const=ACTIVE_SECONDS, help='List window titles, sorted by time spent active in them. Optional argument works same as for --active.')
 
+    parser.add_argument('--no-rollups', action='store_true', help='Compute summaries from the stored keystrokes and clicks even when the per-minute and per-hour activity rollups could answer them. Summaries from rollups count activity in the minute it happened, so they can differ slightly at the ends of the period.')
+
     parser.add_argument('--pkeys', action='store_true', help='List processes sorted by number of keystrokes.')
     parser.add_argument('--tkeys', action='store_true', help='List window titles sorted by number of keystrokes.')
 
+    parser.add_argument('--format', choices=['text'] + output.FORMATS, default='text', help='Output format of listings and summaries. jsonl writes a JSON object per line, csv and tsv a header line and then a line per row. Summaries are written as summary, name, value records. Messages go to standard error. Default is text.')
+
+    parser.add_argument('--export', metavar='DIR', help='Instead of listing or summarizing, write the key sequences, clicks and clipboard events that match the filter to the new directory DIR as NumPy .npy files, one per column and chunk of rows. Processes and windows are stored once, in DIR/processes.npy and DIR/windows.npy, and referred to by their position there. The --body filter cannot be used. Requires numpy and the password.')
+
     return parser.parse_args()
 
 
@@ -569,18 +1062,28 @@ def main():
         return check_password.check(args['data_dir'], encrypter, read_only=True)
 
     ss = Selfstats(os.path.join(args['data_dir'], cfg.DBNAME), args)
+    if args['format'] != 'text':
+        # keep standard output for the rows
+        sys.stdout = codecs.getwriter('utf8')(sys.stderr)
 
-    if ss.need_text or ss.need_keys:
+    if ss.need_text or ss.need_keys or ss.need_titles or args['password'] is not None:
         if args['password'] is None:
             args['password'] = get_password(verify=check_with_encrypter)
 
         models.ENCRYPTER = make_encrypter(args['password'])
+        models.LOOKUP_KEY = models.make_lookup_key(hashlib.md5(args['password']).digest()
+                                                   if args['password'] else None)
 
         if not check_password.check(args['data_dir'], models.ENCRYPTER, read_only=True):
             print 'Password failed'
             sys.exit(1)
 
-    ss.do()
+    try:
+        ss.do()
+    except IOError as e:
+        # whatever read the --format output stopped reading
+        if e.errno != errno.EPIPE:
+            raise
 
 
 if __name__ == '__main__':
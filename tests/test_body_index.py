@@ -0,0 +1,53 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+import unittest
+
+from selfspy import body_index
+
+
+TEXTS = ['na\xc3\xafve user', 'Na\xc3\xafve', 'the caf\xc3\xa9 is open', 'x_1 foo-bar',
+         'K\xe2\x84\xaaelvin', '\xc3\xbcber alles', 'plain ascii text']
+
+PATTERNS = [r'\bna\b', r'\bve\b', r'\bnaive\b', r'\bcaf\b', r'caf\xc3\xa9', r'\bis\b',
+            r'\bx_1\b', r'\bfoo\b', r'\belvin\b', r'\bber\b', r'ascii', r'\bNA\b']
+
+
+class BodyIndexTest(unittest.TestCase):
+    """ Every row that the --body scan matches has the tokens the index
+        asks for """
+
+    def test_scan_rows_have_query_tokens(self):
+        for pattern in PATTERNS:
+            tokens = body_index.query_tokens(pattern)
+            for text in TEXTS:
+                if not re.search(pattern, text, re.I):
+                    continue
+                self.assertIsNotNone(tokens, pattern)
+                indexed = set(body_index.blind(token) for token in
+                              body_index.words_and_trigrams(text.decode('utf8')))
+                self.assertTrue(set(tokens) <= indexed, (pattern, text))
+
+    def test_ascii_words(self):
+        self.assertEqual(body_index.words_and_trigrams(u'na\xefve') & set([u'wna', u'wve', u'wna\xefve']),
+                         set([u'wna', u'wve']))
+
+
+if __name__ == '__main__':
+    unittest.main()
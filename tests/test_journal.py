@@ -0,0 +1,130 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from Crypto.Cipher import Blowfish
+
+from selfspy import models
+from selfspy import journal
+from selfspy.journal import Journal, Compactor, KEY
+
+
+class JournalRestartTest(unittest.TestCase):
+    """ Every journaled event reaches the database, also after a clean
+        shutdown has folded and deleted all segments """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.session_maker = models.initialize(os.path.join(self.dir, 'selfspy.sqlite'))
+        self.folded = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fold(self, session, records):
+        for kind, when, fields, strings in records:
+            session.add(models.Process(strings[0].decode('utf8')))
+
+    def run_session(self, first):
+        session = self.session_maker()
+        log = Journal(os.path.join(self.dir, 'journal'), journal.checkpoint(session),
+                      segment_size=100)
+        session.close()
+        for i in range(first, first + 6):
+            log.append(KEY, i, (False,), ('p%d' % i,))
+        log.close()
+        Compactor(log, self.session_maker, self.fold, lambda: None).compact()
+        self.assertEqual(log.segments(), [])
+
+    def count(self):
+        session = self.session_maker()
+        n = session.query(models.Process).count()
+        session.close()
+        return n
+
+    def test_restart(self):
+        self.run_session(0)
+        self.assertEqual(self.count(), 6)
+        self.run_session(6)
+        self.assertEqual(self.count(), 12)
+
+    def test_leftover_segment(self):
+        """ A segment left behind after its checkpoint was committed is not folded again """
+        self.run_session(0)
+        session = self.session_maker()
+        last = journal.checkpoint(session)
+        session.close()
+        log = Journal(os.path.join(self.dir, 'journal'))
+        with open(log.path(last), 'wb') as f:
+            f.write(journal.encode_record(KEY, 0, (False,), ('again',)))
+        Compactor(log, self.session_maker, self.fold, lambda: None).compact()
+        self.assertEqual(self.count(), 6)
+        self.assertEqual(log.segments(), [])
+
+    def test_pending_records(self):
+        """ The records a fold keeps back are committed with its checkpoint """
+        kept = journal.encode_record(KEY, 5, (False,), ('queued',))
+
+        def fold(session, records):
+            self.fold(session, records)
+            return kept
+
+        log = Journal(os.path.join(self.dir, 'journal'))
+        log.append(KEY, 1, (False,), ('first',))
+        log.close()
+        Compactor(log, self.session_maker, fold, lambda: None).compact()
+        session = self.session_maker()
+        self.assertEqual(journal.pending_records(session), [(KEY, 5, (False,), ['queued'])])
+        session.close()
+
+        self.run_session(1)
+        session = self.session_maker()
+        self.assertEqual(journal.pending_records(session), [])
+        session.close()
+
+
+class SealedRecordTest(unittest.TestCase):
+    """ With a password, the strings of journal records are encrypted """
+
+    def setUp(self):
+        self.encrypter = models.ENCRYPTER
+        models.ENCRYPTER = Blowfish.new(hashlib.md5('secret').digest(), Blowfish.MODE_ECB)
+
+    def tearDown(self):
+        models.ENCRYPTER = self.encrypter
+
+    def test_round_trip(self):
+        for content in ['', 'typed text', 'ends in \0\0', '\xff' * 13]:
+            data = journal.encode_record(journal.CLIPBOARD, 1.5, (True,) * 7 + (0, 0),
+                                         (content, 'text/plain'))
+            self.assertNotIn('text/plain', data)
+            if len(content) > 3:
+                self.assertNotIn(content, data)
+            records = list(journal.read_records(io.BytesIO(data)))
+            self.assertEqual(records, [(journal.CLIPBOARD, 1.5, (True,) * 7 + (0, 0),
+                                        [content, 'text/plain'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
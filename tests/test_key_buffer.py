@@ -0,0 +1,92 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import unittest
+
+from selfspy.key_buffer import KeyBuffer
+
+KEYS = ['a', 'b', ' ', u'\xe9', '<[Left]>', '<[Right]>', '<[BackSpace]>']
+
+
+class KeyPress:
+    def __init__(self, key, time, is_repeat):
+        self.key = key
+        self.time = time
+        self.is_repeat = is_repeat
+
+
+def filter_many(key_presses):
+    """ How ActivityStore collapsed runs of special keys before KeyBuffer """
+    specials_in_row = 0
+    lastpress = None
+    newpresses = []
+    for press in key_presses:
+        key = press.key
+        if specials_in_row and key != lastpress.key:
+            if specials_in_row > 1:
+                lastpress.key = '%s]x%d>' % (lastpress.key[:-2], specials_in_row)
+
+            newpresses.append(lastpress)
+            specials_in_row = 0
+
+        if len(key) > 1:
+            specials_in_row += 1
+            lastpress = press
+        else:
+            newpresses.append(press)
+
+    if specials_in_row:
+        if specials_in_row > 1:
+            lastpress.key = '%s]x%d>' % (lastpress.key[:-2], specials_in_row)
+        newpresses.append(lastpress)
+
+    return newpresses
+
+
+def stored(presses):
+    """ The keys, timings and nrkeys that store_keys wrote for presses """
+    return ([press.key for press in presses], [press.time for press in presses],
+            sum(0 if press.is_repeat else 1 for press in presses))
+
+
+class KeyBufferTest(unittest.TestCase):
+
+    def test_same_as_filter_many(self):
+        rnd = random.Random(1)
+        buf = KeyBuffer()
+        for _ in range(500):
+            presses = [KeyPress(rnd.choice(KEYS), rnd.random(), rnd.random() < 0.2)
+                       for _ in range(rnd.randint(0, 40))]
+            for press in presses:
+                buf.append(press.key, press.time, press.is_repeat)
+            self.assertEqual(buf.flush(), stored(filter_many(presses)))
+            self.assertEqual(len(buf), 0)
+
+    def test_no_collapse(self):
+        rnd = random.Random(2)
+        buf = KeyBuffer(collapse=False)
+        presses = [KeyPress(rnd.choice(KEYS), rnd.random(), rnd.random() < 0.2)
+                   for _ in range(100)]
+        for press in presses:
+            buf.append(press.key, press.time, press.is_repeat)
+        self.assertEqual(buf.flush(), stored(presses))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import unittest
+
+from selfspy import period
+from selfspy.period import Period, Periods
+
+CUTOFF = 180
+MAXTIME = 20000
+
+
+def random_groups(rnd, nr_groups):
+    """ {group: times}, bursts of close times with gaps between them, some
+        past MAXTIME """
+    found = {}
+    for group in range(nr_groups):
+        times = []
+        t = rnd.uniform(0, 1000)
+        for _ in range(rnd.randint(0, 200)):
+            t += rnd.expovariate(1 / 60.0) if rnd.random() < 0.9 else rnd.uniform(200, 2000)
+            times.append(t)
+        found[group] = times
+    return found
+
+
+class PeriodTest(unittest.TestCase):
+
+    def test_order_does_not_matter(self):
+        """ Times that arrive out of order, like the clicks selfstats adds
+            after all keystrokes, give the same intervals """
+        rnd = random.Random(1)
+        for _ in range(200):
+            times = random_groups(rnd, 1)[0]
+            in_order = Period(CUTOFF, MAXTIME)
+            in_order.extend(times)
+            rnd.shuffle(times)
+            shuffled = Period(CUTOFF, MAXTIME)
+            shuffled.extend(times)
+            self.assertEqual(shuffled.times, in_order.times)
+
+    @unittest.skipIf(period.numpy is None, 'needs numpy')
+    def test_unions_match_period(self):
+        rnd = random.Random(2)
+        for _ in range(200):
+            found = random_groups(rnd, rnd.randint(1, 8))
+            groups = []
+            times = []
+            for group, group_times in found.items():
+                group_times = list(group_times)
+                rnd.shuffle(group_times)
+                groups.extend([group] * len(group_times))
+                times.extend(group_times)
+            result = period.unions(groups, times, CUTOFF, MAXTIME)
+            for group, group_times in found.items():
+                expected = Period(CUTOFF, MAXTIME)
+                expected.extend(group_times)
+                if group >= len(result):
+                    self.assertEqual(expected.times, [])
+                    continue
+                self.assertEqual(result[group].times, expected.times)
+                self.assertAlmostEqual(result[group].calc_total(), expected.calc_total())
+
+    def test_periods(self):
+        rnd = random.Random(3)
+        found = random_groups(rnd, 5)
+        collected = Periods(CUTOFF, MAXTIME)
+        for group, times in found.items():
+            collected.extend('g%d' % group, times)
+        result = collected.calc()
+        for group, times in found.items():
+            expected = Period(CUTOFF, MAXTIME)
+            expected.extend(times)
+            if times:
+                self.assertEqual(result['g%d' % group].times, expected.times)
+
+
+if __name__ == '__main__':
+    unittest.main()
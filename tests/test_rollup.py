@@ -0,0 +1,107 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy import stats
+from selfspy.rollup import Rollups
+
+
+def parse_args(*argv):
+    saved = sys.argv
+    sys.argv = ['selfstats'] + list(argv)
+    try:
+        return vars(stats.parse_config())
+    finally:
+        sys.argv = saved
+
+
+class RollupSummaryTest(unittest.TestCase):
+    """ Summaries read from the rollups match the ones computed from the raw
+        rows, also for titles shared by several windows and across a restart
+        of the logger """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.dir, cfg.DBNAME)
+        self.session_maker = models.initialize(self.db_name)
+        session = self.session_maker()
+        processes = [models.Process(name) for name in (u'editor', u'browser')]
+        session.add_all(processes)
+        session.flush()
+        windows = [models.Window(u'notes', processes[0].id),
+                   models.Window(u'notes', processes[1].id),
+                   models.Window(u'mail', processes[1].id)]
+        session.add_all(windows)
+        session.commit()
+        self.windows = [(w.process_id, w.id) for w in windows]
+        session.close()
+        self.start = datetime.datetime(2026, 1, 1, 9)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_logger(self, events):
+        """ Stores events, (seconds from start, window index, key timings),
+            like one run of the logger that starts with the stored data """
+        session = self.session_maker()
+        rollups = Rollups()
+        since = rollups.seed_start(session)
+        if since is not None:
+            rollups.seed(since, [session])
+        for seconds, window, timings in events:
+            process_id, window_id = self.windows[window]
+            row = models.Keys(u'', [], timings, len(timings), self.start, process_id, window_id, 1)
+            row.created_at = self.start + datetime.timedelta(seconds=seconds)
+            session.add(row)
+            rollups.add_keys(process_id, window_id, row.created_at, timings)
+        rollups.flush(session)
+        session.commit()
+        session.close()
+
+    def summary(self, *argv):
+        ss = stats.Selfstats(self.db_name, parse_args('--active', '--pactive', '--tactive', *argv))
+        ss.calc_summary()
+        for session in ss.sessions:
+            session.close()
+        return (ss.summary['activity'].calc_total(),
+                dict((name, d['activity'].calc_total()) for name, d in ss.processes.items()),
+                dict((name, d['activity'].calc_total()) for name, d in ss.windows.items()))
+
+    def test_shared_titles(self):
+        self.run_logger([(0, 0, [5.0, 5.0]), (60, 1, [10.0]), (100, 0, []), (1000, 2, [2.0])])
+        rollups = self.summary()
+        self.assertEqual(rollups, self.summary('--no-rollups'))
+        self.assertEqual(rollups[2][u'notes'], 290)
+
+    def test_restart(self):
+        self.run_logger([(0, 0, [5.0]), (30, 2, [])])
+        self.run_logger([(90, 0, [20.0]), (150, 2, [])])
+        rollups = self.summary()
+        self.assertEqual(rollups, self.summary('--no-rollups'))
+        self.assertEqual(rollups[0], 335)
+
+
+if __name__ == '__main__':
+    unittest.main()
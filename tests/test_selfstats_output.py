@@ -0,0 +1,116 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from selfspy import config as cfg
+from selfspy import models
+from selfspy import output
+from selfspy import stats
+
+
+def parse_args(*argv):
+    saved = sys.argv
+    sys.argv = ['selfstats'] + list(argv)
+    try:
+        return vars(stats.parse_config())
+    finally:
+        sys.argv = saved
+
+
+class PaginateTest(unittest.TestCase):
+    """ Keyset pages hold the same rows as offset and limit pages """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.dir, cfg.DBNAME)
+        session = models.initialize(self.db_name)()
+        start = datetime.datetime(2026, 1, 1)
+        for i in range(50):
+            row = models.Keys('', [], [0.1] * (i % 4), i % 4, start, 1, 1, 1)
+            row.created_at = start + datetime.timedelta(minutes=i)
+            session.add(row)
+        session.commit()
+        session.close()
+        self.chunk_rows = cfg.SELFSTATS_CHUNK_ROWS
+
+    def tearDown(self):
+        cfg.SELFSTATS_CHUNK_ROWS = self.chunk_rows
+        shutil.rmtree(self.dir)
+
+    def offset_pages(self, q, size):
+        rows = []
+        while True:
+            page = q.offset(len(rows)).limit(size).all()
+            rows.extend(page)
+            if len(page) < size:
+                return rows
+
+    def test_pages(self):
+        for size in (1, 3, 7, 50, 100):
+            cfg.SELFSTATS_CHUNK_ROWS = size
+            ss = stats.Selfstats(self.db_name, parse_args('--min-keys', '1'))
+            q = ss.session_maker().query(models.Keys).filter(
+                models.Keys.nrkeys >= 1).order_by(models.Keys.id)
+            expected = [(row.id, row.nrkeys) for row in self.offset_pages(q, size)]
+            self.assertEqual([(row.id, row.nrkeys) for row in ss.paginate(q, models.Keys)], expected)
+            self.assertEqual(list(ss.paginate(q, models.Keys, [models.Keys.nrkeys])), expected)
+            self.assertEqual([(row.id, row.nrkeys) for row in
+                              ss.filter_keys([models.Keys.nrkeys])], expected)
+
+    def test_id_and_limit(self):
+        """ With --id, --limit counts rows, also across pages """
+        cfg.SELFSTATS_CHUNK_ROWS = 4
+        ss = stats.Selfstats(self.db_name, parse_args('--id', '10', '--limit', '9', '--min-keys', '2'))
+        q = ss.session_maker().query(models.Keys).filter(
+            models.Keys.id >= 10, models.Keys.nrkeys >= 2).order_by(models.Keys.id)
+        expected = [row.id for row in q.limit(9)]
+        self.assertEqual([row.id for row in ss.filter_keys([models.Keys.nrkeys])], expected)
+
+
+class OutputTest(unittest.TestCase):
+
+    def write(self, fmt, rows):
+        stream = StringIO()
+        writer = output.make_writer(fmt, ['id', 'title'], stream)
+        for row in rows:
+            writer.row(row)
+        writer.close()
+        return stream.getvalue()
+
+    def test_empty(self):
+        self.assertEqual(self.write('csv', []), 'id,title\n')
+        self.assertEqual(self.write('tsv', []), 'id\ttitle\n')
+        self.assertEqual(self.write('jsonl', []), '')
+
+    def test_rows(self):
+        rows = [(1, u'caf\xe9, "bar"'), (2, None)]
+        self.assertEqual(self.write('csv', rows),
+                         'id,title\n1,"caf\xc3\xa9, ""bar"""\n2,\n')
+        self.assertEqual(self.write('jsonl', rows),
+                         '{"id": 1, "title": "caf\\u00e9, \\"bar\\""}\n{"id": 2, "title": null}\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# Copyright 2012 David Fendrich
+
+# This file is part of Selfspy
+
+# Selfspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Selfspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Selfspy.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import zlib
+import hashlib
+import unittest
+
+from Crypto.Cipher import Blowfish
+
+from selfspy import models
+
+
+class TimingsTest(unittest.TestCase):
+
+    def check(self, timings, tag):
+        blob = models.encode_timings(timings)
+        self.assertEqual(blob[:1], tag)
+        decoded = models.decode_timings(blob)
+        self.assertEqual(len(decoded), len(timings))
+        self.assertEqual(models.count_timings(blob), len(timings))
+        # deltas of the rounded running total, so rounding does not add up
+        total = got = 0.0
+        for expected, value in zip(timings, decoded):
+            total += expected
+            got += value
+            self.assertAlmostEqual(got, total, delta=0.0005 + 1e-9)
+        return decoded
+
+    def test_uint16(self):
+        self.check([0.1, 0.2345, 0.0, 65.5, 1.0 / 3] * 50, models.TIMINGS_UINT16_MS)
+
+    def test_int32(self):
+        self.check([0.1, 3600.0, 0.25], models.TIMINGS_INT32_MS)
+        self.check([0.5, -0.2, 0.3], models.TIMINGS_INT32_MS)
+
+    def test_float64(self):
+        timings = [0.1, 1e7, 0.5]
+        self.assertEqual(self.check(timings, models.TIMINGS_FLOAT64), timings)
+
+    def test_empty(self):
+        self.check([], models.TIMINGS_UINT16_MS)
+
+    def test_legacy_json(self):
+        timings = [0.123456, 2.5, 0.0]
+        blob = zlib.compress(json.dumps(timings))
+        self.assertEqual(models.decode_timings(blob), timings)
+        self.assertEqual(models.count_timings(blob), 3)
+
+    def test_padding(self):
+        """ Blobs read back from an encrypted column end in the \\0 padding
+            of maybe_encrypt """
+        blob = models.encode_timings([0.1, 0.2, 0.3])
+        self.assertEqual(models.decode_timings(blob + '\0' * 5), [0.1, 0.2, 0.3])
+        self.assertEqual(models.count_timings(blob + '\0' * 5), 3)
+
+        encrypter = Blowfish.new(hashlib.md5('secret').digest())
+        codes = [1, 2, 70000, 3]
+        stored = models.maybe_encrypt(models.encode_key_codes(codes), other_encrypter=encrypter)
+        self.assertEqual(len(stored) % 8, 0)
+        decoded = models.decode_key_codes(models.maybe_decrypt(stored, other_encrypter=encrypter))
+        self.assertEqual(decoded.tolist(), codes)
+
+
+if __name__ == '__main__':
+    unittest.main()